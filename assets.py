@@ -0,0 +1,293 @@
+""" Fingerprinted, bundled and precompressed static assets
+
+    python assets.py
+
+concatenates and minifies each bundle in BUNDLES, writes it to static/dist/
+under a name with its content hash in it (dashboard.3f9c1a2b7d4e.js), next
+to .gz and (with brotli installed) .br copies, and records the hashed names
+in static/dist/manifest.json. Templates link to bundles with
+asset_url('dashboard.js'). A changed file gets a new name, so the static
+route can tell browsers to keep bundles for a year, and it sends the
+precompressed copy the client accepts instead of compressing on every
+request.
+
+Old bundles are left in place so pages rendered before a deploy keep
+working. The app builds the bundles at startup if there is no manifest or a
+source file is newer than it, and in debug mode checks again on every
+page, so edits show up without a restart.
+"""
+
+from flask import request, url_for, send_from_directory
+
+import gzip
+
+import hashlib
+
+import json
+
+import mimetypes
+
+import os
+
+import posixpath
+
+import re
+
+import tempfile
+
+from cStringIO import StringIO
+
+try:
+    # brotli is optional; without it bundles are only gzipped
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Bundle name -> files under static/ in the order they are concatenated
+BUNDLES = {
+    'base.css': ['bootstrap-3.3.6/css/bootstrap.min.css', 'style.css'],
+    'base.js': ['bootstrap-3.3.6/js/bootstrap.min.js'],
+    'dashboard.js': ['js/map.js',
+                     'js/charts.js',
+                     'js/submit-expenditure.js',
+                     'js/submit-budget.js',
+                     'js/delete-expenditure.js',
+                     'js/load-more-expenditures.js',
+                     'js/submit-new-account-info.js',
+                     'js/intercom-shutdown.js']
+}
+
+# Where bundles go, under the static folder
+DIST_DIR = 'dist'
+
+MANIFEST_NAME = 'manifest.json'
+
+# Hashed names never change content, so browsers can keep them for a year
+ASSET_MAX_AGE = int(os.getenv('ASSET_MAX_AGE', 365 * 24 * 60 * 60))
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)(.*?)\1\s*\)""")
+
+CSS_COMMENT = re.compile(r"/\*.*?\*/", re.DOTALL)
+
+
+def minify_js(source):
+    """ Minify JavaScript with rjsmin if it is installed, otherwise just drop
+    indentation, blank lines and whole-line comments """
+
+    try:
+        import rjsmin
+        return rjsmin.jsmin(source)
+    except ImportError:
+        pass
+
+    lines = (line.strip() for line in source.splitlines())
+
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+
+def minify_css(source):
+    """ Minify CSS with rcssmin if it is installed, otherwise just drop
+    comments and collapse whitespace """
+
+    try:
+        import rcssmin
+        return rcssmin.cssmin(source)
+    except ImportError:
+        pass
+
+    source = CSS_COMMENT.sub("", source)
+    source = re.sub(r"\s+", " ", source)
+
+    return re.sub(r"\s*([{};,])\s*", r"\1", source).strip()
+
+
+def rebase_css_urls(source, path):
+    """ Point the relative url()s of a stylesheet at path (relative to the
+    static folder) to the same files from the dist folder """
+
+    source_dir = posixpath.dirname(path)
+
+    def rebase(match):
+        url = match.group(2)
+
+        if not url or url.startswith(('/', '#', 'data:', 'http:', 'https:')):
+            return match.group(0)
+
+        target = posixpath.normpath(posixpath.join(source_dir, url))
+
+        return "url(%s)" % posixpath.relpath(target, DIST_DIR)
+
+    return CSS_URL.sub(rebase, source)
+
+
+def bundle(static_folder, name, paths):
+    """ Concatenate and minify the files of one bundle """
+
+    sources = []
+
+    for path in paths:
+        with open(os.path.join(static_folder, path), 'rb') as source_file:
+            source = source_file.read()
+
+        if name.endswith('.css'):
+            sources.append(minify_css(rebase_css_urls(source, path)))
+        else:
+            sources.append(minify_js(source))
+
+    # A script that leaves off its last semicolon can't run into the next one
+    separator = "\n" if name.endswith('.css') else ";\n"
+
+    return separator.join(sources)
+
+
+def hashed_name(name, content):
+    """ Bundle name with a hash of its content before the extension """
+
+    stem, extension = os.path.splitext(name)
+
+    return "%s.%s%s" % (stem, hashlib.md5(content).hexdigest()[:12], extension)
+
+
+def gzip_compress(data):
+    """ Gzip a byte string at the highest level, with a fixed timestamp so
+    the same bundle always compresses to the same bytes """
+
+    buffer = StringIO()
+
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as gzip_file:
+        gzip_file.write(data)
+
+    return buffer.getvalue()
+
+
+def write_file(path, data):
+    """ Write a file atomically, so workers starting together can't read a
+    half-written bundle """
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+
+    with os.fdopen(handle, 'wb') as temp_file:
+        temp_file.write(data)
+
+    os.chmod(temp_path, 0644)
+    os.rename(temp_path, path)
+
+
+def build(static_folder, bundles=BUNDLES):
+    """ Write every bundle, its compressed copies and the manifest; returns
+    the manifest """
+
+    output_dir = os.path.join(static_folder, DIST_DIR)
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    manifest = {}
+
+    for name, paths in sorted(bundles.items()):
+        content = bundle(static_folder, name, paths)
+        filename = hashed_name(name, content)
+        path = os.path.join(output_dir, filename)
+
+        write_file(path, content)
+        write_file(path + '.gz', gzip_compress(content))
+
+        if brotli is not None:
+            write_file(path + '.br', brotli.compress(content, quality=11))
+
+        manifest[name] = posixpath.join(DIST_DIR, filename)
+
+    write_file(os.path.join(output_dir, MANIFEST_NAME),
+               json.dumps(manifest, indent=2, sort_keys=True))
+
+    return manifest
+
+
+def load_manifest(static_folder):
+    """ Read the manifest, or None if the bundles haven't been built """
+
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except IOError:
+        return None
+
+
+def sources_changed(static_folder, bundles=BUNDLES):
+    """ Whether any bundled file is newer than the manifest, or the bundles
+    haven't been built """
+
+    try:
+        built_at = os.path.getmtime(os.path.join(static_folder, DIST_DIR, MANIFEST_NAME))
+    except OSError:
+        return True
+
+    return any(os.path.getmtime(os.path.join(static_folder, path)) > built_at
+               for paths in bundles.values() for path in paths)
+
+
+def send_static(static_folder, filename, cache_timeout):
+    """ Serve a static file, sending hashed bundles precompressed and with
+    far-future caching """
+
+    if not filename.startswith(DIST_DIR + '/'):
+        return send_from_directory(static_folder, filename, cache_timeout=cache_timeout)
+
+    accept_encoding = request.accept_encodings
+    encoding = None
+
+    if accept_encoding['br'] and os.path.isfile(os.path.join(static_folder, filename + '.br')):
+        encoding = 'br'
+
+    elif accept_encoding['gzip'] and os.path.isfile(os.path.join(static_folder, filename + '.gz')):
+        encoding = 'gzip'
+
+    if encoding is None:
+        response = send_from_directory(static_folder, filename, cache_timeout=ASSET_MAX_AGE)
+    else:
+        response = send_from_directory(static_folder,
+                                       filename + ('.br' if encoding == 'br' else '.gz'),
+                                       cache_timeout=ASSET_MAX_AGE)
+        response.headers['Content-Encoding'] = encoding
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.headers['Cache-Control'] += ', immutable'
+
+    return response
+
+
+def init_app(app):
+    """ Load (or build) the manifest, add asset_url() to templates and serve
+    bundles from the static route """
+
+    manifest = load_manifest(app.static_folder)
+
+    if manifest is None or sources_changed(app.static_folder):
+        manifest = build(app.static_folder)
+
+    def asset_url(name):
+        """ URL of a bundle by its name, or of any other static file """
+
+        # Pick up edits to the sources while developing
+        if app.debug and sources_changed(app.static_folder):
+            manifest.update(build(app.static_folder))
+
+        return url_for('static', filename=manifest.get(name, name))
+
+    app.jinja_env.globals['asset_url'] = asset_url
+
+    def static(filename):
+        return send_static(app.static_folder, filename,
+                           app.get_send_file_max_age(filename))
+
+    app.view_functions['static'] = static
+
+
+if __name__ == "__main__":
+    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+    for name, path in sorted(build(static_folder).items()):
+        print "%s -> %s" % (name, path)
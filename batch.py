@@ -0,0 +1,222 @@
+""" Batch JSON API for adding many expenditures or budgets in one request
+
+Every entry is validated before anything is written. The batch then goes in
+with one bulk statement and one commit, and the response carries the
+category totals once for the whole batch. Expenditures may carry a
+client_id; resending a batch with the same client_ids (a queued sync that
+timed out, say) doesn't add them twice.
+"""
+
+from rollup import record_spending
+
+from categories import registry
+
+from importer import insert_new_rows
+
+from tools import parse_date, save_budgets, budget_summaries
+
+from decimal import Decimal, InvalidOperation
+
+import hashlib
+
+import os
+
+
+# Largest number of entries one request may carry
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 500))
+
+
+class BatchError(Exception):
+    """ A batch that can't be written, with an error for each bad entry """
+
+    def __init__(self, errors):
+        Exception.__init__(self, "Invalid batch")
+        self.errors = errors
+
+
+def check_entries(entries):
+    """ Make sure the batch is a list of objects of an acceptable size """
+
+    if not isinstance(entries, list) or not entries:
+        raise BatchError([{'index': None, 'error': "Expected a non-empty list"}])
+
+    if len(entries) > BATCH_MAX_SIZE:
+        raise BatchError([{'index': None,
+                           'error': "At most %s entries per batch" % BATCH_MAX_SIZE}])
+
+
+def required_category(entry):
+    """ Get a known category id from an entry """
+
+    try:
+        category_id = int(entry.get('category_id'))
+    except (TypeError, ValueError):
+        raise ValueError("category_id must be a number")
+
+    if registry.get(category_id) is None:
+        raise ValueError("Unknown category_id %s" % category_id)
+
+    return category_id
+
+
+def required_amount(entry, field):
+    """ Get a non-negative amount from an entry """
+
+    try:
+        amount = Decimal(str(entry.get(field))).quantize(Decimal('0.01'))
+    except (InvalidOperation, ValueError):
+        raise ValueError("%s must be an amount" % field)
+
+    if not amount.is_finite():
+        raise ValueError("%s must be an amount" % field)
+
+    if amount < 0:
+        raise ValueError("%s can't be negative" % field)
+
+    return amount
+
+
+def required_date(entry, field):
+    """ Get a date from an entry """
+
+    value = entry.get(field)
+
+    if not value or not isinstance(value, basestring):
+        raise ValueError("%s is required" % field)
+
+    return parse_date(value)
+
+
+def optional_text(entry, field, max_length=None):
+    """ Get an optional string from an entry """
+
+    value = entry.get(field)
+
+    if value is None:
+        return None
+
+    if not isinstance(value, basestring):
+        raise ValueError("%s must be a string" % field)
+
+    if max_length is not None and len(value) > max_length:
+        raise ValueError("%s is longer than %s characters" % (field, max_length))
+
+    return value
+
+
+def validate_all(entries, validate):
+    """ Validate every entry, raising a BatchError listing every bad one """
+
+    check_entries(entries)
+
+    rows = []
+    errors = []
+
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            errors.append({'index': index, 'error': "Expected an object"})
+            continue
+
+        try:
+            rows.append(validate(entry))
+        except ValueError as error:
+            errors.append({'index': index, 'error': str(error)})
+
+    if errors:
+        raise BatchError(errors)
+
+    return rows
+
+
+def client_hash(user_id, client_id):
+    """ Content hash for an entry the client gave its own id """
+
+    return hashlib.sha1(u"%s|client|%s" % (user_id, client_id)).hexdigest()
+
+
+def add_expenditures(user_id, entries):
+    """ Validate and insert a batch of expenditures for the user in one
+    transaction; returns how many were new and the affected categories'
+    summaries """
+
+    client_ids = set()
+
+    def validate(entry):
+        client_id = optional_text(entry, 'client_id', 200)
+
+        if client_id in client_ids:
+            raise ValueError("client_id %s appears twice" % client_id)
+
+        if client_id:
+            client_ids.add(client_id)
+
+        return {
+            'category_id': required_category(entry),
+            'price': required_amount(entry, 'price'),
+            'date_of_expenditure': required_date(entry, 'date'),
+            'expenditure_userid': user_id,
+            'where_bought': optional_text(entry, 'where_bought', 100),
+            'description': optional_text(entry, 'description'),
+            'tracking_num': optional_text(entry, 'tracking_num'),
+            'tracking_num_carrier': optional_text(entry, 'tracking_num_carrier', 100),
+            'content_hash': client_hash(user_id, client_id) if client_id else None
+        }
+
+    rows = validate_all(entries, validate)
+
+    # Entries sent before are skipped, so a resent batch is harmless
+    new_rows = insert_new_rows(user_id, rows)
+
+    # One rollup change per category and day, however many rows share it
+    daily_totals = {}
+
+    for row in new_rows:
+        key = (row['category_id'], row['date_of_expenditure'].date())
+        total, count = daily_totals.get(key, (Decimal(0), 0))
+        daily_totals[key] = (total + row['price'], count + 1)
+
+    for (category_id, day), (total, count) in sorted(daily_totals.items()):
+        record_spending(user_id, category_id, day, total, count=count)
+
+    category_ids = sorted(set(row['category_id'] for row in rows))
+
+    return len(new_rows), budget_summaries(user_id, category_ids)
+
+
+def add_budgets(user_id, entries):
+    """ Validate and save a batch of budgets for the user in one
+    transaction; returns the affected categories' summaries """
+
+    def validate(entry):
+        start_date = required_date(entry, 'start_date')
+        end_date = required_date(entry, 'end_date')
+
+        if end_date < start_date:
+            raise ValueError("end_date is before start_date")
+
+        return (required_category(entry), required_amount(entry, 'budget'), start_date, end_date)
+
+    budgets = validate_all(entries, validate)
+
+    save_budgets(user_id, budgets)
+
+    category_ids = sorted(set(budget[0] for budget in budgets))
+
+    return budget_summaries(user_id, category_ids)
+
+
+def summaries_to_list(summaries):
+    """ Get JSON-friendly category summaries """
+
+    return [{
+        'category_id': category_id,
+        'category': registry.get(category_id).name,
+        'budget': str(summary['budget']),
+        'start_date': summary['start_date'].strftime('%Y-%m-%d'),
+        'end_date': summary['end_date'].strftime('%Y-%m-%d'),
+        'total': summary['total'],
+        'avg': summary['avg'],
+        'count': summary['count'],
+        'remaining': summary['remaining'],
+        'progress': summary['progress']
+    } for category_id, summary in sorted(summaries.items())]
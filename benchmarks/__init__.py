@@ -0,0 +1 @@
+""" Benchmarks for Spent; run them from the repo root with python -m """
@@ -0,0 +1,144 @@
+""" Before/after benchmark for the lookup indexes added by migrations.py
+
+Run from the repo root against a scratch database, for example:
+
+    python -m benchmarks.indexes sqlite:////tmp/spent_bench.db 500000
+    python -m benchmarks.indexes postgresql:///spent_bench 2000000
+"""
+
+from datetime import datetime, timedelta
+
+from flask import Flask
+
+from model import db, connect_to_db, User, Category, Budget, Expenditure
+
+import migrations
+
+import random
+
+import sys
+
+import time
+
+
+def build_tables(expenditure_count, user_count):
+    """ Create the tables without lookup indexes and fill them with
+    synthetic rows """
+
+    db.drop_all()
+    db.create_all()
+
+    # Start from the old, unindexed schema
+    for model in [User, Budget, Expenditure]:
+        for index in model.__table__.indexes:
+            db.engine.execute("DROP INDEX IF EXISTS %s" % index.name)
+
+    db.engine.execute("DROP TABLE IF EXISTS %s" % migrations.SCHEMA_MIGRATIONS_TABLE)
+
+    db.session.execute(Category.__table__.insert(), [
+        {'id': category_id, 'category': "Category %s" % category_id}
+        for category_id in range(1, 7)])
+
+    db.session.execute(User.__table__.insert(), [
+        {'id': user_id, 'name': "user%s" % user_id,
+         'email': "user%s@example.com" % user_id, 'password': "password%s" % user_id}
+        for user_id in range(1, user_count + 1)])
+
+    db.session.execute(Budget.__table__.insert(), [
+        {'budget': 1000, 'category_id': category_id, 'budget_userid': user_id,
+         'budget_start_date': datetime(2016, 1, 1), 'budget_end_date': datetime(2016, 12, 31)}
+        for user_id in range(1, user_count + 1) for category_id in range(1, 7)])
+
+    start = datetime(2016, 1, 1)
+    batch = []
+
+    for expenditure_id in range(1, expenditure_count + 1):
+        batch.append({
+            'category_id': random.randint(1, 6),
+            'price': random.randint(100, 10000) / 100.0,
+            'date_of_expenditure': start + timedelta(days=random.randint(0, 365)),
+            'expenditure_userid': random.randint(1, user_count),
+            'where_bought': "store",
+            'description': u"synthetic",
+            'tracking_num': "TRACK%s" % expenditure_id if expenditure_id % 50 == 0 else None
+        })
+
+        if len(batch) == 10000:
+            db.session.execute(Expenditure.__table__.insert(), batch)
+            batch = []
+
+    if batch:
+        db.session.execute(Expenditure.__table__.insert(), batch)
+
+    db.session.commit()
+
+    # Make sure the planner has fresh statistics for both runs
+    db.engine.execute("ANALYZE")
+
+
+def hot_queries(user_count, expenditure_count):
+    """ The lookups the dashboard, charts, login and tracking routes make """
+
+    user_id = random.randint(1, user_count)
+    category_id = random.randint(1, 6)
+    tracking_num = "TRACK%s" % (random.randint(1, expenditure_count // 50 or 1) * 50)
+
+    return [
+        ("expenditure window", lambda: db.session.query(
+            db.func.sum(Expenditure.price), db.func.count(Expenditure.id)).filter(
+            Expenditure.expenditure_userid == user_id,
+            Expenditure.category_id == category_id,
+            Expenditure.date_of_expenditure.between(
+                datetime(2016, 3, 1), datetime(2016, 3, 31))).one()),
+        ("budget lookup", lambda: Budget.query.filter_by(
+            budget_userid=user_id, category_id=category_id).first()),
+        ("login email", lambda: User.query.filter_by(
+            email="user%s@example.com" % user_id).first()),
+        ("tracking lookup", lambda: Expenditure.query.filter_by(
+            tracking_num=tracking_num).first()),
+    ]
+
+
+def time_queries(user_count, expenditure_count, repeat):
+    """ Average milliseconds per call for each hot query """
+
+    timings = {}
+
+    for run in range(repeat):
+        for name, query in hot_queries(user_count, expenditure_count):
+            started = time.time()
+            query()
+            timings[name] = timings.get(name, 0) + (time.time() - started)
+            db.session.rollback()
+
+    return dict((name, total * 1000 / repeat) for name, total in timings.items())
+
+
+if __name__ == "__main__":
+    database_url = sys.argv[1] if len(sys.argv) > 1 else 'sqlite:////tmp/spent_bench.db'
+    expenditure_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    user_count = max(expenditure_count // 1000, 1)
+    repeat = 50
+
+    app = Flask(__name__)
+    connect_to_db(app, database_url)
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    with app.app_context():
+        print "Loading %s expenditures for %s users..." % (expenditure_count, user_count)
+        build_tables(expenditure_count, user_count)
+
+        before = time_queries(user_count, expenditure_count, repeat)
+
+        started = time.time()
+        migrations.upgrade(db.engine)
+        print "Index build took %.1fs" % (time.time() - started)
+
+        after = time_queries(user_count, expenditure_count, repeat)
+
+    print
+    print "%-20s %12s %12s %8s" % ("query", "before (ms)", "after (ms)", "speedup")
+
+    for name in sorted(before):
+        print "%-20s %12.3f %12.3f %7.0fx" % (name, before[name], after[name],
+                                             before[name] / max(after[name], 1e-6))
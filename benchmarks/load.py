@@ -0,0 +1,331 @@
+""" End-to-end load benchmark for the Flask routes
+
+Fills a scratch database with synthetic users, budgets and expenditures,
+then has many concurrent clients log in and use the dashboard, the chart
+endpoints and add_expenditure through the Flask test client. Prints p50,
+p95 and p99 latency, throughput and SQL queries per request for each route.
+
+Run from the repo root against a scratch database, for example:
+
+    python -m benchmarks.load sqlite:////tmp/spent_load.db
+    python -m benchmarks.load postgresql:///spent_load --users 2000 --clients 32
+
+The database is dropped and recreated unless --reuse is given.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+import argparse
+
+import os
+
+import random
+
+import threading
+
+import time
+
+
+# Scenario weights for each client's requests after it logs in
+ROUTE_WEIGHTS = [
+    ('dashboard', 4),
+    ('total_spent', 3),
+    ('expenditure_types', 3),
+    ('add_expenditure', 1),
+]
+
+# Mostly small purchases with the occasional large one
+MEAN_PRICE = 40.0
+
+
+def load_app(database_url):
+    """ Import the app connected to the benchmark database. server.py
+    connects when it is imported, so the URL has to be set first. """
+
+    os.environ['POSTGRES_DB_URL'] = database_url
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('SECURE_MODE_KEY', 'benchmark')
+
+    import server
+
+    server.app.config['SQLALCHEMY_ECHO'] = False
+    server.app.config['TESTING'] = True
+
+    return server.app
+
+
+def generate_data(user_count, expenditures_per_user, budget_share, days, seed=0):
+    """ Fill the tables with synthetic users. Each user gets a normally
+    distributed number of expenditures around expenditures_per_user over the
+    last `days` days, with exponentially distributed prices, and a budget in
+    each category with probability budget_share. """
+
+    from model import db, User, Category, Budget, Expenditure
+    from rollup import rebuild_rollup
+
+    random.seed(seed)
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(Category.__table__.insert(), [
+        {'id': category_id, 'category': name}
+        for category_id, name in enumerate(["Online Purchase", "Travel", "Food",
+                                            "Groceries", "Clothing", "Entertainment"], 1)])
+
+    db.session.execute(User.__table__.insert(), [
+        {'id': user_id, 'name': "user%s" % user_id,
+         'email': "user%s@example.com" % user_id, 'password': "password%s" % user_id}
+        for user_id in range(1, user_count + 1)])
+
+    now = datetime.now()
+    budgets = []
+    batch = []
+
+    for user_id in range(1, user_count + 1):
+        for category_id in range(1, 7):
+            if random.random() < budget_share:
+                budgets.append({
+                    'budget': random.randint(100, 2000),
+                    'category_id': category_id,
+                    'budget_userid': user_id,
+                    'budget_start_date': now - timedelta(days=days),
+                    'budget_end_date': now + timedelta(days=30)})
+
+        count = max(int(random.gauss(expenditures_per_user, expenditures_per_user / 4.0)), 0)
+
+        for _ in range(count):
+            batch.append({
+                'category_id': random.randint(1, 6),
+                'price': round(random.expovariate(1 / MEAN_PRICE) + 1, 2),
+                'date_of_expenditure': now - timedelta(days=random.randint(0, days)),
+                'expenditure_userid': user_id,
+                'where_bought': "store",
+                'description': u"synthetic"})
+
+        if len(batch) >= 10000:
+            db.session.execute(Expenditure.__table__.insert(), batch)
+            batch = []
+
+    if batch:
+        db.session.execute(Expenditure.__table__.insert(), batch)
+
+    if budgets:
+        db.session.execute(Budget.__table__.insert(), budgets)
+
+    db.session.commit()
+
+    # The dashboard and charts read the rollup, not the raw expenditures
+    rebuild_rollup()
+
+
+class QueryCounter(object):
+    """ Counts the SQL statements each thread sends to the database """
+
+    def __init__(self, engine):
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    def value(self):
+        return getattr(self.local, 'count', 0)
+
+
+class Results(object):
+    """ Latencies, query counts and errors per route, from every client """
+
+    def __init__(self):
+        self.latencies = {}
+        self.queries = {}
+        self.errors = {}
+        # (route, cause) -> how many requests failed that way
+        self.causes = {}
+        self.lock = threading.Lock()
+
+    def record(self, route, seconds, queries, error=None):
+        """ Record one request; error is what went wrong, or None """
+
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            self.queries.setdefault(route, []).append(queries)
+
+            if error is not None:
+                self.errors[route] = self.errors.get(route, 0) + 1
+                self.causes[route, error] = self.causes.get((route, error), 0) + 1
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a list of numbers """
+
+    ordered = sorted(values)
+    rank = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def choose_route(weights=ROUTE_WEIGHTS):
+    """ Pick a route according to the scenario weights """
+
+    pick = random.uniform(0, sum(weight for route, weight in weights))
+
+    for route, weight in weights:
+        pick -= weight
+
+        if pick <= 0:
+            return route
+
+    return weights[-1][0]
+
+
+def request_for(route, user_id):
+    """ Method, path and form data for a request to a route """
+
+    if route == 'login_form':
+        return 'POST', '/login-form', {'email': "user%s@example.com" % user_id,
+                                       'password': "password%s" % user_id}
+
+    if route == 'dashboard':
+        return 'GET', '/dashboard/%s' % user_id, None
+
+    if route == 'total_spent':
+        return 'GET', '/total-spent.json', None
+
+    if route == 'expenditure_types':
+        return 'GET', '/expenditure-types.json', None
+
+    return 'POST', '/add-expenditure-to-db', {
+        'category': str(random.randint(1, 6)),
+        'price': "%.2f" % (random.expovariate(1 / MEAN_PRICE) + 1),
+        'date': datetime.now().strftime('%Y-%m-%d'),
+        'wherebought': "store",
+        'description': "benchmark",
+        'tracking-num': "",
+        'tracking-num-carrier': ""}
+
+
+def run_client(app, counter, results, user_count, request_count, cold):
+    """ One client: log in as a random user, then make request_count
+    requests picked by the scenario weights """
+
+    from cache import user_cache
+
+    client = app.test_client()
+    user_id = random.randint(1, user_count)
+    routes = ['login_form'] + [choose_route() for _ in range(request_count)]
+
+    for route in routes:
+        method, path, data = request_for(route, user_id)
+
+        # Measure the uncached path, as after every write
+        if cold:
+            user_cache.invalidate(user_id)
+
+        counter.reset()
+        started = time.time()
+
+        # The app is in testing mode, so errors in views are raised here
+        try:
+            response = client.open(path, method=method, data=data)
+            error = "HTTP %s" % response.status_code if response.status_code >= 400 else None
+        except Exception as exception:
+            error = "%s: %s" % (type(exception).__name__, exception)
+
+        results.record(route, time.time() - started, counter.value(), error)
+
+
+def run_benchmark(app, user_count, clients, requests_per_client, cold=False):
+    """ Run every client on its own thread and collect the results """
+
+    from model import db
+
+    counter = QueryCounter(db.engine)
+    results = Results()
+
+    threads = [threading.Thread(target=run_client,
+                                args=(app, counter, results, user_count,
+                                      requests_per_client, cold))
+               for _ in range(clients)]
+
+    started = time.time()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return results, time.time() - started
+
+
+def report(results, elapsed):
+    """ Print one line of latency, throughput and query stats per route """
+
+    print "%-18s %7s %6s %9s %9s %9s %9s %8s" % (
+        "route", "count", "errors", "p50 (ms)", "p95 (ms)", "p99 (ms)", "req/s", "queries")
+
+    total = 0
+
+    for route in sorted(results.latencies):
+        latencies = results.latencies[route]
+        queries = results.queries[route]
+        total += len(latencies)
+
+        print "%-18s %7d %6d %9.1f %9.1f %9.1f %9.1f %8.1f" % (
+            route, len(latencies), results.errors.get(route, 0),
+            percentile(latencies, 0.50) * 1000,
+            percentile(latencies, 0.95) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            len(latencies) / elapsed,
+            float(sum(queries)) / len(queries))
+
+    print
+    print "%d requests in %.1fs, %.1f req/s" % (total, elapsed, total / elapsed)
+
+    if results.causes:
+        print
+        print "%-18s %7s  %s" % ("route", "errors", "cause")
+
+        for (route, cause), count in sorted(results.causes.items()):
+            print "%-18s %7d  %s" % (route, count, cause)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load benchmark for the Spent routes")
+    parser.add_argument('database_url', nargs='?', default='sqlite:////tmp/spent_load.db')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--expenditures', type=int, default=200,
+                        help="average expenditures per user")
+    parser.add_argument('--budget-share', type=float, default=0.5,
+                        help="chance a user has a budget in each category")
+    parser.add_argument('--days', type=int, default=90,
+                        help="spread expenditures over this many days")
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=50,
+                        help="requests per client after logging in")
+    parser.add_argument('--cold', action='store_true',
+                        help="invalidate the user's cache before every request")
+    parser.add_argument('--reuse', action='store_true',
+                        help="keep the existing data instead of generating it")
+    args = parser.parse_args()
+
+    app = load_app(args.database_url)
+
+    with app.app_context():
+        if not args.reuse:
+            print "Generating %s users with about %s expenditures each..." % (
+                args.users, args.expenditures)
+            generate_data(args.users, args.expenditures, args.budget_share, args.days)
+
+    print "Running %s clients x %s requests..." % (args.clients, args.requests)
+    print
+
+    results, elapsed = run_benchmark(app, args.users, args.clients, args.requests, args.cold)
+
+    report(results, elapsed)
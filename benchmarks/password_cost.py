@@ -0,0 +1,62 @@
+""" Calibrate PASSWORD_ITERATIONS to a target login latency
+
+Times PBKDF2 on this machine and prints the iteration count that makes one
+password hash take about the target number of milliseconds. Run it on the
+hardware the app is deployed to, for example:
+
+    python -m benchmarks.password_cost 250
+"""
+
+from passwords import hash_password, verify_password, PASSWORD_ITERATIONS
+
+import sys
+
+import time
+
+
+def time_hash(iterations, repeat=3):
+    """ Best of a few runs, in milliseconds, of hashing one password """
+
+    timings = []
+
+    for run in range(repeat):
+        started = time.time()
+        hash_password("correct horse battery staple", iterations)
+        timings.append((time.time() - started) * 1000)
+
+    return min(timings)
+
+
+def calibrate(target_ms, start=10000):
+    """ Double the iterations until a hash takes at least a tenth of the
+    target, then scale linearly to the target """
+
+    iterations = start
+    elapsed = time_hash(iterations)
+
+    while elapsed < target_ms / 10.0:
+        iterations *= 2
+        elapsed = time_hash(iterations)
+
+    # PBKDF2's cost is linear in its iteration count
+    calibrated = int(iterations * target_ms / elapsed)
+
+    # Round to a readable number
+    return max(1000, int(round(calibrated, -3)))
+
+
+if __name__ == "__main__":
+    target_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 250
+
+    print "Current PASSWORD_ITERATIONS=%d: %.1f ms per hash" % (
+        PASSWORD_ITERATIONS, time_hash(PASSWORD_ITERATIONS))
+
+    iterations = calibrate(target_ms)
+    stored = hash_password("correct horse battery staple", iterations)
+
+    started = time.time()
+    verify_password("correct horse battery staple", stored)
+    verify_ms = (time.time() - started) * 1000
+
+    print "PASSWORD_ITERATIONS=%d: %.1f ms per login (target %.0f ms)" % (
+        iterations, verify_ms, target_ms)
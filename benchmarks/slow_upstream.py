@@ -0,0 +1,291 @@
+""" Dashboard latency while the tracking upstream is slow
+
+Starts a stub Shippo that takes --delay seconds to answer, then runs the app
+under gunicorn (with gunicorn_config.py) once per worker class. Each run
+first measures dashboard latency on its own, then again while --slow-clients
+clients keep asking /tracking for packages the app has never seen, so every
+one of those requests waits on the stub. With sync workers the dashboard
+queues behind the tracking lookups; with gevent workers it shouldn't notice
+them.
+
+Run from the repo root against a scratch database, for example:
+
+    python -m benchmarks.slow_upstream sqlite:////tmp/spent_slow.db
+    python -m benchmarks.slow_upstream postgresql:///spent_slow --delay 5 --slow-clients 50
+
+The database is dropped and recreated.
+"""
+
+from benchmarks.load import load_app, generate_data, percentile
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from SocketServer import ThreadingMixIn
+
+import argparse
+
+import itertools
+
+import json
+
+import os
+
+import socket
+
+import subprocess
+
+import sys
+
+import threading
+
+import time
+
+import requests
+
+
+# Tracking numbers the app has never looked up, one per slow request
+TRACKING_NUMBERS = 20000
+
+
+class SlowShippoHandler(BaseHTTPRequestHandler):
+    """ Answers like Shippo does, after waiting `delay` seconds """
+
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+
+        body = json.dumps({
+            'tracking_status': {
+                'status': "TRANSIT",
+                'location': {'city': "Oakland", 'state': "CA", 'zip': "94612", 'country': "US"}
+            }
+        })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_slow_shippo(delay):
+    """ Run the stub Shippo on a free local port """
+
+    SlowShippoHandler.delay = delay
+
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), SlowShippoHandler)
+    thread = threading.Thread(target=stub.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return stub, "http://127.0.0.1:%s" % stub.server_port
+
+
+def add_tracked_expenditures(user_id, count):
+    """ Give a user expenditures with tracking numbers nothing has looked up """
+
+    from model import db, Expenditure
+
+    db.session.execute(Expenditure.__table__.insert(), [
+        {'category_id': 1, 'price': 10, 'expenditure_userid': user_id,
+         'where_bought': "store", 'description': u"tracked",
+         'tracking_num': "SLOW%06d" % number, 'tracking_num_carrier': "usps"}
+        for number in range(count)])
+
+    db.session.commit()
+
+
+def free_port():
+    """ A local port nothing is listening on """
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+
+    return port
+
+
+def start_gunicorn(database_url, shippo_url, worker_class, workers, delay):
+    """ Serve the app with gunicorn_config.py and wait until it answers """
+
+    port = free_port()
+
+    env = dict(os.environ,
+               POSTGRES_DB_URL=database_url,
+               SHIPPO_BASE_URL=shippo_url,
+               # Let the stub's delay finish instead of timing out
+               SHIPPO_READ_TIMEOUT=str(delay + 5),
+               GUNICORN_WORKER_CLASS=worker_class,
+               WEB_CONCURRENCY=str(workers),
+               GUNICORN_TIMEOUT=str(int(delay) + 30))
+
+    env.setdefault('SECRET_KEY', 'benchmark')
+    env.setdefault('SECURE_MODE_KEY', 'benchmark')
+
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn.app.wsgiapp",
+                                "-c", "gunicorn_config.py",
+                                "--bind", "127.0.0.1:%s" % port,
+                                "--log-level", "warning",
+                                "server:app"], env=env)
+
+    base_url = "http://127.0.0.1:%s" % port
+
+    for _ in range(300):
+        try:
+            requests.get(base_url + "/", timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError("gunicorn didn't start")
+
+
+def log_in(base_url, user_id):
+    """ A session logged in as a benchmark user """
+
+    session = requests.Session()
+    session.post(base_url + "/login-form", data={'email': "user%s@example.com" % user_id,
+                                                 'password': "password%s" % user_id})
+
+    return session
+
+
+def dashboard_client(base_url, session, user_id, stop, latencies, errors):
+    """ Load the dashboard until told to stop """
+
+    # At least one request, however long the dashboard is stuck in the queue
+    while True:
+        started = time.time()
+
+        try:
+            ok = session.get(base_url + "/dashboard/%s" % user_id, timeout=60).ok
+        except requests.RequestException:
+            ok = False
+
+        latencies.append(time.time() - started)
+
+        if not ok:
+            errors.append(1)
+
+        if stop.is_set():
+            break
+
+
+def tracking_client(base_url, tracking_numbers, stop, completed):
+    """ Look up packages nobody has tracked yet until told to stop """
+
+    session = requests.Session()
+
+    while not stop.is_set():
+        try:
+            session.post(base_url + "/tracking/%s" % next(tracking_numbers), timeout=120)
+            completed.append(1)
+        except requests.RequestException:
+            pass
+
+
+def measure(base_url, user_count, dashboard_clients, slow_clients, tracking_numbers, seconds):
+    """ Dashboard latencies over `seconds`, with slow tracking lookups going
+    on if slow_clients > 0; returns latencies, errors and lookups done """
+
+    stop = threading.Event()
+    latencies, errors, completed = [], [], []
+
+    threads = [threading.Thread(target=tracking_client,
+                                args=(base_url, tracking_numbers, stop, completed))
+               for _ in range(slow_clients)]
+
+    # Logged in before the slow lookups start, so only the dashboard is timed
+    for client in range(dashboard_clients):
+        user_id = 1 + client % user_count
+        threads.append(threading.Thread(target=dashboard_client,
+                                        args=(base_url, log_in(base_url, user_id), user_id,
+                                              stop, latencies, errors)))
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    time.sleep(seconds)
+    stop.set()
+
+    for thread in threads:
+        thread.join()
+
+    return latencies, errors, completed
+
+
+def report(worker_class, phase, latencies, errors, completed):
+    """ Print one line of dashboard latency stats """
+
+    print "%-8s %-8s %7d %6d %9.1f %9.1f %9.1f %9d" % (
+        worker_class, phase, len(latencies), len(errors),
+        percentile(latencies, 0.50) * 1000,
+        percentile(latencies, 0.95) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        len(completed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dashboard latency with a slow tracking upstream")
+    parser.add_argument('database_url', nargs='?', default='sqlite:////tmp/spent_slow.db')
+    parser.add_argument('--worker-classes', default='sync,gevent',
+                        help="comma-separated gunicorn worker classes to compare")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="more than one needs SPENT_CACHE_URL set to a redis:// URL")
+    parser.add_argument('--delay', type=float, default=3.0,
+                        help="seconds the stub Shippo takes to answer")
+    parser.add_argument('--slow-clients', type=int, default=16)
+    parser.add_argument('--dashboard-clients', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=15,
+                        help="length of each measurement")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--expenditures', type=int, default=200,
+                        help="average expenditures per user")
+    args = parser.parse_args()
+
+    app = load_app(args.database_url)
+
+    with app.app_context():
+        print "Generating %s users..." % args.users
+        generate_data(args.users, args.expenditures, 0.5, 90)
+        add_tracked_expenditures(args.users, TRACKING_NUMBERS)
+
+    stub, shippo_url = start_slow_shippo(args.delay)
+
+    # Shared by every client and run, so no package is looked up twice
+    # (imap, unlike a generator, is safe to advance from many threads)
+    tracking_numbers = itertools.imap("SLOW%06d".__mod__, itertools.count())
+
+    print "Stub Shippo answers after %.1fs; %s slow clients, %s dashboard clients" % (
+        args.delay, args.slow_clients, args.dashboard_clients)
+    print
+    print "%-8s %-8s %7s %6s %9s %9s %9s %9s" % (
+        "workers", "upstream", "count", "errors", "p50 (ms)", "p95 (ms)", "p99 (ms)", "lookups")
+
+    for worker_class in args.worker_classes.split(','):
+        process, base_url = start_gunicorn(args.database_url, shippo_url, worker_class,
+                                           args.workers, args.delay)
+
+        try:
+            report(worker_class, "idle",
+                   *measure(base_url, args.users, args.dashboard_clients, 0,
+                            tracking_numbers, args.seconds))
+            report(worker_class, "slow",
+                   *measure(base_url, args.users, args.dashboard_clients, args.slow_clients,
+                            tracking_numbers, args.seconds))
+        finally:
+            process.terminate()
+            process.wait()
+
+    stub.shutdown()
@@ -0,0 +1,134 @@
+""" Nightly job that records where every user's budgets stand
+
+Every budget's spending, remaining amount and progress is computed in one
+query over all users: budgets are joined to the daily spending rollup rows
+inside their date windows and added up, and a window function counts each
+user's budgets that are over. The rows are read through a server-side
+cursor (on PostgreSQL) and written to budget_statuses in batches of
+STATUS_BATCH_SIZE, in one transaction, so readers see the previous run's
+statuses until the new ones are complete. Memory stays flat however many
+users there are, and on PostgreSQL the query is cancelled after
+BUDGET_STATUS_TIMEOUT seconds.
+
+Run `python budget_status.py` from a scheduler once a night.
+"""
+
+from sqlalchemy import func
+from sqlalchemy.sql import and_, case
+
+from model import db, connect_to_db, Budget, BudgetStatus, DailySpending
+
+from export import export_batches
+
+from datetime import datetime
+
+import os
+
+
+# Rows inserted per statement
+STATUS_BATCH_SIZE = int(os.getenv('STATUS_BATCH_SIZE', 5000))
+
+# Longest the statuses query may run on PostgreSQL, 0 for no limit
+BUDGET_STATUS_TIMEOUT = int(os.getenv('BUDGET_STATUS_TIMEOUT', 1800))
+
+
+def status_query():
+    """ Select the status of every budget of every user """
+
+    budgets = Budget.__table__
+    spending = DailySpending.__table__
+
+    # Spending per budget, from the rollup rows inside its window
+    totals = db.select([
+        budgets.c.budget_userid,
+        budgets.c.category_id,
+        func.coalesce(budgets.c.budget, 0).label('budget'),
+        budgets.c.budget_start_date,
+        budgets.c.budget_end_date,
+        func.coalesce(func.sum(spending.c.total), 0).label('total'),
+        func.coalesce(func.sum(spending.c.count), 0).label('count')]).select_from(
+        budgets.outerjoin(spending, and_(
+            spending.c.spending_userid == budgets.c.budget_userid,
+            spending.c.category_id == budgets.c.category_id,
+            spending.c.day.between(func.date(budgets.c.budget_start_date),
+                                   func.date(budgets.c.budget_end_date))))).where(
+        budgets.c.budget_userid.isnot(None)).group_by(
+        budgets.c.budget_userid,
+        budgets.c.category_id,
+        budgets.c.budget,
+        budgets.c.budget_start_date,
+        budgets.c.budget_end_date).alias('totals')
+
+    remaining = totals.c.budget - totals.c.total
+    over_budget = totals.c.total > totals.c.budget
+
+    return db.select([
+        totals.c.budget_userid,
+        totals.c.category_id,
+        totals.c.budget,
+        totals.c.budget_start_date,
+        totals.c.budget_end_date,
+        totals.c.total,
+        totals.c.count,
+        remaining.label('remaining'),
+        # Same percentage as get_progress, with no budget counting as 0
+        db.cast(case([(totals.c.budget == 0, 0)],
+                     else_=remaining * 100 / totals.c.budget), db.Float).label('progress'),
+        over_budget.label('over_budget'),
+        func.sum(case([(over_budget, 1)], else_=0)).over(
+            partition_by=totals.c.budget_userid).label('categories_over_budget')])
+
+
+def refresh_budget_statuses(batch_size=STATUS_BATCH_SIZE):
+    """ Replace budget_statuses with every budget's current status; returns
+    how many were saved """
+
+    table = BudgetStatus.__table__
+    computed_at = datetime.now()
+    saved = 0
+
+    if db.engine.dialect.name == "postgresql" and BUDGET_STATUS_TIMEOUT:
+        db.session.execute("SET LOCAL statement_timeout = %d" % (BUDGET_STATUS_TIMEOUT * 1000))
+
+    # Deleted in the same transaction, so nobody sees an empty table
+    db.session.execute(table.delete())
+
+    for rows in export_batches(status_query(), batch_size):
+        statuses = []
+
+        for row in rows:
+            status = dict(row.items())
+            status['computed_at'] = computed_at
+            statuses.append(status)
+
+        db.session.execute(table.insert(), statuses)
+        saved += len(statuses)
+
+    db.session.commit()
+
+    return saved
+
+
+def users_over_budget(min_categories=1):
+    """ Ids of the users over budget in at least min_categories categories
+    at the last refresh """
+
+    return [user_id for user_id, in db.session.query(
+        BudgetStatus.budget_userid).filter(
+        BudgetStatus.categories_over_budget >= min_categories).distinct().order_by(
+        BudgetStatus.budget_userid)]
+
+
+if __name__ == "__main__":
+    from flask import Flask
+
+    app = Flask(__name__)
+
+    spent_database = os.getenv('POSTGRES_DB_URL', 'postgres:///spending')
+    connect_to_db(app, spent_database)
+
+    with app.app_context():
+        saved = refresh_budget_statuses()
+        over = users_over_budget()
+
+    print "Saved %s budget statuses; %s users are over budget" % (saved, len(over))
@@ -0,0 +1,266 @@
+""" Per-user cache for dashboard and chart aggregates
+
+Every cached value is stored under its user's current data version. Writes
+call invalidate(user_id), which gives the user a new version, so their old
+entries are never read again and age out of the backend on their own. Other
+users' entries are untouched.
+
+The in-memory LRU backend only sees this process's invalidations, so with
+it one worker would keep serving data (and 304s) another worker has
+invalidated. More than one worker needs SPENT_CACHE_URL pointed at a shared
+store (redis://...); check_workers() refuses to start them otherwise.
+"""
+
+from collections import OrderedDict
+
+import cPickle as pickle
+
+import functools
+
+import hashlib
+
+import itertools
+
+import os
+
+import threading
+
+import time
+
+
+class LRUCache(object):
+    """ In-process backend that keeps the most recently used entries """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Get a value, or None if it isn't cached """
+
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            # Move it to the most recently used end
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        """ Store a value, evicting the least recently used if full """
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """ Remove a value if it is cached """
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """ Remove every value """
+
+        with self._lock:
+            self._entries.clear()
+
+
+class LocalStore(object):
+    """ Dict-backed stand-in for a redis/memcached client, for tests and
+    local development """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def flushdb(self):
+        self.data.clear()
+
+
+class ExternalCache(object):
+    """ Backend for an external store shared by every worker. The client
+    needs get/set/delete on byte strings, like redis or memcached clients
+    have. """
+
+    def __init__(self, client, prefix="spent:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+
+        if value is None:
+            return None
+
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        """ Remove every value under this cache's prefix """
+
+        # Only touch our own keys on a shared redis
+        if hasattr(self.client, 'scan_iter'):
+            for key in self.client.scan_iter(self.prefix + "*"):
+                self.client.delete(key)
+        else:
+            self.client.flushdb()
+
+
+# Keeps versions made within the same microsecond apart
+version_counter = itertools.count()
+
+
+def new_version():
+    """ A version token that never repeats, even after the old one has been
+    evicted """
+
+    return "%x.%x.%x" % (int(time.time() * 1000000), os.getpid(), next(version_counter))
+
+
+class UserDataCache(object):
+    """ Caches computed values per user and counts hits and misses """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = {}
+        self.misses = {}
+
+    def version(self, user_id):
+        """ Get the user's current data version """
+
+        version_key = "version:%s" % user_id
+        version = self.backend.get(version_key)
+
+        # A missing version means the user's entries can't be trusted, so
+        # start a fresh one
+        if version is None:
+            version = new_version()
+            self.backend.set(version_key, version)
+
+        return version
+
+    def invalidate(self, user_id):
+        """ Move the user to a new data version after their data changes """
+
+        self.backend.set("version:%s" % user_id, new_version())
+
+    def get_or_compute(self, user_id, name, args, compute):
+        """ Get the cached value for this user, name and arguments, computing
+        and storing it on a miss """
+
+        args_hash = hashlib.md5(repr(args)).hexdigest()
+        key = "%s:%s:%s:%s" % (user_id, self.version(user_id), name, args_hash)
+
+        value = self.backend.get(key)
+
+        if value is not None:
+            self.hits[name] = self.hits.get(name, 0) + 1
+            return value
+
+        self.misses[name] = self.misses.get(name, 0) + 1
+
+        value = compute()
+        self.backend.set(key, value)
+
+        return value
+
+    def cached(self, name, user_arg=0):
+        """ Decorate a function whose argument at position user_arg is the
+        user id so its results are cached per user """
+
+        def decorator(function):
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                user_id = args[user_arg]
+
+                # Nothing to key on without a user
+                if user_id is None:
+                    return function(*args, **kwargs)
+
+                return self.get_or_compute(user_id, name, (args, sorted(kwargs.items())),
+                                           lambda: function(*args, **kwargs))
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        """ Hits, misses and hit ratio for each cached function """
+
+        stats = {}
+
+        for name in set(self.hits) | set(self.misses):
+            hits = self.hits.get(name, 0)
+            misses = self.misses.get(name, 0)
+            stats[name] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': float(hits) / (hits + misses)
+            }
+
+        return stats
+
+    def clear(self):
+        """ Drop every cached value and reset the counters """
+
+        self.backend.clear()
+        self.hits = {}
+        self.misses = {}
+
+
+def is_shared(cache_url=None):
+    """ Whether every worker sees the same store under cache_url """
+
+    cache_url = cache_url or os.getenv('SPENT_CACHE_URL', 'memory://')
+
+    return cache_url.startswith('redis://')
+
+
+def check_workers(workers, cache_url=None):
+    """ Raise RuntimeError for more than one worker on a per-process cache """
+
+    if workers > 1 and not is_shared(cache_url):
+        raise RuntimeError("%s workers need a shared cache; set SPENT_CACHE_URL to a "
+                           "redis:// URL or run one worker" % workers)
+
+
+def create_backend(cache_url=None, max_size=None):
+    """ Pick the backend from SPENT_CACHE_URL: memory:// (the default),
+    local:// for the LocalStore stand-in, or redis://host:port/db """
+
+    cache_url = cache_url or os.getenv('SPENT_CACHE_URL', 'memory://')
+    max_size = max_size or int(os.getenv('SPENT_CACHE_SIZE', 10000))
+
+    if cache_url.startswith('redis://'):
+        # redis is only needed when it is configured
+        import redis
+        return ExternalCache(redis.StrictRedis.from_url(cache_url))
+
+    if cache_url.startswith('local://'):
+        return ExternalCache(LocalStore())
+
+    return LRUCache(max_size)
+
+
+user_cache = UserDataCache(create_backend())
@@ -0,0 +1,97 @@
+""" In-process registry of the spending categories in the categories table """
+
+from collections import namedtuple
+
+from sqlalchemy import event
+
+from model import db, Category
+
+import hashlib
+
+import os
+
+import threading
+
+import time
+
+
+# Chart colors, picked by category id so the original six keep their colors
+CHART_COLORS = ["#F68D5C", "#F4D27A", "#F37257", "#7895A2", "#AFC1CC", "#517281"]
+
+# Other processes can't see this process's invalidations, so the registry
+# also reloads itself after this many seconds
+CATEGORY_CACHE_SECONDS = int(os.getenv('CATEGORY_CACHE_SECONDS', 60))
+
+CategoryInfo = namedtuple('CategoryInfo', ['id', 'name', 'color'])
+
+
+class CategoryRegistry(object):
+    """ Caches the categories table, sorted by name, as plain tuples """
+
+    def __init__(self, ttl=CATEGORY_CACHE_SECONDS):
+        self.ttl = ttl
+        self._categories = None
+        self._version = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Read every category from the database """
+
+        rows = db.session.query(Category.id, Category.category).order_by(
+            Category.category, Category.id).all()
+
+        return [CategoryInfo(id, name, CHART_COLORS[(id - 1) % len(CHART_COLORS)])
+                for id, name in rows]
+
+    def all(self):
+        """ Get every category, reloading the cache if it is stale """
+
+        with self._lock:
+            if self._categories is None or time.time() - self._loaded_at > self.ttl:
+                self._categories = self.load()
+                self._version = hashlib.md5(repr(self._categories)).hexdigest()
+                self._loaded_at = time.time()
+
+            return self._categories
+
+    def version(self):
+        """ A token that changes whenever the categories do. It comes from
+        their contents, so every process agrees on it. """
+
+        self.all()
+
+        return self._version
+
+    def ids(self):
+        """ Get every category id """
+
+        return [category.id for category in self.all()]
+
+    def get(self, category_id):
+        """ Get one category by id, or None if it doesn't exist """
+
+        for category in self.all():
+            if category.id == category_id:
+                return category
+
+        return None
+
+    def invalidate(self):
+        """ Forget the cached categories so the next lookup reloads them """
+
+        with self._lock:
+            self._categories = None
+
+
+registry = CategoryRegistry()
+
+
+# Reload as soon as this process changes a category
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def invalidate_registry(mapper, connection, target):
+    """ Drop the cached categories whenever one is written """
+
+    registry.invalidate()
@@ -0,0 +1,209 @@
+""" Data for the dashboard's bar and donut charts """
+
+from sqlalchemy import func, cast, DateTime
+
+from model import db, DailySpending
+
+from cache import user_cache
+
+from categories import registry
+
+from tools import get_category_totals, parse_date
+
+from datetime import datetime, timedelta
+
+import os
+
+
+# Category ids in the order the original fixed charts listed them; newer
+# categories follow in id order
+BAR_CHART_ORDER = [3, 4, 5, 6, 2, 1]
+DONUT_CHART_ORDER = [2, 6, 4, 5, 3, 1]
+
+# Bucket sizes for the spending series, smallest first
+SERIES_BUCKETS = ['day', 'week', 'month', 'year']
+
+# Longest series one request can ask for; longer ranges need bigger buckets
+MAX_SERIES_BUCKETS = int(os.getenv('MAX_SERIES_BUCKETS', 750))
+
+
+def in_chart_order(categories, order):
+    """ Categories sorted by their place in a chart's order """
+
+    return sorted(categories, key=lambda category: (
+        order.index(category.id) if category.id in order else len(order), category.id))
+
+
+def bar_chart_data(categories, category_totals):
+    """ Bar chart payload: totals and averages per category """
+
+    return {
+        "labels": [category.name for category in categories],
+        "datasets": [
+            {
+                "label": "Total Spent",
+                "fillColor": "#F37257",
+                "strokeColor": "#F37257",
+                "pointColor": "#F37257",
+                "pointStrokeColor": "#fff",
+                "pointHighlightFill": "#fff",
+                "pointHighlightStroke": "#F37257",
+                "data": [category_totals.get(category.id, (0.0, 0.0))[0] for category in categories]
+            },
+            {
+                "label": "Average",
+                "fillColor": "#AFC1CC",
+                "strokeColor": "#AFC1CC",
+                "pointColor": "#AFC1CC",
+                "pointStrokeColor": "#fff",
+                "pointHighlightFill": "#fff",
+                "pointHighlightStroke": "#AFC1CC",
+                "data": [category_totals.get(category.id, (0.0, 0.0))[1] for category in categories]
+            }
+        ]
+    }
+
+
+def donut_chart_data(categories, category_totals):
+    """ Donut chart payload: totals per category """
+
+    return {
+        'expenditures': [
+            {
+                "value": category_totals.get(category.id, (0.0, 0.0))[0],
+                "color": category.color,
+                "highlight": "#963019",
+                "label": category.name
+            }
+            for category in categories
+        ]
+    }
+
+
+def get_chart_stats(id):
+    """ Chart payloads for the last 30 days """
+
+    # This is today's date
+    today = datetime.today().strftime('%Y-%m-%d')
+
+    # This is the date 30 days in the past from today
+    thirty_days_past = (datetime.today() + timedelta(-30)).strftime('%Y-%m-%d')
+
+    # The window is part of the cache key, so cached charts move on with
+    # the date instead of staying where the user's last write left them
+    return get_window_chart_stats(id, thirty_days_past, today)
+
+
+@user_cache.cached('get_chart_stats')
+def get_window_chart_stats(id, start, end):
+    """ Compute a window's totals and averages once and build both chart
+    payloads from them """
+
+    # Every category the app knows about, in each chart's own order; the
+    # dashboard tables list them by name
+    categories = registry.all()
+
+    # Totals and averages for every category come from one grouped query
+    category_totals = get_category_totals(id, start, end)
+
+    return {
+        'bar': bar_chart_data(in_chart_order(categories, BAR_CHART_ORDER), category_totals),
+        'donut': donut_chart_data(in_chart_order(categories, DONUT_CHART_ORDER), category_totals)
+    }
+
+
+def bucket_count(start, end, bucket):
+    """ How many buckets of a size a date range spans, at most """
+
+    days = (end - start).days + 1
+
+    if bucket == 'day':
+        return days
+
+    if bucket == 'week':
+        return days // 7 + 2
+
+    months = (end.year - start.year) * 12 + end.month - start.month + 1
+
+    if bucket == 'month':
+        return months
+
+    return end.year - start.year + 1
+
+
+def choose_bucket(start, end):
+    """ The smallest bucket that keeps the series under the cap """
+
+    for bucket in SERIES_BUCKETS:
+        if bucket_count(start, end, bucket) <= MAX_SERIES_BUCKETS:
+            return bucket
+
+    return SERIES_BUCKETS[-1]
+
+
+def bucket_start(day, bucket, dialect_name):
+    """ SQL for the first day of the bucket a rollup day falls in """
+
+    if dialect_name == "postgresql":
+        return func.date(func.date_trunc(bucket, cast(day, DateTime)))
+
+    # SQLite's date modifiers; weeks start on Monday, like date_trunc's
+    if bucket == 'week':
+        return func.date(day, 'weekday 0', '-6 days')
+
+    if bucket == 'month':
+        return func.date(day, 'start of month')
+
+    if bucket == 'year':
+        return func.date(day, 'start of year')
+
+    return func.date(day)
+
+
+@user_cache.cached('get_spending_series')
+def get_spending_series(id, start, end, bucket=None, category_id=None):
+    """ Sum the user's spending into day, week, month or year buckets in the
+    database. Raises ValueError for a bad range or one with too many
+    buckets; buckets with no spending are left out. """
+
+    start = parse_date(start)
+    end = parse_date(end)
+
+    if start is None or end is None or end < start:
+        raise ValueError("A series needs a start date on or before its end date")
+
+    if bucket is None:
+        bucket = choose_bucket(start, end)
+
+    if bucket not in SERIES_BUCKETS:
+        raise ValueError("Unknown bucket %r" % bucket)
+
+    if bucket_count(start, end, bucket) > MAX_SERIES_BUCKETS:
+        raise ValueError("Too many %s buckets; use a bigger bucket or a shorter range" % bucket)
+
+    period = bucket_start(DailySpending.day, bucket, db.engine.dialect.name).label('period')
+
+    query = db.session.query(
+        period,
+        func.sum(DailySpending.total),
+        func.sum(DailySpending.count)).filter(
+        DailySpending.spending_userid == id,
+        DailySpending.day.between(start.date(), end.date()))
+
+    if category_id is not None:
+        query = query.filter(DailySpending.category_id == category_id)
+
+    rows = query.group_by(period).order_by(period).all()
+
+    # PostgreSQL hands back dates, SQLite hands back strings
+    return {
+        'bucket': bucket,
+        'start': start.strftime('%Y-%m-%d'),
+        'end': end.strftime('%Y-%m-%d'),
+        'category_id': category_id,
+        'series': [{
+            'period': period if isinstance(period, basestring) else period.strftime('%Y-%m-%d'),
+            'total': float(total),
+            'count': int(count)
+        } for period, total, count in rows]
+    }
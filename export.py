@@ -0,0 +1,163 @@
+""" Streaming export of a user's expenditures as CSV or NDJSON
+
+Rows are read through a server-side cursor (on PostgreSQL) in batches of
+EXPORT_FETCH_SIZE and written out as they arrive, so an export uses the same
+memory whether the user has ten expenditures or ten million. Rows come in id
+order; an interrupted download resumes with after=<last id received>.
+"""
+
+from model import db, Expenditure, Category
+
+from tools import parse_date
+
+from datetime import timedelta
+
+import csv
+
+import json
+
+import os
+
+import zlib
+
+from cStringIO import StringIO
+
+
+# Rows fetched from the cursor at a time
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', 1000))
+
+EXPORT_COLUMNS = ['expenditure_id', 'date_of_expenditure', 'category_id', 'category', 'price',
+                  'where_bought', 'description', 'tracking_num', 'tracking_num_carrier']
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'
+}
+
+
+def export_query(user_id, start=None, end=None, category_id=None, after_id=None):
+    """ Select the user's expenditures, filtered by date range, category and
+    id cursor, in id order """
+
+    expenditures = Expenditure.__table__
+    categories = Category.__table__
+
+    query = db.select([
+        expenditures.c.id,
+        expenditures.c.date_of_expenditure,
+        expenditures.c.category_id,
+        categories.c.category,
+        expenditures.c.price,
+        expenditures.c.where_bought,
+        expenditures.c.description,
+        expenditures.c.tracking_num,
+        expenditures.c.tracking_num_carrier]).select_from(
+        expenditures.outerjoin(categories, categories.c.id == expenditures.c.category_id)).where(
+        expenditures.c.expenditure_userid == user_id)
+
+    # Date filters cover whole days, like the dashboard windows
+    if start is not None:
+        query = query.where(expenditures.c.date_of_expenditure >= parse_date(start))
+
+    if end is not None:
+        query = query.where(expenditures.c.date_of_expenditure <
+                            parse_date(end) + timedelta(days=1))
+
+    if category_id is not None:
+        query = query.where(expenditures.c.category_id == category_id)
+
+    if after_id is not None:
+        query = query.where(expenditures.c.id > after_id)
+
+    return query.order_by(expenditures.c.id)
+
+
+def export_batches(query, fetch_size=EXPORT_FETCH_SIZE):
+    """ Yield lists of rows from a server-side cursor """
+
+    result = db.session.execute(query.execution_options(stream_results=True))
+
+    try:
+        while True:
+            rows = result.fetchmany(fetch_size)
+
+            if not rows:
+                break
+
+            yield rows
+    finally:
+        result.close()
+
+
+def row_values(row):
+    """ The export fields of a row, in EXPORT_COLUMNS order """
+
+    date_of_expenditure = row[1]
+
+    return [row[0],
+            date_of_expenditure.strftime('%Y-%m-%d') if date_of_expenditure else None,
+            row[2],
+            row[3],
+            str(row[4]) if row[4] is not None else None,
+            row[5],
+            row[6],
+            row[7],
+            row[8]]
+
+
+def csv_chunks(batches):
+    """ Encode batches of rows as CSV, a header then one chunk per batch """
+
+    def encode(values):
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+
+        for value in values:
+            writer.writerow([unicode(field).encode('utf-8') if field is not None else ""
+                             for field in value])
+
+        return buffer.getvalue()
+
+    yield encode([EXPORT_COLUMNS])
+
+    for rows in batches:
+        yield encode(row_values(row) for row in rows)
+
+
+def ndjson_chunks(batches):
+    """ Encode batches of rows as one JSON object per line """
+
+    for rows in batches:
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row_values(row)))) + "\n"
+                      for row in rows)
+
+
+def gzip_chunks(chunks):
+    """ Gzip a stream of chunks as it goes """
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def export_expenditures(user_id, export_format='csv', start=None, end=None,
+                        category_id=None, after_id=None, compress=False):
+    """ Generate the export of a user's expenditures chunk by chunk """
+
+    batches = export_batches(export_query(user_id, start, end, category_id, after_id))
+
+    if export_format == 'ndjson':
+        chunks = ndjson_chunks(batches)
+    else:
+        chunks = csv_chunks(batches)
+
+    if compress:
+        chunks = gzip_chunks(chunks)
+
+    return chunks
@@ -0,0 +1,77 @@
+""" Cached template fragments and compiled templates
+
+The {% cache %} tag stores the HTML it renders in the per-user cache:
+
+    {% cache "ledger", id %} ... {% endcache %}
+
+The fragment is keyed by its name, the user id, the user's data version,
+today's date (for the default budget windows) and the category registry's
+version (fragments show category names), plus any further arguments given
+to the tag. A write invalidates the user's version, so the next render
+rebuilds their fragments; until then a render is a cache lookup.
+
+Compiled templates are kept on disk in TEMPLATE_CACHE_DIR (a per-user temp
+directory by default), so a restarted worker loads bytecode instead of
+parsing every template again.
+"""
+
+from jinja2 import nodes, Markup, FileSystemBytecodeCache
+
+from jinja2.ext import Extension
+
+from cache import user_cache
+
+from categories import registry
+
+from datetime import date
+
+import os
+
+
+class FragmentCacheExtension(Extension):
+    """ Adds {% cache name, user_id, *parts %} ... {% endcache %} """
+
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        # The fragment name, the user id, then any further key parts
+        args = [parser.parse_expression()]
+
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+
+        if len(args) < 2:
+            parser.fail("cache needs a fragment name and a user id", lineno)
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(self.call_method('_cache_fragment', [nodes.List(args)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _cache_fragment(self, args, caller):
+        """ Render the fragment, or get it from the user's cache """
+
+        name, user_id = args[0], args[1]
+
+        # Nothing to key on without a user
+        if user_id is None:
+            return caller()
+
+        return Markup(user_cache.get_or_compute(user_id, "fragment:%s" % name,
+                                                (date.today(), registry.version(), args[2:]),
+                                                lambda: unicode(caller())))
+
+
+def init_app(app):
+    """ Enable the {% cache %} tag and the on-disk bytecode cache """
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+    cache_dir = os.getenv('TEMPLATE_CACHE_DIR')
+
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
@@ -0,0 +1,62 @@
+""" Gunicorn settings for the web process
+
+    gunicorn -c gunicorn_config.py server:app
+
+Workers are gevent workers by default: every request runs in a greenlet,
+and a request waiting on Shippo or on PostgreSQL yields to the others
+instead of holding a worker, so slow tracking lookups can't starve the
+dashboard. psycogreen makes psycopg2 wait for the database cooperatively.
+
+There is one worker per core when SPENT_CACHE_URL points at redis, and a
+single worker otherwise, since the in-memory cache isn't shared between
+processes. Set GUNICORN_WORKER_CLASS=sync to go back to one request per
+worker, or eventlet to use eventlet instead of gevent.
+"""
+
+from cache import is_shared, check_workers
+
+import multiprocessing
+
+import os
+
+
+bind = "0.0.0.0:%s" % os.getenv('PORT', '5000')
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+
+# Greenlets make the concurrency, so one worker per core is enough. Workers
+# only see each other's cache invalidations through redis, so without it
+# there is one worker.
+if is_shared():
+    workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+else:
+    workers = int(os.getenv('WEB_CONCURRENCY', 1))
+
+# Requests each gevent or eventlet worker runs at once
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 200))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+
+
+def on_starting(server):
+    """ Refuse to start several workers on a per-process cache, where their
+    invalidations wouldn't reach each other """
+
+    check_workers(server.cfg.workers)
+
+
+def post_fork(server, worker):
+    """ Let psycopg2 yield to other greenlets while it waits for PostgreSQL.
+    The worker monkey-patches the standard library itself. """
+
+    # SQLite (for benchmarks and local runs) has nothing to patch
+    if not os.getenv('POSTGRES_DB_URL', '').startswith('postgres'):
+        return
+
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+    elif worker_class == 'eventlet':
+        from psycogreen.eventlet import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,145 @@
+""" Conditional GET (ETag/304) and response compression """
+
+from datetime import date
+
+from flask import request, session, make_response
+
+from cache import user_cache
+
+from categories import registry
+
+import functools
+
+import gzip
+
+import hashlib
+
+import os
+
+from cStringIO import StringIO
+
+try:
+    # brotli is optional; without it responses are only gzipped
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Responses smaller than this many bytes aren't worth compressing
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 500))
+
+COMPRESSIBLE_MIMETYPES = set(['text/html', 'text/css', 'text/plain', 'application/json',
+                              'application/javascript', 'text/javascript'])
+
+
+def versioned_etag(user_id):
+    """ ETag for the current request made from the user's data version, so it
+    can be checked before doing any of the work """
+
+    parts = [
+        request.full_path,
+        str(user_id),
+        user_cache.version(user_id),
+        # The 30 day windows and default budget dates move with the date
+        date.today().isoformat(),
+        # Every user's dashboard lists every category
+        repr(registry.all())
+    ]
+
+    return hashlib.md5("|".join(parts)).hexdigest()
+
+
+def conditional(view):
+    """ Answer GET requests with 304 Not Modified while the user's data
+    version hasn't changed, without running the view """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = kwargs.get('id', session.get('id'))
+
+        # Pending flash messages are part of the page, so always render them
+        if user_id is None or request.method != 'GET' or session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        etag = versioned_etag(user_id)
+
+        if request.if_none_match.contains_weak(etag):
+            response = make_response("", 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+
+        # Weak, because the same data is sent gzipped or brotli compressed
+        response.set_etag(etag, weak=True)
+
+        # The page differs per user, so shared caches must not keep it
+        response.headers['Cache-Control'] = 'private, no-cache'
+
+        return response
+
+    return wrapper
+
+
+def add_etag(response):
+    """ Give successful JSON GET responses without a versioned ETag one made
+    from the body, and turn them into 304s when the client has it """
+
+    if (request.method == 'GET' and response.status_code == 200 and
+            response.mimetype == 'application/json' and
+            not response.direct_passthrough and not response.is_streamed and
+            'ETag' not in response.headers):
+
+        response.set_etag(hashlib.md5(response.get_data()).hexdigest(), weak=True)
+
+        if request.if_none_match.contains_weak(response.get_etag()[0]):
+            response.status_code = 304
+            response.set_data("")
+
+    return response
+
+
+def gzip_compress(data):
+    """ Gzip a byte string """
+
+    buffer = StringIO()
+
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6) as gzip_file:
+        gzip_file.write(data)
+
+    return buffer.getvalue()
+
+
+def compress(response):
+    """ Compress large text responses with brotli or gzip, whichever the
+    client accepts """
+
+    if (response.status_code != 200 or response.direct_passthrough or
+            response.is_streamed or 'Content-Encoding' in response.headers or
+            response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    data = response.get_data()
+
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    accept_encoding = request.accept_encodings
+
+    if brotli is not None and accept_encoding['br']:
+        response.set_data(brotli.compress(data))
+        response.headers['Content-Encoding'] = 'br'
+
+    elif accept_encoding['gzip']:
+        response.set_data(gzip_compress(data))
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+def init_app(app):
+    """ Add ETags and then compression to every response """
+
+    @app.after_request
+    def etag_and_compress(response):
+        return compress(add_etag(response))
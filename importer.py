@@ -0,0 +1,432 @@
+""" Bulk import of bank and card statements (CSV or OFX) into expenditures
+
+Statements are parsed a row at a time, with credits skipped, and inserted
+in batches of IMPORT_BATCH_SIZE, one transaction per batch, so memory stays
+flat however long the statement is. Every row gets a content hash, so importing the same
+statement twice skips the rows that are already there. The daily spending
+rollup and the user's cache are refreshed once the batches are done, even
+if one of them failed after others were committed.
+
+    python importer.py <user id> <statement.csv|statement.ofx> [category id]
+"""
+
+from model import db, connect_to_db, Expenditure, ImportJob
+
+from rollup import rebuild_rollup
+
+from categories import registry
+
+from tools import parse_date
+
+from datetime import datetime
+
+from decimal import Decimal, InvalidOperation
+
+from itertools import islice
+
+import csv
+
+import hashlib
+
+import os
+
+import re
+
+import sys
+
+import threading
+
+import uuid
+
+
+# Rows per INSERT, and so per commit
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+
+# Rows per multi-row INSERT ... VALUES statement; older SQLite allows 999
+# parameters in one statement, and a row has up to 9
+INSERT_CHUNK_SIZE = int(os.getenv('INSERT_CHUNK_SIZE', 100))
+
+# Sign of the charges in a CSV amount column: -1 when money going out is
+# negative (like OFX), 1 when it is positive. Rows of the other sign are
+# credits and are skipped. A debit column only holds charges.
+CSV_CHARGE_SIGN = int(os.getenv('CSV_CHARGE_SIGN', -1))
+
+# Header names banks use for each field, checked in order
+DATE_COLUMNS = ['date', 'transaction date', 'posted date', 'posting date', 'date_of_expenditure']
+AMOUNT_COLUMNS = ['amount', 'price', 'debit']
+WHERE_COLUMNS = ['where_bought', 'merchant', 'payee', 'name', 'description']
+DESCRIPTION_COLUMNS = ['description', 'memo', 'details']
+CATEGORY_COLUMNS = ['category']
+
+# Matches both <TAG>value and <TAG>value</TAG> styles of OFX
+OFX_TAG = re.compile(r"<(/?\w+)>([^<\r\n]*)")
+
+
+def parse_amount(value):
+    """ Turn "$1,234.50" or "-12.00" into a Decimal """
+
+    return Decimal(value.replace('$', '').replace(',', '').strip())
+
+
+def find_column(header, names):
+    """ Position of the first of names in the header, or None """
+
+    for name in names:
+        if name in header:
+            return header.index(name)
+
+    return None
+
+
+def parse_csv(stream, charge_sign=CSV_CHARGE_SIGN):
+    """ Yield a row dict for each line of a CSV statement, or None for
+    credits and lines that can't be read """
+
+    reader = csv.reader(stream)
+    header = [name.strip().lower() for name in next(reader, [])]
+
+    date_column = find_column(header, DATE_COLUMNS)
+    amount_column = find_column(header, AMOUNT_COLUMNS)
+    where_column = find_column(header, WHERE_COLUMNS)
+    description_column = find_column(header, DESCRIPTION_COLUMNS)
+    category_column = find_column(header, CATEGORY_COLUMNS)
+
+    if date_column is None or amount_column is None:
+        raise ValueError("A statement needs a date and an amount column")
+
+    if header[amount_column] == 'debit':
+        charge_sign = 1
+
+    def field(values, column):
+        if column is None or column >= len(values):
+            return u""
+
+        return values[column].decode('utf-8', 'replace').strip()
+
+    # A statement covers a few hundred days at most, so parse each date once
+    dates = {}
+
+    def row_date(value):
+        if value not in dates:
+            dates[value] = parse_date(value)
+
+        return dates[value]
+
+    for values in reader:
+        if not any(values):
+            continue
+
+        try:
+            row = {
+                'date': row_date(field(values, date_column)),
+                'amount': parse_amount(field(values, amount_column)) * charge_sign,
+                'where_bought': field(values, where_column),
+                'description': field(values, description_column),
+                'category': field(values, category_column),
+                'fitid': None
+            }
+        except (ValueError, InvalidOperation):
+            yield None
+            continue
+
+        # Refunds and deposits aren't expenditures
+        yield row if row['amount'] > 0 else None
+
+
+def ofx_row(transaction):
+    """ A row dict for one OFX transaction, or None for credits and
+    transactions that can't be read """
+
+    try:
+        amount = parse_amount(transaction.get('TRNAMT', ''))
+        date = datetime.strptime(transaction.get('DTPOSTED', '')[:8], '%Y%m%d')
+    except (ValueError, InvalidOperation):
+        return None
+
+    # OFX amounts are signed; money coming in isn't an expenditure
+    if amount >= 0:
+        return None
+
+    name = transaction.get('NAME', u"")
+
+    return {
+        'date': date,
+        'amount': -amount,
+        'where_bought': name,
+        'description': transaction.get('MEMO') or name,
+        'category': u"",
+        'fitid': transaction.get('FITID')
+    }
+
+
+def parse_ofx(stream):
+    """ Yield a row dict for each transaction in an OFX statement, or None for
+    transactions that are skipped """
+
+    transaction = None
+
+    for line in stream:
+        for tag, value in OFX_TAG.findall(line):
+            tag = tag.upper()
+
+            if tag == 'STMTTRN':
+                transaction = {}
+
+            elif tag == '/STMTTRN':
+                if transaction is not None:
+                    yield ofx_row(transaction)
+
+                transaction = None
+
+            elif transaction is not None and not tag.startswith('/'):
+                transaction[tag] = value.decode('utf-8', 'replace').strip()
+
+
+def statement_format(filename):
+    """ Guess the statement format from its file name """
+
+    if filename and os.path.splitext(filename)[1].lower() in ('.ofx', '.qfx'):
+        return 'ofx'
+
+    return 'csv'
+
+
+def content_hash(user_id, row, occurrence):
+    """ Hash that identifies a row across imports. Identical rows in one
+    statement (two coffees on the same day) are told apart by how many
+    came before them. """
+
+    if row['fitid']:
+        parts = [str(user_id), "fitid", row['fitid']]
+    else:
+        parts = [str(user_id), row['date'].strftime('%Y-%m-%d'), str(row['amount']),
+                 row['where_bought'], row['description'], str(occurrence)]
+
+    return hashlib.sha1(u"|".join(parts).encode('utf-8')).hexdigest()
+
+
+def category_for(row, default_category_id):
+    """ The category named in the row if it exists, else the default """
+
+    if row['category']:
+        for category in registry.all():
+            if category.name.lower() == row['category'].lower():
+                return category.id
+
+    return default_category_id
+
+
+def insert_new_rows(user_id, rows):
+    """ Insert the rows whose content hash isn't in the database yet, in the
+    caller's transaction; returns the rows inserted """
+
+    hashes = [values['content_hash'] for values in rows if values['content_hash']]
+    existing = set()
+
+    if hashes:
+        existing = set(row_hash for row_hash, in db.session.query(
+            Expenditure.content_hash).filter(
+            Expenditure.expenditure_userid == user_id,
+            Expenditure.content_hash.in_(hashes)))
+
+    new_rows = [values for values in rows if values['content_hash'] not in existing]
+
+    # One statement per chunk, rather than an executemany, which psycopg2
+    # runs as a round trip per row
+    for start in range(0, len(new_rows), INSERT_CHUNK_SIZE):
+        db.session.execute(Expenditure.__table__.insert().values(
+            new_rows[start:start + INSERT_CHUNK_SIZE]))
+
+    return new_rows
+
+
+def insert_batch(user_id, batch):
+    """ Insert the rows of a batch that aren't in the database yet, in one
+    transaction; returns how many were inserted """
+
+    new_rows = insert_new_rows(user_id, batch)
+    db.session.commit()
+
+    return len(new_rows)
+
+
+def import_rows(user_id, rows, default_category_id=None, batch_size=IMPORT_BATCH_SIZE,
+                progress=None):
+    """ Insert parsed rows as the user's expenditures in batches, skipping
+    ones already imported, then refresh the rollup once """
+
+    counts = {'imported': 0, 'duplicates': 0, 'skipped': 0}
+
+    def values_for(rows):
+        # Identical rows can only share a date, and statements list
+        # transactions by date, so only the current day's rows are counted
+        occurrences = {}
+        day = None
+
+        for row in rows:
+            category_id = category_for(row, default_category_id) if row else None
+
+            if row is None or category_id is None or not row['amount']:
+                counts['skipped'] += 1
+                continue
+
+            # Rows with a bank transaction id never need telling apart
+            if row['fitid']:
+                occurrence = 0
+            else:
+                if row['date'] != day:
+                    occurrences.clear()
+                    day = row['date']
+
+                key = (row['amount'], row['where_bought'], row['description'])
+                occurrence = occurrences[key] = occurrences.get(key, -1) + 1
+
+            yield {
+                'category_id': category_id,
+                'price': row['amount'],
+                'date_of_expenditure': row['date'],
+                'expenditure_userid': user_id,
+                'where_bought': row['where_bought'][:100],
+                'description': row['description'],
+                'content_hash': content_hash(user_id, row, occurrence)
+            }
+
+    values = values_for(rows)
+
+    try:
+        while True:
+            batch = list(islice(values, batch_size))
+
+            if not batch:
+                break
+
+            inserted = insert_batch(user_id, batch)
+            counts['imported'] += inserted
+            counts['duplicates'] += len(batch) - inserted
+
+            if progress is not None:
+                progress(counts)
+
+    finally:
+        # The batches committed before a failure stay, so they need the
+        # rollup too; seeding it row by row would cost a query per row
+        if counts['imported']:
+            db.session.rollback()
+            rebuild_rollup(user_id)
+
+    return counts
+
+
+def import_statement(user_id, stream, file_format='csv', default_category_id=None,
+                     progress=None, charge_sign=CSV_CHARGE_SIGN):
+    """ Import an open CSV or OFX statement for a user """
+
+    if file_format == 'ofx':
+        rows = parse_ofx(stream)
+    else:
+        rows = parse_csv(stream, charge_sign)
+
+    return import_rows(user_id, rows, default_category_id, progress=progress)
+
+
+########## BACKGROUND IMPORTS ###########
+
+
+def set_job_status(job_id, status):
+    """ Store an import's status in the database, where every worker can read
+    it, and commit """
+
+    db.session.merge(ImportJob(job_id=job_id,
+                               user_id=status['user_id'],
+                               state=status['state'],
+                               imported=status['imported'],
+                               duplicates=status['duplicates'],
+                               skipped=status['skipped'],
+                               error=status.get('error'),
+                               updated_at=datetime.now()))
+    db.session.commit()
+
+
+def get_job_status(job_id):
+    """ Get an import's status, or None if there is no such import """
+
+    job = ImportJob.query.get(job_id)
+
+    if job is None:
+        return None
+
+    status = {'job_id': job.job_id, 'user_id': job.user_id, 'state': job.state,
+              'imported': job.imported, 'duplicates': job.duplicates, 'skipped': job.skipped}
+
+    if job.error is not None:
+        status['error'] = job.error
+
+    return status
+
+
+def run_import_job(app, job_id, user_id, path, file_format, default_category_id):
+    """ Import a saved statement, recording progress as it goes, and delete
+    the file when done """
+
+    status = {'job_id': job_id, 'user_id': user_id, 'state': 'running',
+              'imported': 0, 'duplicates': 0, 'skipped': 0}
+
+    def progress(counts):
+        status.update(counts)
+        set_job_status(job_id, status)
+
+    with app.app_context():
+        try:
+            with open(path, 'rU') as statement:
+                progress(import_statement(user_id, statement, file_format,
+                                          default_category_id, progress))
+
+            status['state'] = 'done'
+
+        except Exception as error:
+            db.session.rollback()
+            status['state'] = 'failed'
+            status['error'] = str(error)
+
+        finally:
+            set_job_status(job_id, status)
+            db.session.remove()
+            os.remove(path)
+
+
+def start_import(app, user_id, path, file_format='csv', default_category_id=None):
+    """ Import a saved statement on a background thread so the request
+    doesn't wait for it; returns the job id to poll """
+
+    job_id = uuid.uuid4().hex
+
+    set_job_status(job_id, {'job_id': job_id, 'user_id': user_id, 'state': 'queued',
+                            'imported': 0, 'duplicates': 0, 'skipped': 0})
+
+    thread = threading.Thread(target=run_import_job,
+                              args=(app, job_id, user_id, path, file_format,
+                                    default_category_id))
+    thread.daemon = True
+    thread.start()
+
+    return job_id
+
+
+if __name__ == "__main__":
+    from flask import Flask
+
+    app = Flask(__name__)
+
+    spent_database = os.getenv('POSTGRES_DB_URL', 'postgres:///spending')
+    connect_to_db(app, spent_database)
+
+    user_id = int(sys.argv[1])
+    path = sys.argv[2]
+    default_category_id = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    with app.app_context():
+        with open(path, 'rU') as statement:
+            counts = import_statement(user_id, statement, statement_format(path),
+                                      default_category_id)
+
+    print "Imported %(imported)s, skipped %(duplicates)s duplicates and %(skipped)s unreadable rows" % counts
@@ -0,0 +1,223 @@
+""" Per-request SQL and latency metrics, a slow-query log and Prometheus output
+
+Every request records its wall time, how many SQL statements it ran and how
+long they took, labelled by route. Statements slower than SLOW_QUERY_MS are
+logged to the spent.slow_queries logger with their bound parameters
+redacted. /metrics serves everything in the Prometheus text format.
+"""
+
+from flask import g, request, has_request_context
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cache import user_cache
+
+import logging
+
+import os
+
+import threading
+
+import time
+
+
+# Statements slower than this many milliseconds go to the slow-query log
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 200))
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+slow_query_log = logging.getLogger('spent.slow_queries')
+
+# Log to stderr unless the deployment has set up its own handlers
+if not slow_query_log.handlers:
+    slow_query_log.addHandler(logging.StreamHandler())
+
+
+def redact_parameters(parameters):
+    """ Keep the shape of bound parameters but none of their values, so
+    emails, passwords and amounts never reach the logs """
+
+    if isinstance(parameters, dict):
+        return dict((key, type(value).__name__) for key, value in parameters.items())
+
+    if isinstance(parameters, (list, tuple)):
+        # executemany passes a list of parameter sets
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return "<%d parameter sets>" % len(parameters)
+
+        return [type(value).__name__ for value in parameters]
+
+    return type(parameters).__name__
+
+
+class Metrics(object):
+    """ Request and query counters, per route, shared by every thread """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forget everything recorded so far """
+
+        self.requests = {}
+        self.latency = {}
+        self.queries = {}
+        self.slow_queries = 0
+
+    def record_request(self, route, method, status, seconds, query_count, query_seconds):
+        """ Add one finished request """
+
+        with self._lock:
+            key = (route, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            # Histogram bucket counts, then the sum and count of all requests
+            if route not in self.latency:
+                self.latency[route] = [[0] * len(self.buckets), 0.0, 0]
+
+            histogram = self.latency[route]
+
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][position] += 1
+
+            histogram[1] += seconds
+            histogram[2] += 1
+
+            count, total = self.queries.get(route, (0, 0.0))
+            self.queries[route] = (count + query_count, total + query_seconds)
+
+    def record_slow_query(self):
+        """ Count a statement that went to the slow-query log """
+
+        with self._lock:
+            self.slow_queries += 1
+
+    def render(self):
+        """ Everything recorded, in the Prometheus text exposition format """
+
+        with self._lock:
+            lines = []
+
+            lines.append("# HELP spent_http_requests_total Requests by route, method and status.")
+            lines.append("# TYPE spent_http_requests_total counter")
+
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append('spent_http_requests_total{route="%s",method="%s",status="%s"} %d'
+                             % (route, method, status, count))
+
+            lines.append("# HELP spent_http_request_duration_seconds Wall time of requests by route.")
+            lines.append("# TYPE spent_http_request_duration_seconds histogram")
+
+            for route, (bucket_counts, total, count) in sorted(self.latency.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append('spent_http_request_duration_seconds_bucket{route="%s",le="%s"} %d'
+                                 % (route, bound, bucket_count))
+
+                lines.append('spent_http_request_duration_seconds_bucket{route="%s",le="+Inf"} %d'
+                             % (route, count))
+                lines.append('spent_http_request_duration_seconds_sum{route="%s"} %.6f' % (route, total))
+                lines.append('spent_http_request_duration_seconds_count{route="%s"} %d' % (route, count))
+
+            lines.append("# HELP spent_db_queries_total SQL statements run by requests, by route.")
+            lines.append("# TYPE spent_db_queries_total counter")
+
+            for route, (count, total) in sorted(self.queries.items()):
+                lines.append('spent_db_queries_total{route="%s"} %d' % (route, count))
+
+            lines.append("# HELP spent_db_query_duration_seconds_total Time spent in SQL by route.")
+            lines.append("# TYPE spent_db_query_duration_seconds_total counter")
+
+            for route, (count, total) in sorted(self.queries.items()):
+                lines.append('spent_db_query_duration_seconds_total{route="%s"} %.6f' % (route, total))
+
+            lines.append("# HELP spent_slow_queries_total Statements slower than the slow-query threshold.")
+            lines.append("# TYPE spent_slow_queries_total counter")
+            lines.append("spent_slow_queries_total %d" % self.slow_queries)
+
+        cache_stats = user_cache.stats()
+
+        lines.append("# HELP spent_cache_requests_total Per-user cache lookups by function and result.")
+        lines.append("# TYPE spent_cache_requests_total counter")
+
+        for name, stats in sorted(cache_stats.items()):
+            lines.append('spent_cache_requests_total{name="%s",result="hit"} %d' % (name, stats['hits']))
+            lines.append('spent_cache_requests_total{name="%s",result="miss"} %d' % (name, stats['misses']))
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    """ Note when each statement starts """
+
+    conn.info.setdefault('query_started', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    """ Add the statement to the current request's totals and log it if it
+    was slow """
+
+    seconds = time.time() - conn.info['query_started'].pop()
+
+    if has_request_context() and hasattr(g, 'query_count'):
+        g.query_count += 1
+        g.query_seconds += seconds
+
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        metrics.record_slow_query()
+        slow_query_log.warning("Slow query (%.1f ms): %s | parameters: %r",
+                               seconds * 1000, " ".join(statement.split()),
+                               redact_parameters(parameters))
+
+
+@event.listens_for(Engine, 'handle_error')
+def drop_query_timer(context):
+    """ Failed statements never reach after_cursor_execute """
+
+    if context.connection is not None:
+        started = context.connection.info.get('query_started')
+
+        if started:
+            started.pop()
+
+
+def init_app(app):
+    """ Time every request and count its SQL statements """
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.time()
+        g.query_count = 0
+        g.query_seconds = 0.0
+
+    @app.after_request
+    def record_request(response):
+        metrics.record_request(request.endpoint or "unknown",
+                               request.method,
+                               response.status_code,
+                               time.time() - g.request_started,
+                               g.query_count,
+                               g.query_seconds)
+        g.request_recorded = True
+
+        return response
+
+    @app.teardown_request
+    def record_failed_request(exception):
+        # Unhandled errors skip after_request, but still count as requests
+        if exception is not None and not getattr(g, 'request_recorded', False):
+            metrics.record_request(request.endpoint or "unknown",
+                                   request.method,
+                                   500,
+                                   time.time() - getattr(g, 'request_started', time.time()),
+                                   getattr(g, 'query_count', 0),
+                                   getattr(g, 'query_seconds', 0.0))
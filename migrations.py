@@ -0,0 +1,292 @@
+""" Versioned schema migrations for upgrading existing databases in place """
+
+from datetime import datetime
+
+from model import db, connect_to_db, User, Budget, Expenditure, DailySpending, TrackingStatus, BudgetStatus, ImportJob
+
+from rollup import rebuild_rollup
+
+from cache import user_cache
+
+import sqlalchemy
+
+import os
+
+import sys
+
+
+# Applied migrations are recorded here, one row per version
+SCHEMA_MIGRATIONS_TABLE = "schema_migrations"
+
+
+def is_postgres(connection):
+    """ Check if the connection is to a PostgreSQL database """
+
+    return connection.dialect.name == "postgresql"
+
+
+def create_index(connection, index):
+    """ Create an index if it doesn't exist yet; on PostgreSQL the index is
+    built concurrently so the table stays writable while it builds """
+
+    columns = ", ".join(column.name for column in index.columns)
+    unique = "UNIQUE " if index.unique else ""
+
+    if is_postgres(connection):
+
+        # A failed concurrent build leaves an invalid index behind, which
+        # IF NOT EXISTS would otherwise skip over
+        invalid = connection.execute(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "WHERE pg_class.relname = %(name)s AND NOT pg_index.indisvalid",
+            {'name': index.name}).first()
+
+        if invalid:
+            connection.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % index.name)
+
+        connection.execute("CREATE %sINDEX CONCURRENTLY IF NOT EXISTS %s ON %s (%s)" % (
+            unique, index.name, index.table.name, columns))
+
+    else:
+        connection.execute("CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)" % (
+            unique, index.name, index.table.name, columns))
+
+
+def add_column(connection, column):
+    """ Add a nullable column to an existing table if it isn't there yet;
+    without a default this doesn't rewrite the table """
+
+    table = column.table
+    existing = [existing_column['name'] for existing_column in
+                sqlalchemy.inspect(connection).get_columns(table.name)]
+
+    if column.name not in existing:
+        connection.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+            table.name, column.name, column.type.compile(dialect=connection.dialect)))
+
+
+def get_index(model, name):
+    """ Get one of a model's indexes by name """
+
+    for index in model.__table__.indexes:
+        if index.name == name:
+            return index
+
+
+def lookup_index(name, table_name, column_names):
+    """ An index on a stand-in table, for indexes the models no longer
+    declare """
+
+    # The index takes its table from the columns it is built on
+    columns = [sqlalchemy.Column(column_name) for column_name in column_names]
+    sqlalchemy.Table(table_name, sqlalchemy.MetaData(), *columns)
+
+    return sqlalchemy.Index(name, *columns)
+
+
+# The indexes migration 1 has always created. Migrations 6 and 7 replace or
+# drop some of them, so they are spelled out here rather than read from the
+# models.
+LOOKUP_INDEXES = [
+    lookup_index('ix_users_email', 'users', ['email']),
+    lookup_index('ix_users_password', 'users', ['password']),
+    lookup_index('ix_budget_userid_category_id', 'budget', ['budget_userid', 'category_id']),
+    lookup_index('ix_expenditures_tracking_num', 'expenditures', ['tracking_num']),
+    lookup_index('ix_expenditures_userid_category_id_date', 'expenditures',
+                 ['expenditure_userid', 'category_id', 'date_of_expenditure']),
+]
+
+
+def add_lookup_indexes(connection):
+    """ Index the columns the dashboard, chart, login and tracking queries
+    filter on """
+
+    for index in LOOKUP_INDEXES:
+        create_index(connection, index)
+
+
+def add_daily_spending(connection):
+    """ Create the daily spending rollup and backfill it """
+
+    DailySpending.__table__.create(bind=connection, checkfirst=True)
+    rebuild_rollup(connection=connection)
+
+
+def add_ledger_index(connection):
+    """ Index the ledger's keyset pagination order """
+
+    create_index(connection, get_index(Expenditure, 'ix_expenditures_userid_date_id'))
+
+
+def add_tracking_statuses(connection):
+    """ Create the table the tracking poller keeps package statuses in """
+
+    TrackingStatus.__table__.create(bind=connection, checkfirst=True)
+
+
+def add_import_hashes(connection):
+    """ Add the content hash statement imports dedupe on """
+
+    add_column(connection, Expenditure.__table__.c.content_hash)
+    create_index(connection, get_index(Expenditure, 'ux_expenditures_userid_content_hash'))
+
+
+def add_unique_budgets(connection):
+    """ Keep only the newest budget per user and category, then enforce it
+    with a unique index that replaces the plain lookup index """
+
+    duplicated_users = [user_id for user_id, in connection.execute(
+        "SELECT DISTINCT budget_userid FROM budget "
+        "GROUP BY budget_userid, category_id HAVING COUNT(*) > 1")]
+
+    connection.execute(
+        "DELETE FROM budget WHERE id NOT IN ("
+        "SELECT MAX(id) FROM budget GROUP BY budget_userid, category_id)")
+
+    create_index(connection, get_index(Budget, 'ux_budget_userid_category_id'))
+
+    if is_postgres(connection):
+        connection.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_budget_userid_category_id")
+    else:
+        connection.execute("DROP INDEX IF EXISTS ix_budget_userid_category_id")
+
+    # Cached dashboards may still show the deleted duplicates; new versions
+    # reach every worker through a shared cache backend
+    for user_id in duplicated_users:
+        user_cache.invalidate(user_id)
+
+
+def widen_password_column(connection):
+    """ Make room for password hashes and drop the index on plaintext
+    passwords. Existing passwords are hashed as their users log in. """
+
+    if is_postgres(connection):
+        connection.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_password")
+        connection.execute("ALTER TABLE users ALTER COLUMN password TYPE VARCHAR(128)")
+    else:
+        # SQLite doesn't enforce VARCHAR lengths
+        connection.execute("DROP INDEX IF EXISTS ix_users_password")
+
+
+def add_budget_statuses(connection):
+    """ Create the table the nightly budget status job fills """
+
+    BudgetStatus.__table__.create(bind=connection, checkfirst=True)
+
+
+def add_import_jobs(connection):
+    """ Create the table background imports record their progress in """
+
+    ImportJob.__table__.create(bind=connection, checkfirst=True)
+
+
+def add_tracking_failures(connection):
+    """ Add the failure count the tracking poller gives up on """
+
+    add_column(connection, TrackingStatus.__table__.c.failures)
+
+
+# Each migration is (version, description, function). Functions must be safe
+# to re-run, since a database built with db.create_all() already has the
+# latest schema but no recorded versions.
+MIGRATIONS = [
+    (1, "Add lookup indexes", add_lookup_indexes),
+    (2, "Add daily spending rollup", add_daily_spending),
+    (3, "Add expenditure ledger index", add_ledger_index),
+    (4, "Add tracking statuses", add_tracking_statuses),
+    (5, "Add statement import hashes", add_import_hashes),
+    (6, "Make budgets unique per user and category", add_unique_budgets),
+    (7, "Widen password column for hashes", widen_password_column),
+    (8, "Add budget statuses", add_budget_statuses),
+    (9, "Add import jobs", add_import_jobs),
+    (10, "Add tracking lookup failures", add_tracking_failures),
+]
+
+
+def create_migrations_table(connection):
+    """ Create the table that records applied migrations """
+
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS %s ("
+        "version INTEGER PRIMARY KEY, "
+        "description VARCHAR(200), "
+        "applied_at TIMESTAMP)" % SCHEMA_MIGRATIONS_TABLE)
+
+
+def get_applied_versions(connection):
+    """ Get the set of migration versions already applied """
+
+    if not connection.dialect.has_table(connection, SCHEMA_MIGRATIONS_TABLE):
+        return set()
+
+    rows = connection.execute("SELECT version FROM %s" % SCHEMA_MIGRATIONS_TABLE)
+
+    return set(row[0] for row in rows)
+
+
+def upgrade(engine, target=None):
+    """ Apply every pending migration up to target, in order """
+
+    # Concurrent index builds can't run inside a transaction block, so every
+    # migration runs on an autocommit connection
+    connection = engine.connect()
+
+    if is_postgres(connection):
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+
+    applied_now = []
+
+    try:
+        create_migrations_table(connection)
+        applied = get_applied_versions(connection)
+
+        for version, description, migration in MIGRATIONS:
+            if version in applied or (target is not None and version > target):
+                continue
+
+            print "Migration %s: %s" % (version, description)
+
+            migration(connection)
+
+            connection.execute(
+                db.text("INSERT INTO %s (version, description, applied_at) "
+                        "VALUES (:version, :description, :applied_at)" % SCHEMA_MIGRATIONS_TABLE),
+                version=version, description=description, applied_at=datetime.now())
+
+            applied_now.append(version)
+
+    finally:
+        connection.close()
+
+    return applied_now
+
+
+def status(engine):
+    """ List every migration and whether it has been applied """
+
+    connection = engine.connect()
+
+    try:
+        applied = get_applied_versions(connection)
+    finally:
+        connection.close()
+
+    return [(version, description, version in applied)
+            for version, description, migration in MIGRATIONS]
+
+
+if __name__ == "__main__":
+    # Run `python migrations.py` to upgrade the database, or
+    # `python migrations.py status` to see what is pending
+    from flask import Flask
+
+    app = Flask(__name__)
+
+    spent_database = os.getenv('POSTGRES_DB_URL', 'postgres:///spending')
+    connect_to_db(app, spent_database)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "status":
+        for version, description, is_applied in status(db.engine):
+            print "%s %s: %s" % ("[x]" if is_applied else "[ ]", version, description)
+    else:
+        upgrade(db.engine)
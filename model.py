@@ -1,9 +1,10 @@
 
-from flask_sqlalchemy import SQLAlchemy
+from routing import RoutingSQLAlchemy, replica_binds
 
 import os
 
-db = SQLAlchemy()
+# Queries in @read_only routes go to a replica when any are configured
+db = RoutingSQLAlchemy()
 
 
 class User(db.Model):
@@ -13,8 +14,9 @@ class User(db.Model):
 
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     name = db.Column(db.String(64))
-    email = db.Column(db.String(64))
-    password = db.Column(db.String(64))
+    email = db.Column(db.String(64), index=True)
+    # A salted PBKDF2 hash from passwords.py; never looked up by value
+    password = db.Column(db.String(128))
 
 
 class Category(db.Model):
@@ -43,6 +45,12 @@ class Budget(db.Model):
 
     category = db.relationship("Category", backref=db.backref('budget'))
 
+    # Budgets are always looked up by user and category, and a user has at
+    # most one budget per category
+    __table_args__ = (
+        db.Index('ux_budget_userid_category_id', 'budget_userid', 'category_id', unique=True),
+    )
+
     def __repr__(self):
         """ Provide useful info """
 
@@ -62,21 +70,146 @@ class Expenditure(db.Model):
     expenditure_userid = db.Column(db.Integer, db.ForeignKey('users.id'))
     where_bought = db.Column(db.String(100))
     description = db.Column(db.UnicodeText)
-    tracking_num = db.Column(db.String, nullable=True)
+    tracking_num = db.Column(db.String, nullable=True, index=True)
     tracking_num_carrier = db.Column(db.String(100), nullable=True)
 
+    # Identifies imported rows so a statement imported twice isn't doubled
+    content_hash = db.Column(db.String(40), nullable=True)
+
     user = db.relationship("User", backref=db.backref('expenditures'))
 
     category = db.relationship("Category", backref=db.backref('expenditures'))
 
+    # Covers the per-user, per-category date range lookups behind the
+    # dashboard and the charts
+    __table_args__ = (
+        db.Index('ix_expenditures_userid_category_id_date', 'expenditure_userid',
+                 'category_id', 'date_of_expenditure'),
+        # Serves the dashboard ledger's newest-first keyset pages
+        db.Index('ix_expenditures_userid_date_id', 'expenditure_userid',
+                 'date_of_expenditure', 'id'),
+        # Dedupes statement imports
+        db.Index('ux_expenditures_userid_content_hash', 'expenditure_userid',
+                 'content_hash', unique=True),
+    )
+
+
+class DailySpending(db.Model):
+    """ This is the running total of a user's spending per category per day,
+    kept up to date as expenditures are added and removed """
+
+    __tablename__ = "daily_spending"
+
+    spending_userid = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    # the data type of the total should match the data type of the price
+    total = db.Column(db.Numeric(15, 2), nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        """ Provide useful info """
+
+        return "<DailySpending spending_userid=%s category_id=%s day=%s total=%s count=%s>" % (
+            self.spending_userid, self.category_id, self.day, self.total, self.count)
+
+
+class TrackingStatus(db.Model):
+    """ This is the latest known status of a tracked package, refreshed in the
+    background by tracking_poller.py """
+
+    __tablename__ = "tracking_statuses"
+
+    tracking_num_carrier = db.Column(db.String(100), primary_key=True)
+    tracking_num = db.Column(db.String, primary_key=True, index=True)
+    status = db.Column(db.String(20))
+    city = db.Column(db.String(100))
+    state = db.Column(db.String(100))
+    zipcode = db.Column(db.String(20))
+    country = db.Column(db.String(100))
+    updated_at = db.Column(db.DateTime)
+    # Lookups in a row that failed or found nothing; the poller gives up on
+    # a package after TRACKING_MAX_FAILURES of them
+    failures = db.Column(db.Integer)
+
+    def __repr__(self):
+        """ Provide useful info """
+
+        return "<TrackingStatus tracking_num=%s tracking_num_carrier=%s status=%s updated_at=%s>" % (
+            self.tracking_num, self.tracking_num_carrier, self.status, self.updated_at)
+
+
+class BudgetStatus(db.Model):
+    """ This is where each budget stood at the last run of budget_status.py,
+    so over-budget users can be found without adding up their spending """
+
+    __tablename__ = "budget_statuses"
+
+    budget_userid = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id'), primary_key=True)
+    budget = db.Column(db.Numeric(15, 2), nullable=False)
+    budget_start_date = db.Column(db.DateTime)
+    budget_end_date = db.Column(db.DateTime)
+    total = db.Column(db.Numeric(15, 2), nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    remaining = db.Column(db.Numeric(15, 2), nullable=False)
+    # Percent of the budget remaining, like the dashboard progress bars
+    progress = db.Column(db.Float, nullable=False)
+    over_budget = db.Column(db.Boolean, nullable=False)
+    # How many of the user's budgets, this one included, are over
+    categories_over_budget = db.Column(db.Integer, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """ Provide useful info """
+
+        return "<BudgetStatus budget_userid=%s category_id=%s budget=%s total=%s over_budget=%s>" % (
+            self.budget_userid, self.category_id, self.budget, self.total, self.over_budget)
+
+
+class ImportJob(db.Model):
+    """ This is the progress of a background statement import, kept in the
+    database so every worker can report it """
+
+    __tablename__ = "import_jobs"
 
-def connect_to_db(app, spent_database):
+    job_id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    state = db.Column(db.String(20), nullable=False)
+    imported = db.Column(db.Integer, nullable=False, default=0)
+    duplicates = db.Column(db.Integer, nullable=False, default=0)
+    skipped = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        """ Provide useful info """
+
+        return "<ImportJob job_id=%s user_id=%s state=%s imported=%s>" % (
+            self.job_id, self.user_id, self.state, self.imported)
+
+
+def connect_to_db(app, spent_database, replica_urls=None):
     """ Connect the database to our Flask app. """
 
+    # Read replicas come from a comma-separated REPLICA_DB_URLS by default
+    if replica_urls is None:
+        replica_urls = [url for url in os.getenv('REPLICA_DB_URLS', '').split(',') if url]
+
     # Configure to use the database
     app.config['SQLALCHEMY_DATABASE_URI'] = spent_database
-    app.config['SQLALCHEMY_ECHO'] = True
+    app.config['SQLALCHEMY_BINDS'] = replica_binds(replica_urls)
+    # Echoing every statement is a debugging aid, so it is opt-in
+    app.config['SQLALCHEMY_ECHO'] = os.getenv('SQLALCHEMY_ECHO', '').lower() in ('1', 'true', 'yes')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
+
+    # Under gevent workers many requests share a process, so the pool may
+    # need to be larger than SQLAlchemy's default of 5 (+10 overflow)
+    if os.getenv('DB_POOL_SIZE'):
+        app.config['SQLALCHEMY_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE'))
+
+    if os.getenv('DB_MAX_OVERFLOW'):
+        app.config['SQLALCHEMY_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW'))
     db.app = app
     db.init_app(app)
 
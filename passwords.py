@@ -0,0 +1,91 @@
+""" Salted PBKDF2 password hashing
+
+Hashes are stored as pbkdf2_sha256$<iterations>$<salt>$<hash>, so the cost
+can be raised later without invalidating existing passwords: a login with
+an older cost, or with a plaintext password left over from before hashing,
+is verified and then rehashed at the current cost.
+
+Pick PASSWORD_ITERATIONS for your hardware with
+python -m benchmarks.password_cost <target milliseconds>.
+"""
+
+import base64
+
+import hashlib
+
+import hmac
+
+import os
+
+
+ALGORITHM = 'pbkdf2_sha256'
+
+# Higher is slower for attackers and for every login
+PASSWORD_ITERATIONS = int(os.getenv('PASSWORD_ITERATIONS', 100000))
+
+SALT_BYTES = 16
+
+
+def pbkdf2(password, salt, iterations):
+    """ Derive the hash of a password """
+
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+
+
+def hash_password(password, iterations=None):
+    """ Hash a password with a new random salt """
+
+    iterations = iterations or PASSWORD_ITERATIONS
+    salt = base64.b64encode(os.urandom(SALT_BYTES))
+
+    return "%s$%d$%s$%s" % (ALGORITHM, iterations, salt,
+                            base64.b64encode(pbkdf2(password, salt, iterations)))
+
+
+def is_hashed(stored):
+    """ Check if a stored password is a hash rather than plaintext """
+
+    return bool(stored) and stored.startswith(ALGORITHM + "$")
+
+
+def verify_password(password, stored):
+    """ Check a password against its stored hash, or against a legacy
+    plaintext password, in constant time """
+
+    if not stored or password is None:
+        return False
+
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+
+    if not is_hashed(stored):
+        return hmac.compare_digest(password, stored.encode('utf-8'))
+
+    try:
+        algorithm, iterations, salt, expected = stored.encode('utf-8').split("$")
+        iterations = int(iterations)
+    except ValueError:
+        return False
+
+    return hmac.compare_digest(base64.b64encode(pbkdf2(password, salt, iterations)), expected)
+
+
+def needs_rehash(stored):
+    """ Check if a stored password should be hashed again at the current
+    cost, after a successful login """
+
+    if not is_hashed(stored):
+        return True
+
+    try:
+        return int(stored.split("$")[1]) < PASSWORD_ITERATIONS
+    except (IndexError, ValueError):
+        return True
+
+
+# Checked when there is no such user, so a missing email takes as long as a
+# wrong password
+DUMMY_HASH = hash_password("not a real password")
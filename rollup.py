@@ -0,0 +1,158 @@
+""" Keep the daily_spending rollup in step with the expenditures table """
+
+from sqlalchemy import func
+from sqlalchemy.sql import and_
+
+from model import db, connect_to_db, DailySpending, Expenditure
+
+from cache import user_cache
+
+from datetime import datetime
+
+from decimal import Decimal
+
+import os
+
+import sys
+
+
+UPSERT_SPENDING_SQL = """
+INSERT INTO daily_spending (spending_userid, category_id, day, total, count)
+VALUES (:user_id, :category_id, :day, :total, :count)
+ON CONFLICT (spending_userid, category_id, day) DO UPDATE SET
+    total = daily_spending.total + EXCLUDED.total,
+    count = daily_spending.count + EXCLUDED.count
+"""
+
+
+def supports_upsert():
+    """ Check if the database has INSERT ... ON CONFLICT DO UPDATE """
+
+    dialect = db.engine.dialect
+
+    if dialect.name == "postgresql":
+        return True
+
+    # SQLite added it in 3.24
+    return dialect.name == "sqlite" and (dialect.server_version_info or ()) >= (3, 24)
+
+
+def record_spending(user_id, category_id, day, price, count=1):
+    """ Add an expenditure to (or, with a negative price and count, take it out
+    of) the user's rollup row for that category and day.
+
+    This runs in the caller's session, so the rollup changes commit or roll
+    back together with the expenditure itself. """
+
+    # Expenditures without a date never fall inside a window, and ones
+    # without a category aren't in any budget, so they have nothing to roll up
+    if day is None or category_id is None:
+        return
+
+    if isinstance(day, datetime):
+        day = day.date()
+
+    table = DailySpending.__table__
+
+    # Prices may be NULL, which count as nothing spent
+    price = Decimal(price or 0)
+
+    row_filter = and_(table.c.spending_userid == user_id,
+                      table.c.category_id == category_id,
+                      table.c.day == day)
+
+    # Add to the day's row or create it in one atomic statement, so two
+    # first writes for the same day can't both try to insert it
+    if count > 0 and supports_upsert():
+        # Typed like the columns, so SQLite gets dates and amounts it can store
+        upsert = db.text(UPSERT_SPENDING_SQL).bindparams(
+            db.bindparam('day', type_=table.c.day.type),
+            db.bindparam('total', type_=table.c.total.type))
+
+        db.session.execute(upsert, {
+            'user_id': user_id,
+            'category_id': category_id,
+            'day': day,
+            'total': price,
+            'count': count})
+        return
+
+    # Most days already have a row, so try updating it in place first. Only
+    # older SQLite gets here with a new row to insert, and SQLite lets one
+    # writer in at a time, so nothing can insert the row in between.
+    result = db.session.execute(table.update().where(row_filter).values(
+        total=table.c.total + price,
+        count=table.c.count + count))
+
+    if result.rowcount == 0 and count > 0:
+        db.session.execute(table.insert().values(
+            spending_userid=user_id,
+            category_id=category_id,
+            day=day,
+            total=price,
+            count=count))
+
+    # Drop rows for days that no longer have any expenditures
+    elif count < 0:
+        db.session.execute(table.delete().where(and_(row_filter, table.c.count <= 0)))
+
+
+def rebuild_rollup(user_id=None, connection=None):
+    """ Recompute the rollup from the expenditures table, for one user or for
+    everyone. Used for backfills and after bulk loads that skip
+    record_spending. """
+
+    executor = connection if connection is not None else db.session
+    table = DailySpending.__table__
+
+    day = func.date(Expenditure.date_of_expenditure)
+
+    totals = db.select([
+        Expenditure.expenditure_userid,
+        Expenditure.category_id,
+        day,
+        # Prices may be NULL, which count as nothing spent
+        func.coalesce(func.sum(Expenditure.price), 0),
+        func.count(Expenditure.id)]).where(and_(
+        # The rollup only has rows record_spending would have made
+        Expenditure.expenditure_userid.isnot(None),
+        Expenditure.category_id.isnot(None),
+        Expenditure.date_of_expenditure.isnot(None))).group_by(
+        Expenditure.expenditure_userid,
+        Expenditure.category_id,
+        day)
+
+    delete = table.delete()
+
+    if user_id is not None:
+        totals = totals.where(Expenditure.expenditure_userid == user_id)
+        delete = delete.where(table.c.spending_userid == user_id)
+
+    executor.execute(delete)
+    executor.execute(table.insert().from_select(
+        ['spending_userid', 'category_id', 'day', 'total', 'count'], totals))
+
+    if connection is None:
+        db.session.commit()
+
+    # Cached aggregates were computed from the old rollup
+    if user_id is not None:
+        user_cache.invalidate(user_id)
+    else:
+        user_cache.clear()
+
+
+if __name__ == "__main__":
+    # Run `python rollup.py` to rebuild every user's rollup, or
+    # `python rollup.py <user id>` to rebuild one user's
+    from flask import Flask
+
+    app = Flask(__name__)
+
+    spent_database = os.getenv('POSTGRES_DB_URL', 'postgres:///spending')
+    connect_to_db(app, spent_database)
+
+    user_id = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+    rebuild_rollup(user_id)
+    print "Rebuilt daily spending rollup"
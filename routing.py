@@ -0,0 +1,134 @@
+""" Send the queries of read-only routes to read replicas
+
+Replicas are configured with REPLICA_DB_URLS, a comma-separated list of
+database URLs, and become SQLAlchemy binds named replica_0, replica_1, ...
+Routes decorated with @read_only run their queries against one replica
+picked per request; everything else, and every write (flushed or run with
+session.execute), uses the primary.
+
+Replicas lag behind the primary, so after a request writes anything the
+user's reads stay on the primary for READ_YOUR_WRITES_SECONDS. The deadline
+lives in the (cookie) session so every worker honours it.
+"""
+
+from contextlib import contextmanager
+
+from flask import g, session, has_request_context
+
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+
+from sqlalchemy.sql.expression import SelectBase, TextClause
+
+import functools
+
+import os
+
+import random
+
+import time
+
+
+# How long a user's reads stay on the primary after they write
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', 10))
+
+REPLICA_BIND_PREFIX = 'replica_'
+
+
+def replica_binds(replica_urls):
+    """ SQLALCHEMY_BINDS entries for a list of replica URLs """
+
+    return dict(("%s%d" % (REPLICA_BIND_PREFIX, position), url)
+                for position, url in enumerate(replica_urls))
+
+
+def replica_keys(app):
+    """ Names of the replica binds configured on the app """
+
+    return sorted(key for key in (app.config.get('SQLALCHEMY_BINDS') or {})
+                  if key.startswith(REPLICA_BIND_PREFIX))
+
+
+def is_write(clause):
+    """ Whether a statement given to session.execute() changes anything """
+
+    if clause is None or isinstance(clause, SelectBase):
+        return False
+
+    # Raw SQL reaches here as text(); only a plain SELECT is a read
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().upper().startswith("SELECT")
+
+    return True
+
+
+class RoutingSession(SignallingSession):
+    """ Session that reads from a replica inside @read_only routes """
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context():
+            # Writes always go to the primary, whether they are flushed or
+            # executed directly; remember them so the user's next reads do too
+            if self._flushing or is_write(clause):
+                g.wrote_to_primary = True
+
+            elif getattr(g, 'read_only', False):
+                keys = replica_keys(self.app)
+
+                if keys:
+                    # Stick to one replica for the whole request
+                    if getattr(g, 'replica_key', None) not in keys:
+                        g.replica_key = random.choice(keys)
+
+                    return get_state(self.app).db.get_engine(self.app, bind=g.replica_key)
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with replica routing in its sessions """
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+
+def recently_wrote():
+    """ Whether the user wrote within the read-your-writes window """
+
+    return session.get('read_primary_until', 0) > time.time()
+
+
+def read_only(view):
+    """ Run a view's queries on a replica, unless the user just wrote """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = not recently_wrote()
+
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def use_primary():
+    """ Send the queries inside the block to the primary, for the parts of a
+    read-only route that go on to write """
+
+    read_only = getattr(g, 'read_only', False)
+    g.read_only = False
+
+    try:
+        yield
+    finally:
+        g.read_only = read_only
+
+
+def init_app(app):
+    """ Start the read-your-writes window whenever a request writes """
+
+    @app.after_request
+    def keep_reads_on_primary(response):
+        if getattr(g, 'wrote_to_primary', False):
+            session['read_primary_until'] = time.time() + READ_YOUR_WRITES_SECONDS
+
+        return response
@@ -1,211 +1,234 @@
-""" Utility file to seed spending database in seed_data/ """
+""" Utility file to seed spending database in seed_data/
+
+Each table is streamed from its |-separated file in chunks, so memory stays
+flat however big the files are. PostgreSQL loads each chunk with COPY; other
+databases use one bulk INSERT per chunk. Every chunk is committed as it goes.
+
+    python seed.py                 # load seed_data/
+    python seed.py /data/big_seed  # load another directory with the same files
+"""
 
 from sqlalchemy import func
-from model import User, Expenditure, Budget, Category
+from model import User, Expenditure, Budget, Category, DailySpending
 
 from model import connect_to_db, db
 from server import app
 
+from rollup import rebuild_rollup
+
+from tools import parse_date
+
+from cStringIO import StringIO
+
+from decimal import Decimal
+
+from itertools import islice
+
 import os
 
+import sys
 
-def load_users():
-    """ Load users from users.csv into database """
 
-    print "Users"
+# Rows per COPY or INSERT, and so per commit
+CHUNK_SIZE = int(os.getenv('SEED_CHUNK_SIZE', 50000))
 
-    # Delete all rows in table, so if we need to run this a second time,
-    # we won't be trying to add duplicate users
-    User.query.delete()
 
-    # Read users.csv file and insert data into the session
-    for row in open("seed_data/users.csv"):
-        row = row.rstrip()
-        user_data = row.split("|")
-        id = user_data[0]
-        name = user_data[1]
-        email = user_data[2]
-        password = user_data[3]
+def to_date(value):
+    """ Dates for databases that won't take strings """
 
-        user = User(id=id,
-                    name=name,
-                    email=email,
-                    password=password)
+    return parse_date(value) if value else None
 
-        # We need to add to the session or it won't ever be stored
-        db.session.add(user)
 
-    # Once we're done, we should commit our work
-    db.session.commit()
+# Columns in file order, with the converters the non-COPY path needs
+USER_COLUMNS = [('id', int), ('name', unicode), ('email', unicode), ('password', unicode)]
 
+CATEGORY_COLUMNS = [('id', int), ('category', unicode)]
 
-def load_categories():
-    """ Load categories from categories.csv into database """
+BUDGET_COLUMNS = [('id', int), ('budget', Decimal), ('category_id', int),
+                  ('budget_userid', int), ('budget_start_date', to_date),
+                  ('budget_end_date', to_date)]
 
-    print "Categories"
+EXPENDITURE_COLUMNS = [('id', int), ('category_id', int), ('price', Decimal),
+                       ('date_of_expenditure', to_date), ('expenditure_userid', int),
+                       ('where_bought', unicode), ('description', unicode),
+                       ('tracking_num', unicode), ('tracking_num_carrier', unicode)]
 
-    # Delete all rows in table, so if we need to run this a second time,
-    # we won't be trying to add duplicate categories
-    Category.query.delete()
 
-    # Read categories.csv file and insert data into the session
-    for row in open("seed_data/categories.csv"):
-        row = row.rstrip()
-        categories_data = row.split("|")
-        id = categories_data[0]
-        category = categories_data[1]
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    """ Yield lists of up to chunk_size raw lines from a file """
 
-        category_model = Category(id=id,
-                                  category=category)
+    with open(path) as seed_file:
+        while True:
+            lines = list(islice(seed_file, chunk_size))
 
-        # We need to add to the session or it won't ever be stored
-        db.session.add(category_model)
+            if not lines:
+                break
 
-    db.session.commit()
+            # Skip blank lines and make sure every row ends its line
+            lines = [line.rstrip("\r\n") + "\n" for line in lines if line.strip()]
 
+            if lines:
+                yield lines
 
-def load_budget():
-    """ Load budget from budget.csv into database """
 
-    print "Budget"
+def copy_chunk(table, columns, lines):
+    """ Load raw lines with PostgreSQL's COPY """
 
-    # Delete all rows in table, so if we need to run this a second time,
-    # we won't be trying to add duplicate users
-    Budget.query.delete()
-
-    # Read users.csv file and insert data into the session
-    for row in open("seed_data/budget.csv"):
-        row = row.rstrip()
-        budget_data = row.split("|")
-        id = budget_data[0]
-        budget = budget_data[1]
-        category_id = budget_data[2]
-        budget_userid = budget_data[3]
-        budget_start_date = budget_data[4]
-        budget_end_date = budget_data[5]
-
-        budget = Budget(id=id,
-                        budget=budget,
-                        category_id=category_id,
-                        budget_userid=budget_userid,
-                        budget_start_date=budget_start_date,
-                        budget_end_date=budget_end_date)
-
-        # We need to add to the session or it won't ever be stored
-        db.session.add(budget)
-
-    # Once we're done, we should commit our work
-    db.session.commit()
+    column_names = ", ".join(name for name, converter in columns)
 
+    # CSV mode with a quote character that never appears, so quotes and
+    # backslashes in descriptions are loaded as-is and empty fields stay
+    # empty strings, the way the ORM loader stored them
+    copy_sql = ("COPY %s (%s) FROM STDIN WITH (FORMAT csv, DELIMITER '|', "
+                "QUOTE E'\\x01', NULL '\\N')" % (table.name, column_names))
 
-def load_expenditures():
-    """ Load expenditures from expenditures.csv into database """
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(copy_sql, StringIO("".join(lines)))
 
-    print "Expenditures"
-    Expenditure.query.delete()
-
-    for row in open("seed_data/expenditures.csv"):
-        row = row.rstrip()
-        expenditure_data = row.split("|")
-        id = expenditure_data[0]
-        category_id = expenditure_data[1]
-        price = expenditure_data[2]
-        date_of_expenditure = expenditure_data[3]
-        expenditure_userid = expenditure_data[4]
-        where_bought = expenditure_data[5]
-        description = expenditure_data[6]
-        tracking_num = expenditure_data[7]
-        tracking_num_carrier = expenditure_data[8]
-
-        expenditure = Expenditure(id=id,
-                                  category_id=category_id,
-                                  price=price,
-                                  date_of_expenditure=date_of_expenditure,
-                                  expenditure_userid=expenditure_userid,
-                                  where_bought=where_bought,
-                                  description=description,
-                                  tracking_num=tracking_num,
-                                  tracking_num_carrier=tracking_num_carrier)
-
-        db.session.add(expenditure)
 
-    db.session.commit()
+def insert_chunk(table, columns, lines):
+    """ Load raw lines with one bulk INSERT """
 
+    rows = []
 
-def set_val_user_id():
-    """ Set value for the next user id after seeding database """
+    for line in lines:
+        values = line.rstrip("\n").split("|")
+        row = {}
 
-    # Get the Max user id in the database
-    result = db.session.query(func.max(User.id)).one()
+        for (name, converter), value in zip(columns, values):
+            if converter is unicode:
+                row[name] = value.decode('utf-8')
+            else:
+                row[name] = converter(value)
 
-    max_id = int(result[0])
+        rows.append(row)
 
-    # Set the value for the next user_id to be max_id + 1
-    # Note to self: the 'users_id_seq' variable is based on the Users table
-    query = "SELECT setval('users_id_seq', :new_id)"
+    db.session.execute(table.insert(), rows)
 
-    db.session.execute(query, {'new_id': max_id + 1})
-    db.session.commit()
 
+def bulk_load(model, path, columns, chunk_size=CHUNK_SIZE):
+    """ Stream a seed file into a table chunk by chunk, committing each one """
 
-def set_val_expenditure_id():
-    """ Set value for the next expenditure id after seeding database """
+    table = model.__table__
+    use_copy = db.engine.dialect.name == "postgresql"
+    total = 0
 
-    # Get the Max expenditure id in the database
-    result = db.session.query(func.max(Expenditure.id)).one()
+    for lines in read_chunks(path, chunk_size):
+        if use_copy:
+            copy_chunk(table, columns, lines)
+        else:
+            insert_chunk(table, columns, lines)
 
-    max_id = int(result[0])
+        db.session.commit()
 
-    # Set the value for the next expenditure id to be max_id + 1
-    query = "SELECT setval('expenditures_id_seq', :new_id)"
+        total += len(lines)
+        print "  %s rows" % total
+
+
+def clear_tables():
+    """ Delete all rows in the seeded tables, so if we need to run this a
+    second time, we won't be trying to add duplicates. Tables that point at
+    other tables go first. """
+
+    for model in [DailySpending, Expenditure, Budget, Category, User]:
+        model.query.delete()
 
-    db.session.execute(query, {'new_id': max_id + 1})
     db.session.commit()
 
 
-def set_val_budget_id():
-    """ Set value for the next budget id after seeding database """
+def load_users(seed_dir="seed_data"):
+    """ Load users from users.csv into database """
 
-    # Get the Max user id in the database
-    result = db.session.query(func.max(Budget.id)).one()
+    print "Users"
+    bulk_load(User, os.path.join(seed_dir, "users.csv"), USER_COLUMNS)
 
-    max_id = int(result[0])
 
-    # Set the value for the next user_id to be max_id + 1
-    query = "SELECT setval('budget_id_seq', :new_id)"
+def load_categories(seed_dir="seed_data"):
+    """ Load categories from categories.csv into database """
 
-    db.session.execute(query, {'new_id': max_id + 1})
-    db.session.commit()
+    print "Categories"
+    bulk_load(Category, os.path.join(seed_dir, "categories.csv"), CATEGORY_COLUMNS)
 
 
-def set_val_category_id():
-    """ Set value for the next category id after seeding database """
+def load_budget(seed_dir="seed_data"):
+    """ Load budget from budget.csv into database """
+
+    print "Budget"
+    bulk_load(Budget, os.path.join(seed_dir, "budget.csv"), BUDGET_COLUMNS)
+
+
+def load_expenditures(seed_dir="seed_data"):
+    """ Load expenditures from expenditures.csv into database """
 
-    # Get the Max user id in the database
-    result = db.session.query(func.max(Category.id)).one()
+    print "Expenditures"
+    bulk_load(Expenditure, os.path.join(seed_dir, "expenditures.csv"), EXPENDITURE_COLUMNS)
+
+
+def set_val_id(model, sequence):
+    """ Set the next id of a table's sequence to one past its largest id """
 
-    max_id = int(result[0])
+    # Get the Max id in the table
+    result = db.session.query(func.max(model.id)).one()
 
-    # Set the value for the next user_id to be max_id + 1
-    query = "SELECT setval('categories_id_seq', :new_id)"
+    max_id = int(result[0] or 0)
+
+    # Set the value for the next id to be max_id + 1
+    query = "SELECT setval('%s', :new_id)" % sequence
 
     db.session.execute(query, {'new_id': max_id + 1})
     db.session.commit()
 
 
+def set_val_user_id():
+    """ Set value for the next user id after seeding database """
+
+    # Note to self: the 'users_id_seq' variable is based on the Users table
+    set_val_id(User, 'users_id_seq')
+
+
+def set_val_expenditure_id():
+    """ Set value for the next expenditure id after seeding database """
+
+    set_val_id(Expenditure, 'expenditures_id_seq')
+
+
+def set_val_budget_id():
+    """ Set value for the next budget id after seeding database """
+
+    set_val_id(Budget, 'budget_id_seq')
+
+
+def set_val_category_id():
+    """ Set value for the next category id after seeding database """
+
+    set_val_id(Category, 'categories_id_seq')
+
+
 if __name__ == "__main__":
     spent_database = os.getenv('POSTGRES_DB_URL', 'postgres:///spending')
     connect_to_db(app, spent_database)
 
+    # Echoing millions of statements would dominate the load time
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    seed_dir = sys.argv[1] if len(sys.argv) > 1 else "seed_data"
+
     # In case tables haven't been created, create them
     db.create_all()
 
     # Import different types of data
-    load_users()
-    load_categories()
-    load_expenditures()
-    load_budget()
-    set_val_user_id()
-    set_val_category_id()
-    set_val_expenditure_id()
-    set_val_budget_id()
+    clear_tables()
+    load_users(seed_dir)
+    load_categories(seed_dir)
+    load_expenditures(seed_dir)
+    load_budget(seed_dir)
+
+    # Sequences only exist on PostgreSQL; reset them once, after every load
+    if db.engine.dialect.name == "postgresql":
+        set_val_user_id()
+        set_val_category_id()
+        set_val_expenditure_id()
+        set_val_budget_id()
+
+    # Seeded expenditures skip the rollup, so rebuild it once at the end
+    rebuild_rollup()
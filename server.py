@@ -2,18 +2,46 @@ from jinja2 import StrictUndefined
 
 # from pprint import pprint
 
-from datetime import datetime, timedelta
-
 import requests
 
-from flask import Flask, request, render_template, session, url_for, flash, redirect, jsonify, json, abort
+from flask import Flask, request, render_template, session, url_for, flash, redirect, jsonify, abort, Response, stream_with_context
 from flask_debugtoolbar import DebugToolbarExtension
 
-from model import User, connect_to_db, db, Expenditure, Budget
+from model import User, connect_to_db, db, Expenditure, Budget, TrackingStatus
+
+from rollup import record_spending
+
+from categories import registry
+
+from charts import get_chart_stats, get_spending_series
+
+from cache import user_cache
+
+from http_cache import conditional
+
+import http_cache
+
+import instrumentation
+
+import routing
+
+import fragments
+
+import assets
+
+from routing import read_only, use_primary
 
-from tools import expenditure_function, budget_totals, get_dates_for_budget, get_progress, get_budget_per_category
+from tracking import tracking_client, save_tracking_status, tracking_status_info, address_info as tracking_address_info
 
-from sqlalchemy.sql import and_
+from export import export_expenditures, EXPORT_MIMETYPES
+
+from batch import add_expenditures, add_budgets, summaries_to_list, BatchError
+
+from importer import start_import, get_job_status, statement_format
+
+from passwords import hash_password, verify_password, needs_rehash, DUMMY_HASH
+
+from tools import get_dashboard_data, budget_summaries, save_budget, parse_date, get_expenditure_page, expenditure_to_dict
 
 import os
 
@@ -23,6 +51,12 @@ import hmac
 
 import base64
 
+import tempfile
+
+from datetime import date, timedelta
+
+from decimal import Decimal
+
 app = Flask(__name__)
 
 app.jinja_env.undefined = StrictUndefined
@@ -34,6 +68,22 @@ app.secret_key = os.getenv('SECRET_KEY')
 spent_database = os.getenv('POSTGRES_DB_URL')
 connect_to_db(app, spent_database)
 
+# Time requests and count their queries; registered first so its
+# after_request hook runs last and includes compression
+instrumentation.init_app(app)
+
+# Add ETags and compression to responses
+http_cache.init_app(app)
+
+# Keep a user's reads on the primary for a while after they write
+routing.init_app(app)
+
+# Cache dashboard fragments per user and keep compiled templates on disk
+fragments.init_app(app)
+
+# Serve hashed, precompressed bundles with far-future caching
+assets.init_app(app)
+
 
 @app.route('/')
 def index():
@@ -67,13 +117,16 @@ def profile_edit():
         db.session.commit()
 
     if password:
-        user_info.password = password
+        user_info.password = hash_password(password)
         db.session.commit()
 
     if email:
         user_info.email = email
         db.session.commit()
 
+    # The user's cached data is out of date now
+    user_cache.invalidate(id)
+
     name_info = {
         'name': name,
         'email': email
@@ -146,172 +199,122 @@ def intercom_webhook():
 
 
 @app.route('/tracking/<tracking_num>', methods=["POST"])
+@read_only
 def tracking_with_id(tracking_num):
     """ Handle the tracking information and display on the map """
 
+    # The tracking poller keeps the latest status of every package in the
+    # database, so this is usually all it takes
+    tracking_status = TrackingStatus.query.filter_by(tracking_num=tracking_num).first()
+
+    # A row without a status only records lookups that failed
+    if tracking_status is not None and tracking_status.status is not None:
+        return jsonify(tracking_status_info(tracking_status))
+
     # Get the expenditure associated with the tracking number
     expenditure_object = Expenditure.query.filter_by(tracking_num=tracking_num).first()
 
+    if expenditure_object is None:
+        abort(404)
+
     # Get the carrier associated with the tracking number
     carrier = expenditure_object.tracking_num_carrier
 
-    def shippo_url(track_num, carrier_info):
-        """ Creates API call using tracking information the user input via the form """
-
-        url = "https://api.goshippo.com/v1/tracks/" + str(carrier_info) + "/" + str(track_num) + "/"
-        return url
+    # Hand the database connection back to the pool while Shippo is called,
+    # so slow lookups can't use up the pool
+    db.session.close()
+
+    # The poller hasn't seen this package yet, so look it up now, from the
+    # cache while it is fresh; a slow or failing Shippo times out instead of
+    # tying up the worker, and a body that isn't JSON is a bad gateway too
+    try:
+        data = tracking_client.track(carrier, tracking_num)
+    except (requests.RequestException, ValueError):
+        abort(502)
+
+    # Save it so the next lookup is a database read; the existing row, if
+    # the replica hasn't caught up, is on the primary
+    with use_primary():
+        save_tracking_status(carrier, tracking_num, data)
+        db.session.commit()
 
-    # Returns the data we need
-    shippo_tracking = shippo_url(tracking_num, carrier)
-    result = requests.get(shippo_tracking)
-    data = json.loads(result.content)
+    # This is the location and delivery status of the package
+    address_info = tracking_address_info(data)
 
-    final_dest = data['tracking_status']['location']
+    # Return jsonified budget info to map.js
+    return jsonify(address_info)
 
-    city = final_dest['city']
-    state = final_dest['state']
-    zipcode = final_dest['zip']
-    country = final_dest['country']
 
-    # This is the delivery status of the paackage
-    tracking_status = data['tracking_status']['status']
+@app.route('/dashboard-stats.json')
+@read_only
+@conditional
+def dashboard_stats_data():
+    """ Return the data for both dashboard charts in one response """
 
-    address_info = {
-        'city': city,
-        'state': state,
-        'zipcode': zipcode,
-        'country': country,
-        'tracking_status': tracking_status
-    }
+    # Get the id of the user in the session
+    id = session.get('id')
 
-    # Return jsonified budget info to map.js
-    return jsonify(address_info)
+    # Return jsonified info to charts.js
+    return jsonify(get_chart_stats(id))
 
 
 @app.route('/total-spent.json')
+@read_only
+@conditional
 def budget_types_data():
     """ Bar chart shows totals for last 30 days """
 
     id = session.get('id')
 
-    # This is today's date
-    today = datetime.today().strftime('%Y-%m-%d')
-    # '2016-05-31'
-
-    # This is the date 30 days in the past from today
-    thirty_days_past = (datetime.today() + timedelta(-30)).strftime('%Y-%m-%d')
-
-    # If the user id is in the session, this will render the dashboard
-    # template, which will display their information and expenditure information
-    if 'id' in session:
-
-        # Unpacking the total price and average spent
-        total_food_price, avg_food_expenditures = expenditure_function(3, id, thirty_days_past, today)
-        total_groceries_price, avg_groceries_expenditures = expenditure_function(4, id, thirty_days_past, today)
-        total_clothing_price, avg_clothing_expenditures = expenditure_function(5, id, thirty_days_past, today)
-        total_entertainment_price, avg_entertainment_expenditures = expenditure_function(6, id, thirty_days_past, today)
-        total_travel_price, avg_travel_expenditures = expenditure_function(2, id, thirty_days_past, today)
-        total_online_purchase_price, avg_online_expenditures = expenditure_function(1, id, thirty_days_past, today)
-
-    data_dict = {
-        "labels": ["Food", "Groceries", "Clothing", "Entertainment", "Travel", "Online Purchases"],
-        "datasets": [
-            {
-                "label": "Total Spent",
-                "fillColor": "#F37257",
-                "strokeColor": "#F37257",
-                "pointColor": "#F37257",
-                "pointStrokeColor": "#fff",
-                "pointHighlightFill": "#fff",
-                "pointHighlightStroke": "#F37257",
-                "data": [total_food_price, total_groceries_price, total_clothing_price, total_entertainment_price, total_travel_price, total_online_purchase_price]
-            },
-            {
-                "label": "Average",
-                "fillColor": "#AFC1CC",
-                "strokeColor": "#AFC1CC",
-                "pointColor": "#AFC1CC",
-                "pointStrokeColor": "#fff",
-                "pointHighlightFill": "#fff",
-                "pointHighlightStroke": "#AFC1CC",
-                "data": [avg_food_expenditures, avg_groceries_expenditures, avg_clothing_expenditures, avg_entertainment_expenditures, avg_travel_expenditures, avg_online_expenditures]
-            }
-        ]
-    }
-
     # This returns the data jsonified
-    return jsonify(data_dict)
+    return jsonify(get_chart_stats(id)['bar'])
 
 
 @app.route('/expenditure-types.json')
+@read_only
+@conditional
 def expenditure_types_data():
     """ Return data about expenditures to the donut chart """
 
     # Get the id of the user in the session
     id = session.get('id')
 
-    # This is today's date
-    today = datetime.today().strftime('%Y-%m-%d')
-    # '2016-05-31'
-
-    # This is the date 30 days in the past from today
-    thirty_days_past = (datetime.today() + timedelta(-30)).strftime('%Y-%m-%d')
-
-    # Get the total amount spent per category by calling the get_expenditures function
-    travel_expenditures, avg_travel = expenditure_function(2, id, thirty_days_past, today)
-    entertainment_expenditures, avg_entertainment = expenditure_function(6, id, thirty_days_past, today)
-    groceries_expenditures, avg_groceries = expenditure_function(4, id, thirty_days_past, today)
-    clothing_expenditures, avg_clothing = expenditure_function(5, id, thirty_days_past, today)
-    food_expenditures, avg_food = expenditure_function(3, id, thirty_days_past, today)
-    online_purchase_expenditures, avg_online = expenditure_function(1, id, thirty_days_past, today)
-
-    # Jsonified info
-    data_list_of_dicts = {
-        'expenditures': [
-            {
-                "value": travel_expenditures,
-                "color": "#F4D27A",
-                "highlight": "#963019",
-                "label": "Travel"
-            },
-            {
-                "value": entertainment_expenditures,
-                "color": "#517281",
-                "highlight": "#963019",
-                "label": "Entertainment"
-            },
-            {
-                "value": groceries_expenditures,
-                "color": "#7895A2",
-                "highlight": "#963019",
-                "label": "Groceries"
-            },
-            {
-                "value": clothing_expenditures,
-                "color": "#AFC1CC",
-                "highlight": "#963019",
-                "label": "Clothing"
-            },
-            {
-                "value": food_expenditures,
-                "color": "#F37257",
-                "highlight": "#963019",
-                "label": "Food"
-            },
-            {
-                "value": online_purchase_expenditures,
-                "color": "#F68D5C",
-                "highlight": "#963019",
-                "label": "Online Purchase"
-            }
-        ]
-    }
-
     # Return jsonified info
-    return jsonify(data_list_of_dicts)
+    return jsonify(get_chart_stats(id)['donut'])
+
+
+@app.route('/spending-series.json')
+@read_only
+@conditional
+def spending_series_data():
+    """ Return the user's spending summed into day, week, month or year
+    buckets. Takes start and end dates (the last 30 days by default), a
+    bucket (picked from the range by default) and a category. """
+
+    # Get the id of the user in the session
+    id = session.get('id')
+
+    if id is None:
+        abort(401)
+
+    # Whole days, so the default range's cache key only changes daily
+    today = date.today()
+
+    try:
+        series = get_spending_series(id,
+                                     request.args.get("start") or today - timedelta(days=30),
+                                     request.args.get("end") or today,
+                                     request.args.get("bucket"),
+                                     request.args.get("category", type=int))
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
+    return jsonify(series)
 
 
 @app.route('/dashboard/<int:id>')
+@read_only
+@conditional
 def dashboard(id):
     """ This is the user dashboard """
 
@@ -329,133 +332,142 @@ def dashboard(id):
         MESSAGE = str(user.id)
         hash_result = hmac.new(KEY, MESSAGE, hashlib.sha256).hexdigest() 
 
-        ####### GET THE USER'S BUDGETS FOR EACH CATEGORY
-
-        cat_1_budget = get_budget_per_category(1, id)
-        cat_2_budget = get_budget_per_category(2, id)
-        cat_3_budget = get_budget_per_category(3, id)
-        cat_4_budget = get_budget_per_category(4, id)
-        cat_5_budget = get_budget_per_category(5, id)
-        cat_6_budget = get_budget_per_category(6, id)
-
-        # This is the expenditure object, which contains information about
-        # expenditures specific to the user from the expenditure table in the
-        # database
-        expenditures = Expenditure.query.filter_by(expenditure_userid=id).all()
-
-        ########### GET BUDGET START AND END DATES ###########
-
-        # Calls the get_dates_for_budget function in tools.py
-        cat_3_start, cat_3_end = get_dates_for_budget(3, id)
-        cat_1_start, cat_1_end = get_dates_for_budget(1, id)
-        cat_2_start, cat_2_end = get_dates_for_budget(2, id)
-        cat_4_start, cat_4_end = get_dates_for_budget(4, id)
-        cat_5_start, cat_5_end = get_dates_for_budget(5, id)
-        cat_6_start, cat_6_end = get_dates_for_budget(6, id)
-
-        # Strips datetime objects to year, month, day
-        cat_3_start_date = cat_3_start.strftime('%m-%d-%Y')
-        cat_1_start_date = cat_1_start.strftime('%m-%d-%Y')
-        cat_2_start_date = cat_2_start.strftime('%m-%d-%Y')
-        cat_4_start_date = cat_4_start.strftime('%m-%d-%Y')
-        cat_5_start_date = cat_5_start.strftime('%m-%d-%Y')
-        cat_6_start_date = cat_6_start.strftime('%m-%d-%Y')
-
-        cat_3_end_date = cat_3_end.strftime('%m-%d-%Y')
-        cat_1_end_date = cat_1_end.strftime('%m-%d-%Y')
-        cat_2_end_date = cat_2_end.strftime('%m-%d-%Y')
-        cat_4_end_date = cat_4_end.strftime('%m-%d-%Y')
-        cat_5_end_date = cat_5_end.strftime('%m-%d-%Y')
-        cat_6_end_date = cat_6_end.strftime('%m-%d-%Y')
-
-        ########### TOTAL PRICE AND AVERAGE SPENT ###########
-
-        # Unpacking the total price and average spent
-        total_food_price, avg_food_expenditures = expenditure_function(3, id, cat_3_start_date, cat_3_end_date)
-        total_groceries_price, avg_groceries_expenditures = expenditure_function(4, id, cat_4_start_date, cat_4_end_date)
-        total_clothing_price, avg_clothing_expenditures = expenditure_function(5, id, cat_5_start_date, cat_5_end_date)
-        total_entertainment_price, avg_entertainment_expenditures = expenditure_function(6, id, cat_6_start_date, cat_6_end_date)
-        total_travel_price, avg_travel_expenditures = expenditure_function(2, id, cat_2_start_date, cat_2_end_date)
-        total_online_purchase_price, avg_online_expenditures = expenditure_function(1, id, cat_1_start_date, cat_1_end_date)
-
-        total_price = (total_food_price + total_groceries_price + total_clothing_price +
-                       total_entertainment_price + total_travel_price +
-                       total_online_purchase_price)
-
-        ########### BUDGET ###########
-
-        # Calling the function for each of the expenditure categories
-        food_budget_minus_expenses = budget_totals(3, id, total_food_price)
-        online_budget_minus_expenses = budget_totals(1, id, total_online_purchase_price)
-        groceries_budget_minus_expenses = budget_totals(4, id, total_groceries_price)
-        clothing_budget_minus_expenses = budget_totals(5, id, total_clothing_price)
-        travel_budget_minus_expenses = budget_totals(2, id, total_travel_price)
-        entertainment_budget_minus_expenses = budget_totals(6, id, total_entertainment_price)
-
-        ############# PROGRESS BAR ##############
-
-        # Call get_progress in tools.py to calculate the progress bar totals
-        clothing_progress = get_progress(clothing_budget_minus_expenses, cat_5_budget)
-        online_progress = get_progress(online_budget_minus_expenses, cat_1_budget)
-        food_progress = get_progress(food_budget_minus_expenses, cat_3_budget)
-        groceries_progress = get_progress(groceries_budget_minus_expenses, cat_4_budget)
-        entertainment_progress = get_progress(entertainment_budget_minus_expenses, cat_6_budget)
-        travel_progress = get_progress(travel_budget_minus_expenses, cat_2_budget)
+        # This is the first page of the user's expenditures, newest first;
+        # the rest are loaded through /expenditures.json. The template only
+        # calls this when its cached ledger fragments are stale, and the rows
+        # and the Load more cursor share one query.
+        first_page = []
+
+        def expenditure_page():
+            if not first_page:
+                first_page.append(get_expenditure_page(id))
+
+            return first_page[0]
+
+        ########### BUDGETS, DATES, TOTALS, AVERAGES AND PROGRESS ###########
+
+        # Every category the app knows about
+        categories = registry.all()
+
+        # One grouped query in tools.py returns everything the widgets need
+        # for each category
+        dashboard_data = get_dashboard_data(id, [category.id for category in categories])
+
+        # One row per category for the widgets in dashboard.html
+        category_widgets = []
+
+        for category in categories:
+            category_data = dashboard_data[category.id]
+
+            category_widgets.append({
+                'id': category.id,
+                'name': category.name,
+                'budget': category_data['budget'],
+                # Strips datetime objects to year, month, day
+                'start_date': category_data['start_date'].strftime('%m-%d-%Y'),
+                'end_date': category_data['end_date'].strftime('%m-%d-%Y'),
+                'total': category_data['total'],
+                'avg': category_data['avg'],
+                'remaining': category_data['remaining'],
+                'progress': category_data['progress']
+            })
+
+        total_price = sum(category_widget['total'] for category_widget in category_widgets)
 
         # Renders the dashboard, which displays the following info
         return render_template("dashboard.html",
                                                 name=user.name,
-                                                password=user.password,
                                                 email=user.email,
-                                                expenditures=expenditures,
+                                                expenditure_page=expenditure_page,
                                                 id=id,
-                                                total_food_price=total_food_price,
-                                                total_travel_price=total_travel_price,
-                                                total_clothing_price=total_clothing_price,
-                                                total_entertainment_price=total_entertainment_price,
-                                                total_online_purchase_price=total_online_purchase_price,
-                                                total_groceries_price=total_groceries_price,
-                                                avg_online_expenditures=avg_online_expenditures,
-                                                avg_entertainment_expenditures=avg_entertainment_expenditures,
-                                                avg_clothing_expenditures=avg_clothing_expenditures,
-                                                avg_travel_expenditures=avg_travel_expenditures,
-                                                avg_groceries_expenditures=avg_groceries_expenditures,
-                                                avg_food_expenditures=avg_food_expenditures,
-                                                clothing_budget_minus_expenses=clothing_budget_minus_expenses,
-                                                travel_budget_minus_expenses=travel_budget_minus_expenses,
-                                                groceries_budget_minus_expenses=groceries_budget_minus_expenses,
-                                                food_budget_minus_expenses=food_budget_minus_expenses,
-                                                online_budget_minus_expenses=online_budget_minus_expenses,
-                                                entertainment_budget_minus_expenses=entertainment_budget_minus_expenses,
-                                                cat_1_budget=cat_1_budget,
-                                                cat_2_budget=cat_2_budget,
-                                                cat_3_budget=cat_3_budget,
-                                                cat_4_budget=cat_4_budget,
-                                                cat_5_budget=cat_5_budget,
-                                                cat_6_budget=cat_6_budget,
-                                                cat_1_start_date=cat_1_start_date,
-                                                cat_2_start_date=cat_2_start_date,
-                                                cat_3_start_date=cat_3_start_date,
-                                                cat_4_start_date=cat_4_start_date,
-                                                cat_5_start_date=cat_5_start_date,
-                                                cat_6_start_date=cat_6_start_date,
-                                                cat_1_end_date=cat_1_end_date,
-                                                cat_2_end_date=cat_2_end_date,
-                                                cat_3_end_date=cat_3_end_date,
-                                                cat_4_end_date=cat_4_end_date,
-                                                cat_5_end_date=cat_5_end_date,
-                                                cat_6_end_date=cat_6_end_date,
-                                                clothing_progress=clothing_progress,
-                                                entertainment_progress=entertainment_progress,
-                                                online_progress=online_progress,
-                                                food_progress=food_progress,
-                                                groceries_progress=groceries_progress,
-                                                travel_progress=travel_progress,
+                                                categories=category_widgets,
                                                 total_price=total_price,
                                                 user_hash=hash_result,
                                                 app_id=APP_ID)
 
 
+@app.route('/cache-stats.json')
+def cache_stats_data():
+    """ Report hits, misses and hit ratios for the per-user cache """
+
+    return jsonify(user_cache.stats())
+
+
+@app.route('/metrics')
+def metrics_data():
+    """ Report request, query and cache metrics for Prometheus """
+
+    return Response(instrumentation.metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/expenditures.json')
+@read_only
+@conditional
+def expenditures_data():
+    """ Return the next page of the user's expenditures for the ledger """
+
+    # Get the id of the user in the session
+    id = session.get('id')
+
+    if id is None:
+        abort(401)
+
+    # Continue from the cursor the previous page handed out
+    try:
+        expenditures, next_cursor = get_expenditure_page(id, request.args.get("cursor"))
+    except ValueError:
+        abort(400)
+
+    expenditures_info = {
+        'expenditures': [expenditure_to_dict(expenditure) for expenditure in expenditures],
+        'next_cursor': next_cursor
+    }
+
+    # Return jsonified info to load-more-expenditures.js
+    return jsonify(expenditures_info)
+
+
+@app.route('/export/expenditures.<export_format>')
+@read_only
+def export_expenditures_data(export_format):
+    """ Stream the user's expenditures as CSV or NDJSON. Takes optional
+    start and end dates, a category, and after=<id> to resume an export
+    after the last row received. """
+
+    # Get the id of the user in the session
+    id = session.get('id')
+
+    if id is None:
+        abort(401)
+
+    if export_format not in EXPORT_MIMETYPES:
+        abort(404)
+
+    # Compress as we go; the after_request hook skips streamed responses
+    compress = bool(request.accept_encodings['gzip'])
+
+    try:
+        chunks = export_expenditures(id, export_format,
+                                     start=request.args.get("start"),
+                                     end=request.args.get("end"),
+                                     category_id=request.args.get("category", type=int),
+                                     after_id=request.args.get("after", type=int),
+                                     compress=compress)
+    except ValueError:
+        abort(400)
+
+    # Keep the session and request context alive while the rows stream out
+    response = Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=expenditures.%s' % export_format
+
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+
+    return response
+
+
 @app.route('/remove-budget/<int:id>', methods=["POST"])
 def remove_budget(id):
     """ Remove a budget from the database """
@@ -473,6 +485,9 @@ def remove_budget(id):
         db.session.delete(budget_at_hand)
         db.session.commit()
 
+        # The user's cached data is out of date now
+        user_cache.invalidate(user_id)
+
     # Redirect the user to their dashboard
     return redirect(url_for('dashboard', id=user_id))
 
@@ -490,42 +505,21 @@ def add_budget():
     start_date = request.form.get("start-date")
     end_date = request.form.get("end-date")
 
-    user_budget_query = Budget.query.filter_by(budget_userid=id).all()
-
-    # Check for budgets in the database under the user ID in particular categories;
-    # delete budgets that exist to override them
-    # Check to see if you can modify it instead
-    for query in user_budget_query:
-        if query.category_id == category_id:
-            db.session.delete(query)
-            db.session.commit()
-
-    # Add the budget to the database. It will be the only budget for that
-    # category in the database for the user
-    new_budget = Budget(budget=budget,
-                        category_id=category_id,
-                        budget_userid=id,
-                        budget_start_date=start_date,
-                        budget_end_date=end_date)
-
-    # Insert the new budget into the budget table and commit the insert
-    db.session.add(new_budget)
+    # Replace the user's budget for this category, or add it if there isn't
+    # one, and total the spending in its window, in one transaction
+    budget_id, category_data = save_budget(id, category_id, budget, start_date, end_date)
     db.session.commit()
 
-    # Call functions in tools.py
-    total_cat_price, avg_cat_expenditures = expenditure_function(category_id, id, start_date, end_date)
-    cat_budget_minus_expenses = budget_totals(category_id, id, total_cat_price)
-
-    # Call get_progress in tools.py to calculate the progress bar totals
-    category_progress = get_progress(cat_budget_minus_expenses, budget)
+    # The user's cached data is out of date now
+    user_cache.invalidate(id)
 
     budget_info = {
-        'id': new_budget.id,
-        'category': new_budget.category.category,
+        'id': budget_id,
+        'category': registry.get(category_id).name,
         'category_id': category_id,
         'budget': budget,
-        'cat_budget_minus_expenses': cat_budget_minus_expenses,
-        'category_progress': category_progress
+        'cat_budget_minus_expenses': category_data['remaining'],
+        'category_progress': category_data['progress']
     }
 
     # Return jsonified budget info to submit-budget.js
@@ -542,14 +536,12 @@ def add_expenditure():
     # Get values from the form
     category_id = int(request.form.get("category"))
     price = request.form.get("price")
-    date_of_expenditure = request.form.get("date")
+    date_of_expenditure = parse_date(request.form.get("date"))
     where_bought = request.form.get("wherebought")
     description = request.form.get("description")
     tracking_num = request.form.get("tracking-num")
     tracking_num_carrier = request.form.get("tracking-num-carrier")
 
-    start_date, end_date = get_dates_for_budget(category_id, id)
-
     # Create a new expenditure object to insert into the expenditures table
     new_expenditure = Expenditure(category_id=category_id,
                                   price=price,
@@ -560,37 +552,155 @@ def add_expenditure():
                                   tracking_num=tracking_num,
                                   tracking_num_carrier=tracking_num_carrier)
 
-    # Insert the new expenditure into the expenditures table and commit the insert
+    # Insert the new expenditure into the expenditures table, add it to the
+    # daily spending rollup, and total the category's budget window, all in
+    # one transaction
     db.session.add(new_expenditure)
-    db.session.commit()
-
-    # Unpacking the function call
-    total_cat_price, avg_cat_expenditures = expenditure_function(category_id, id, start_date, end_date)
+    record_spending(id, category_id, date_of_expenditure, price)
+    db.session.flush()
 
-    budget_minus_expenses = budget_totals(category_id, id, total_cat_price)
-    cat_budget = get_budget_per_category(category_id, id)
-    category_progress = get_progress(budget_minus_expenses, cat_budget)
+    category_data = budget_summaries(id, [category_id])[category_id]
 
+    # Read everything the response needs before the commit expires it
     expenditure_info = {
-        'total_cat_price': total_cat_price,
-        'avg_cat_expenditures': avg_cat_expenditures,
+        'total_cat_price': category_data['total'],
+        'avg_cat_expenditures': category_data['avg'],
         'category_id': category_id,
         'expenditure_id': new_expenditure.id,
-        'date_of_expenditure': new_expenditure.date_of_expenditure.strftime('%Y-%m-%d'),
-        'where_bought': new_expenditure.where_bought,
-        'description': new_expenditure.description,
-        'price': str(new_expenditure.price),
-        'category': new_expenditure.category.category,
-        'tracking_num': new_expenditure.tracking_num,
-        'tracking_num_carrier': new_expenditure.tracking_num_carrier,
-        'cat_budget_minus_expenses': budget_minus_expenses,
-        'category_progress': category_progress
+        'date_of_expenditure': date_of_expenditure.strftime('%Y-%m-%d'),
+        'where_bought': where_bought,
+        'description': description,
+        'price': str(Decimal(price).quantize(Decimal('0.01'))),
+        'category': registry.get(category_id).name,
+        'tracking_num': tracking_num,
+        'tracking_num_carrier': tracking_num_carrier,
+        'cat_budget_minus_expenses': category_data['remaining'],
+        'category_progress': category_data['progress']
     }
 
+    db.session.commit()
+
+    # The user's cached data is out of date now
+    user_cache.invalidate(id)
+
     # Return jsonified info to submit-expenditure.js
     return jsonify(expenditure_info)
 
 
+def batch_entries(name):
+    """ Get the list of entries from a batch request's JSON body """
+
+    data = request.get_json(silent=True)
+
+    if not isinstance(data, dict):
+        return None
+
+    return data.get(name)
+
+
+@app.route('/expenditures/batch', methods=["POST"])
+def add_expenditures_batch():
+    """ Add a JSON list of expenditures in one transaction """
+
+    # Set the value of the user id of the user in the session
+    id = session.get('id')
+
+    if id is None:
+        abort(401)
+
+    # Nothing is written unless every entry is valid
+    try:
+        inserted, summaries = add_expenditures(id, batch_entries('expenditures'))
+    except BatchError as error:
+        db.session.rollback()
+        return jsonify({'errors': error.errors}), 400
+
+    db.session.commit()
+
+    # The user's cached data is out of date now
+    user_cache.invalidate(id)
+
+    batch_info = {
+        'inserted': inserted,
+        'categories': summaries_to_list(summaries)
+    }
+
+    return jsonify(batch_info)
+
+
+@app.route('/budgets/batch', methods=["POST"])
+def add_budgets_batch():
+    """ Add or replace a JSON list of budgets in one transaction """
+
+    # Set the value of the user id of the user in the session
+    id = session.get('id')
+
+    if id is None:
+        abort(401)
+
+    # Nothing is written unless every entry is valid
+    try:
+        summaries = add_budgets(id, batch_entries('budgets'))
+    except BatchError as error:
+        db.session.rollback()
+        return jsonify({'errors': error.errors}), 400
+
+    db.session.commit()
+
+    # The user's cached data is out of date now
+    user_cache.invalidate(id)
+
+    return jsonify({'categories': summaries_to_list(summaries)})
+
+
+@app.route('/import-expenditures', methods=["POST"])
+def import_expenditures():
+    """ Import a CSV or OFX statement of expenditures in the background """
+
+    # Set the value of the user id of the user in the session
+    id = session.get('id')
+
+    if id is None:
+        abort(401)
+
+    statement = request.files.get("statement")
+
+    if statement is None:
+        abort(400)
+
+    # Rows that don't name a known category go in this one
+    category_id = request.form.get("category")
+    default_category_id = int(category_id) if category_id else None
+
+    # Save the upload so the import can run after this request returns
+    file_descriptor, path = tempfile.mkstemp(suffix=os.path.splitext(statement.filename or "")[1])
+    os.close(file_descriptor)
+    statement.save(path)
+
+    job_id = start_import(app, id, path, statement_format(statement.filename), default_category_id)
+
+    import_info = {
+        'job_id': job_id,
+        'status_url': url_for('import_status', job_id=job_id)
+    }
+
+    # Return jsonified job info so the page can poll for progress
+    return jsonify(import_info), 202
+
+
+@app.route('/import-status/<job_id>')
+def import_status(job_id):
+    """ Report the progress of a statement import """
+
+    status = get_job_status(job_id)
+
+    # Users can only see their own imports
+    if status is None or status['user_id'] != session.get('id'):
+        abort(404)
+
+    return jsonify(status)
+
+
 @app.route('/remove-expenditure/<int:id>', methods=["POST"])
 def remove_expenditure(id):
     """ Remove an expenditure from the database """
@@ -598,10 +708,22 @@ def remove_expenditure(id):
     # This is the expenditure object we are working with
     expenditure_at_hand = Expenditure.query.filter_by(id=id).first()
 
-    # Deletes the expenditure item from the expenditure table
+    # This is the user the expenditure belongs to
+    owner_id = expenditure_at_hand.expenditure_userid
+
+    # Deletes the expenditure item from the expenditure table and takes it
+    # out of the daily spending rollup in the same transaction
     db.session.delete(expenditure_at_hand)
+    record_spending(owner_id,
+                    expenditure_at_hand.category_id,
+                    expenditure_at_hand.date_of_expenditure,
+                    -(expenditure_at_hand.price or 0),
+                    count=-1)
     db.session.commit()
 
+    # The owner's cached data is out of date now
+    user_cache.invalidate(owner_id)
+
     # Return jsonified id to delete-expenditure.js
     return jsonify({"expenditure_id": id})
 
@@ -619,62 +741,52 @@ def sign_up():
     # to the database, otherwise we will flash an error message
     email_login_query = User.query.filter_by(email=email).first()
 
-    # Check if user already exists
-    if email_login_query is None:
-
-        # If the user does not exist in the database, we add the user
-        new_user = User()
-
-        # Set the new user's name, email, and password
-        new_user.name = name
-        new_user.email = email
-        new_user.password = password
+    # Should the user already exist in the database, this will
+    # redirect them back to the homepage and flash a message that says
+    # a user with that information already exists
+    if email_login_query is not None:
 
-        # Add the new user to the session - this is a database insertion
-        db.session.add(new_user)
-        db.session.commit()
+        # Flash a message saying a user by this name already exists
+        flash('A user by this name already exists')
 
-        # Flash a message confirming the user has successfully signed up
-        flash('You have successfully signed up')
+        # Take the user back to the homepage
+        return redirect(url_for("index"))
 
-        return redirect(url_for('index'))
+    # If the user does not exist in the database, we add the user
+    new_user = User()
 
-    # Should the user already exist in the database, this will
-    # redirect them back to the homepage and flash a message that says
-    # a user with that information already exists
-    else:
-        user_existence_check = User.query.filter(
-                                                and_(
-                                                    User.email == email,
-                                                    User.password == password)).first()
+    # Set the new user's name, email, and hashed password
+    new_user.name = name
+    new_user.email = email
+    new_user.password = hash_password(password)
 
-        if user_existence_check:
+    # Add the new user to the session - this is a database insertion
+    db.session.add(new_user)
+    db.session.commit()
 
-            # Flash a message saying a user by this name already exists
-            flash('A user by this name already exists')
+    # Flash a message confirming the user has successfully signed up
+    flash('You have successfully signed up')
 
-            # Take the user back to the homepage
-            return redirect(url_for("index"))
+    return redirect(url_for('index'))
 
 
 @app.route('/login-form', methods=["POST"])
 def login_form():
     """ Login form """
 
-    # FIXME: login breaks if incorrect email but correct password
-    # login works with incorrect password
-
     # Gather information from the login form
     email = request.form.get("email")
     password = request.form.get("password")
 
-    # If either of these return None, the user will not be able to
-    # successfully log in
-    email_login_query = User.query.filter_by(email=email).first()
-    password_login_query = User.query.filter_by(password=password).first()
+    # One indexed lookup by email; the password is checked against its hash
+    user = User.query.filter_by(email=email).first()
+
+    # An unknown email still costs one hash, so it can't be told apart from
+    # a wrong password by timing
+    if user is None:
+        verify_password(password, DUMMY_HASH)
 
-    # Check if email_login_query is empty
-    if email_login_query is None and password_login_query is None:
+    if user is None or not verify_password(password, user.password):
 
         # Flash an error message if the login information provided by the user
         # does not match any records
@@ -684,28 +796,17 @@ def login_form():
         # or sign up if they haven't
         return redirect(url_for("index"))
 
-    # If the user logs in with the incorrect email an error message will flash
-    # and they will not be logged in
-    elif email_login_query is None:
-
-        flash('Error in logging in')
-
-        return redirect(url_for("index"))
-
-    # If the user logs in with the incorrect password an error message will flash
-    # and they will not be logged in
-    elif password_login_query is None:
-
-        flash('Error in logging in')
-
-        return redirect(url_for("index"))
+    # Plaintext passwords from before hashing, and hashes made at a lower
+    # cost, are upgraded now that we have the password
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.session.commit()
 
-    else:
-        # Put the id into the session
-        session['id'] = email_login_query.id
+    # Put the id into the session
+    session['id'] = user.id
 
-        # Take the user to the dashboard page, using their id
-        return redirect(url_for('dashboard', id=session['id']))
+    # Take the user to the dashboard page, using their id
+    return redirect(url_for('dashboard', id=session['id']))
 
 
 @app.route('/logout', methods=["GET"])
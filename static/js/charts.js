@@ -1,4 +1,3 @@
-
 // Charts are from chart.js
 
 function charts() {
@@ -8,22 +7,22 @@ function charts() {
   };
 
   var ctx_donut = $("#donutChart").get(0).getContext("2d");
+  var ctx_line = $("#barChart").get(0).getContext("2d");
 
-  // Gets info from this route in server.py and sends to the donut chart
-  $.get("/expenditure-types.json", function (data) {
-    var myDonutChart = new Chart(ctx_donut).Doughnut(data.expenditures, options);
-    $('#donutLegend').html(myDonutChart.generateLegend());
-  });
+  // Gets the info for both charts from this route in server.py, which
+  // computes the totals and averages once
+  $.get("/dashboard-stats.json", function (data) {
 
-  var ctx_line = $("#barChart").get(0).getContext("2d");
+    // Donut chart
+    var myDonutChart = new Chart(ctx_donut).Doughnut(data.donut.expenditures, options);
+    $('#donutLegend').html(myDonutChart.generateLegend());
 
-  // Gets info from this route in server.py and sends to the bar chart
-  $.get("/total-spent.json", function (data) {
-    var myBarChart = new Chart(ctx_line).Bar(data, options);
+    // Bar chart
+    var myBarChart = new Chart(ctx_line).Bar(data.bar, options);
     $("#BarLegend").html(myBarChart.generateLegend());
   });
 
 }
 
 // Call the function so the charts display upon page load
-charts();
\ No newline at end of file
+charts();
@@ -35,5 +35,6 @@ function deleteExpenditure(evt) {
     console.log("ran deleteExpenditure");
 }
 
-// When this button is pressed, call the deleteExpenditure function
-$(".delete-expenditure").click(deleteExpenditure);
\ No newline at end of file
+// When this button is pressed, call the deleteExpenditure function; the
+// handler is delegated so rows added by "Load more" are covered too
+$("#table-expenditure-table").on("click", ".delete-expenditure", deleteExpenditure);
\ No newline at end of file
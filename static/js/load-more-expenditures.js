@@ -0,0 +1,70 @@
+"use strict";
+
+function buildExpenditureRow(expenditure) {
+  // This function builds a ledger row the same way dashboard.html does
+
+  var row = $('<tr>').attr('id', 'expenditure-row-' + String(expenditure.expenditure_id));
+
+  row.append($('<th scope="row">').text(expenditure.category));
+  row.append($('<td>').text('$' + String(expenditure.price)));
+  row.append($('<td>').text(expenditure.date_of_expenditure));
+  row.append($('<td>').text(expenditure.where_bought || ''));
+  row.append($('<td>').text(expenditure.description || ''));
+
+  // If a tracking number exists, add the tracking button
+  var trackingCell = $('<td>');
+
+  if (expenditure.tracking_num) {
+    var trackingForm = $('<form method="POST" class="tracking-form">')
+      .attr('action', '/tracking/' + String(expenditure.tracking_num));
+    var trackingButton = $('<button type="submit" class="btn btn-lg btn-custom submit-tracking" ' +
+      'aria-label="Left Align" data-toggle="modal" data-target="#trackingModal">')
+      .attr('data-trackingnum', expenditure.tracking_num)
+      .append('<span class="glyphicon glyphicon-send" aria-hidden="true"></span>');
+    trackingCell.append(trackingForm.append(trackingButton));
+  }
+
+  row.append(trackingCell);
+
+  // Add the remove button
+  var removeForm = $('<form method="POST">')
+    .attr('action', '/remove-expenditure/' + String(expenditure.expenditure_id))
+    .attr('id', 'expenditure-' + String(expenditure.expenditure_id));
+  var removeButton = $('<button type="submit" class="btn btn-lg btn-custom delete-expenditure" aria-label="Left Align">')
+    .attr('data-expenditureid', expenditure.expenditure_id)
+    .append($('<span class="glyphicon glyphicon-minus-sign" aria-hidden="true">')
+      .attr('data-expenditureid', expenditure.expenditure_id));
+
+  row.append($('<td>').append(removeForm.append(removeButton)));
+
+  return row;
+}
+
+function appendExpenditurePage(result) {
+  // This function appends the next page of expenditures to the ledger
+
+  var tableBody = $('#table-expenditure-table tbody');
+
+  $.each(result.expenditures, function (index, expenditure) {
+    tableBody.append(buildExpenditureRow(expenditure));
+  });
+
+  // Point the button at the following page, or hide it on the last one
+  if (result.next_cursor) {
+    $('#load-more-expenditures').data('cursor', result.next_cursor);
+  } else {
+    $('#load-more-expenditures').hide();
+  }
+}
+
+function loadMoreExpenditures(evt) {
+  evt.preventDefault();
+
+  var cursor = $('#load-more-expenditures').data('cursor');
+
+  // Get the next page from this route in server.py
+  $.get("/expenditures.json", {"cursor": cursor}, appendExpenditurePage);
+}
+
+// Event listener
+$("#load-more-expenditures").on("click", loadMoreExpenditures);
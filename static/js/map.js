@@ -123,4 +123,5 @@ function updateAddress(evt) {
     console.log("Finished sending AJAX");
     }
 
-$('.submit-tracking').click(updateAddress);
\ No newline at end of file
+// Delegated so rows added by "Load more" are covered too
+$('#table-expenditure-table').on('click', '.submit-tracking', updateAddress);
\ No newline at end of file
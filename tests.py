@@ -2,8 +2,96 @@ import unittest
 
 from datetime import datetime
 
+import server
 from server import app
-from model import db, connect_to_db, User, example_data, Budget, Expenditure
+from model import db, connect_to_db, User, example_data, Budget, Expenditure, DailySpending, Category, TrackingStatus, BudgetStatus, ImportJob
+from rollup import rebuild_rollup
+from categories import registry
+import charts
+from cache import user_cache, UserDataCache, ExternalCache, LocalStore, LRUCache, check_workers
+from tracking import TrackingClient
+from tracking_poller import poll_once, pending_packages
+from seed import bulk_load, EXPENDITURE_COLUMNS
+from budget_status import refresh_budget_statuses, users_over_budget
+import importer
+from importer import import_statement, import_rows
+from passwords import hash_password, verify_password
+from tools import get_dashboard_data, expenditure_aggregates, expenditure_function, get_expenditure_page
+
+from decimal import Decimal
+
+import gzip
+
+from StringIO import StringIO
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import threading
+
+import tempfile
+
+import os
+
+import json
+
+import migrations
+
+import instrumentation
+
+import routing
+
+import assets
+
+import time
+
+from sqlalchemy import create_engine, inspect, event
+
+
+class FakeShippoHandler(BaseHTTPRequestHandler):
+    """ Answers /tracks/<carrier>/<number>/ like Shippo does """
+
+    # Tracking number -> status, and a log of the paths requested
+    statuses = {}
+    requests_seen = []
+
+    def do_GET(self):
+        self.requests_seen.append(self.path)
+        tracking_num = self.path.strip("/").split("/")[-1]
+        status = self.statuses.get(tracking_num, "TRANSIT")
+
+        # A status of None answers with an error page instead of JSON
+        if status is None:
+            body = "<html>Service Unavailable</html>"
+        else:
+            body = json.dumps({
+                'tracking_status': {
+                    'status': status,
+                    'location': {'city': "Oakland", 'state': "CA", 'zip': "94612", 'country': "US"}
+                }
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_shippo():
+    """ Run the fake Shippo API on a free local port """
+
+    FakeShippoHandler.statuses = {}
+    FakeShippoHandler.requests_seen = []
+
+    fake_shippo = HTTPServer(("127.0.0.1", 0), FakeShippoHandler)
+    thread = threading.Thread(target=fake_shippo.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return fake_shippo, "http://127.0.0.1:%s" % fake_shippo.server_port
 
 
 class SpentDatabaseTests(unittest.TestCase):
@@ -16,6 +104,9 @@ class SpentDatabaseTests(unittest.TestCase):
         app.config['SECRET_KEY'] = 'key123'
         self.client = app.test_client()
 
+        # Start every test with an empty per-user cache
+        user_cache.clear()
+
         # Connect to test database (uncomment when testing database)
         connect_to_db(app, "postgresql:///testdb")
 
@@ -245,5 +336,1029 @@ class SpentDatabaseTests(unittest.TestCase):
         self.assertIn("1", result.data)
 
 
+    def test_dashboard_data_grouped_query(self):
+        """ Test that the dashboard data matches the budget window totals """
+
+        # Add two expenditures inside the food budget window and one outside
+        user = User.query.filter_by(email="mu@mu.com").first()
+
+        db.session.add_all([
+            Expenditure(category_id=3, price=20, date_of_expenditure="2016-05-10",
+                        expenditure_userid=user.id),
+            Expenditure(category_id=3, price=30, date_of_expenditure="2016-06-01",
+                        expenditure_userid=user.id),
+            Expenditure(category_id=3, price=99, date_of_expenditure="2016-07-01",
+                        expenditure_userid=user.id)])
+        db.session.commit()
+        rebuild_rollup(user.id)
+
+        dashboard_data = get_dashboard_data(user.id, [1, 2, 3, 4, 5, 6])
+
+        # The food budget only counts the two expenditures in its window
+        self.assertEqual(dashboard_data[3]['total'], 50.0)
+        self.assertEqual(dashboard_data[3]['avg'], 25.0)
+        self.assertEqual(dashboard_data[3]['remaining'], 950.0)
+        self.assertEqual(dashboard_data[3]['progress'], "95.0")
+
+        # Categories without a budget show nothing spent
+        self.assertEqual(dashboard_data[2]['total'], 0.0)
+        self.assertEqual(dashboard_data[2]['budget'], 0)
+
+
+    def test_expenditure_aggregates(self):
+        """ Test that totals and averages are computed in the database """
+
+        user = User.query.filter_by(email="mu@mu.com").first()
+
+        db.session.add_all([
+            Expenditure(category_id=3, price="10.10", date_of_expenditure="2016-05-10",
+                        expenditure_userid=user.id),
+            Expenditure(category_id=3, price="10.20", date_of_expenditure="2016-05-11",
+                        expenditure_userid=user.id)])
+        db.session.commit()
+        rebuild_rollup(user.id)
+
+        total, avg, count = expenditure_aggregates(3, user.id, "2016-05-01", "2016-05-31")
+
+        # Decimal math stays exact
+        self.assertEqual(total, Decimal("20.30"))
+        self.assertEqual(avg, Decimal("10.15"))
+        self.assertEqual(count, 2)
+
+        # The float contract of expenditure_function is unchanged
+        self.assertEqual(expenditure_function(3, user.id, "2016-05-01", "2016-05-31"), (20.3, 10.15))
+        self.assertEqual(expenditure_function(4, user.id, "2016-05-01", "2016-05-31"), (0.0, 0.0))
+
+
+    def test_migrations_upgrade(self):
+        """ Test that migrations apply once and are recorded """
+
+        try:
+            # Tables from create_all already have the indexes, so this only
+            # records the versions
+            applied = migrations.upgrade(db.engine)
+            self.assertEqual(applied, [version for version, description, migration
+                                       in migrations.MIGRATIONS])
+
+            # The indexes later migrations replaced are gone again
+            index_names = set(index['name'] for table in ['users', 'budget']
+                              for index in inspect(db.engine).get_indexes(table))
+            self.assertIn('ix_users_email', index_names)
+            self.assertNotIn('ix_users_password', index_names)
+            self.assertNotIn('ix_budget_userid_category_id', index_names)
+
+            # Running it again has nothing left to do
+            self.assertEqual(migrations.upgrade(db.engine), [])
+            self.assertTrue(all(is_applied for version, description, is_applied
+                                in migrations.status(db.engine)))
+
+        finally:
+            db.engine.execute("DROP TABLE IF EXISTS %s" % migrations.SCHEMA_MIGRATIONS_TABLE)
+
+
+    def test_rollup_follows_add_and_remove(self):
+        """ Test that adding and removing expenditures keeps the rollup current """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        for price in ["12.50", "7.50"]:
+            self.client.post("/add-expenditure-to-db", data=dict(
+                category=3,
+                price=price,
+                date="2016-05-20",
+                where_bought="Market",
+                description="groceries"))
+
+        rollup = DailySpending.query.filter_by(category_id=3).one()
+        self.assertEqual(rollup.total, Decimal("20.00"))
+        self.assertEqual(rollup.count, 2)
+
+        # Removing one takes it back out of the day's row
+        expenditure = Expenditure.query.filter_by(category_id=3).first()
+        self.client.post("/remove-expenditure/" + str(expenditure.id))
+
+        rollup = DailySpending.query.filter_by(category_id=3).one()
+        self.assertEqual(rollup.count, 1)
+
+        # A rebuild from the expenditures table agrees with the running total
+        running_total = rollup.total
+        rebuild_rollup()
+        self.assertEqual(DailySpending.query.filter_by(category_id=3).one().total, running_total)
+
+    def test_rebuild_rollup_skips_incomplete_rows(self):
+        """ Test that undated and unpriced expenditures don't break a rebuild """
+
+        db.session.add_all([
+            Expenditure(category_id=3, price=10, expenditure_userid=1, date_of_expenditure=None),
+            Expenditure(category_id=3, price=None, expenditure_userid=1,
+                        date_of_expenditure="2016-05-20"),
+            Expenditure(category_id=None, price=5, expenditure_userid=1,
+                        date_of_expenditure="2016-05-20")])
+        db.session.commit()
+
+        rebuild_rollup()
+
+        rollup = DailySpending.query.filter_by(spending_userid=1).one()
+        self.assertEqual((rollup.category_id, rollup.total, rollup.count), (3, Decimal("0.00"), 1))
+
+    def test_remove_expenditure_without_price(self):
+        """ Test that an expenditure with no price can be removed """
+
+        expenditure = Expenditure(category_id=3, price=None, expenditure_userid=1,
+                                  date_of_expenditure="2016-05-20")
+        db.session.add(expenditure)
+        db.session.commit()
+
+        result = self.client.post("/remove-expenditure/%s" % expenditure.id)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(Expenditure.query.filter_by(id=expenditure.id).count(), 0)
+
+
+    def test_expenditure_ledger_pages(self):
+        """ Test that the ledger pages through expenditures newest first """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        user = User.query.filter_by(email="mu@mu.com").first()
+
+        # Two expenditures share a date so the id breaks the tie
+        for date in ["2016-05-01", "2016-05-03", "2016-05-03"]:
+            db.session.add(Expenditure(category_id=3, price=10, date_of_expenditure=date,
+                                       expenditure_userid=user.id))
+        db.session.commit()
+
+        first_page, cursor = get_expenditure_page(user.id, limit=2)
+        self.assertEqual([expenditure.date_of_expenditure.day for expenditure in first_page], [3, 3])
+        self.assertTrue(first_page[0].id > first_page[1].id)
+
+        # The JSON endpoint continues after the cursor and ends the ledger
+        result = self.client.get("/expenditures.json?cursor=" + cursor)
+        page = json.loads(result.data)
+
+        self.assertEqual([expenditure['date_of_expenditure'] for expenditure in page['expenditures']],
+                         ["2016-05-01"])
+        self.assertEqual(page['expenditures'][0]['category'], "Food")
+        self.assertIsNone(page['next_cursor'])
+
+        # A garbled cursor is rejected
+        self.assertEqual(self.client.get("/expenditures.json?cursor=nope").status_code, 400)
+
+    def test_expenditure_ledger_pages_undated(self):
+        """ Test that undated expenditures are paged after the dated ones """
+
+        user = User.query.filter_by(email="mu@mu.com").first()
+
+        for date in ["2016-05-01", None, None]:
+            db.session.add(Expenditure(category_id=3, price=10, date_of_expenditure=date,
+                                       expenditure_userid=user.id))
+        db.session.commit()
+
+        first_page, cursor = get_expenditure_page(user.id, limit=2)
+        second_page, last_cursor = get_expenditure_page(user.id, cursor, limit=2)
+
+        self.assertEqual([expenditure.date_of_expenditure for expenditure in first_page][1], None)
+        self.assertEqual(first_page[0].date_of_expenditure.day, 1)
+        self.assertEqual(len(second_page), 1)
+        self.assertIsNone(second_page[0].date_of_expenditure)
+        self.assertTrue(first_page[1].id > second_page[0].id)
+        self.assertIsNone(last_cursor)
+
+
+    def test_category_registry_follows_categories_table(self):
+        """ Test that new categories show up on the dashboard and charts """
+
+        self.assertEqual([category.name for category in registry.all()], ["Food", "Travel"])
+
+        # Adding a category refreshes the registry in this process
+        db.session.add(Category(id=7, category="Pets"))
+        db.session.commit()
+
+        self.assertEqual(registry.get(7).name, "Pets")
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        result = self.client.get("/dashboard/1")
+        self.assertIn('id="budget-7"', result.data)
+
+        # The dashboard lists categories by name, the charts in their
+        # original orders with new categories last
+        self.assertTrue(result.data.index('id="budget-3"') < result.data.index('id="budget-7"')
+                        < result.data.index('id="budget-2"'))
+
+        chart = json.loads(self.client.get("/total-spent.json").data)
+        self.assertEqual(chart['labels'], ["Food", "Travel", "Pets"])
+
+        donut = json.loads(self.client.get("/expenditure-types.json").data)
+        self.assertEqual([slice['label'] for slice in donut['expenditures']],
+                         ["Travel", "Food", "Pets"])
+
+
+    def test_dashboard_stats_combines_charts(self):
+        """ Test that the combined stats match the two chart routes """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        self.client.post("/add-expenditure-to-db", data=dict(
+            category=3,
+            price=40,
+            date=datetime.now(),
+            where_bought="Whole Foods",
+            description="groceries and stuff"))
+
+        stats = json.loads(self.client.get("/dashboard-stats.json").data)
+
+        self.assertEqual(stats['bar'], json.loads(self.client.get("/total-spent.json").data))
+        self.assertEqual(stats['donut'], json.loads(self.client.get("/expenditure-types.json").data))
+
+        # Food comes first in the bar chart, and the new expenditure is counted
+        self.assertEqual(stats['bar']['datasets'][0]['data'][0], 40.0)
+
+
+    def test_cache_invalidated_by_writes(self):
+        """ Test that chart data is cached until the user adds an expenditure """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        first = json.loads(self.client.get("/dashboard-stats.json").data)
+        second = json.loads(self.client.get("/dashboard-stats.json").data)
+        self.assertEqual(first, second)
+        self.assertEqual(user_cache.stats()['get_chart_stats']['hits'], 1)
+
+        self.client.post("/add-expenditure-to-db", data=dict(
+            category=3,
+            price=40,
+            date=datetime.now(),
+            where_bought="Whole Foods",
+            description="groceries and stuff"))
+
+        # The write moved the user to a new version, so this is recomputed
+        third = json.loads(self.client.get("/dashboard-stats.json").data)
+        self.assertEqual(third['bar']['datasets'][0]['data'][0], 40.0)
+
+    def test_cached_charts_follow_the_date(self):
+        """ Test that cached chart data moves with the 30 day window """
+
+        db.session.add(Expenditure(category_id=3, price=40, date_of_expenditure="2016-05-20",
+                                   expenditure_userid=1))
+        db.session.commit()
+        rebuild_rollup(1)
+
+        # Long outside today's window
+        self.assertEqual(charts.get_chart_stats(1)['bar']['datasets'][0]['data'][0], 0.0)
+
+        class June(datetime):
+            @classmethod
+            def today(cls):
+                return datetime(2016, 6, 1)
+
+        # A new day is a new window, without any write from the user
+        charts.datetime = June
+
+        try:
+            self.assertEqual(charts.get_chart_stats(1)['bar']['datasets'][0]['data'][0], 40.0)
+        finally:
+            charts.datetime = datetime
+
+    def test_cache_backends(self):
+        """ Test the LRU backend and the external backend stand-in """
+
+        lru = LRUCache(max_size=2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+
+        # "b" was the least recently used
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), 1)
+
+        cache = UserDataCache(ExternalCache(LocalStore()))
+        compute = lambda: {'total': Decimal("1.50")}
+
+        self.assertEqual(cache.get_or_compute(1, "totals", (), compute), {'total': Decimal("1.50")})
+        cache.get_or_compute(1, "totals", (), compute)
+        cache.get_or_compute(2, "totals", (), compute)
+
+        # Invalidating one user leaves the other's entries alone
+        cache.invalidate(1)
+        cache.get_or_compute(1, "totals", (), compute)
+        cache.get_or_compute(2, "totals", (), compute)
+
+        self.assertEqual(cache.stats()['totals'], {'hits': 2, 'misses': 3, 'hit_ratio': 0.4})
+
+        # Several workers can't share a per-process cache
+        self.assertRaises(RuntimeError, check_workers, 2, "memory://")
+        check_workers(1, "memory://")
+        check_workers(4, "redis://localhost:6379/0")
+
+
+    def test_conditional_get(self):
+        """ Test that unchanged data gets a 304 and changed data a fresh 200 """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        result = self.client.get("/dashboard-stats.json")
+        etag = result.headers['ETag']
+
+        result = self.client.get("/dashboard-stats.json", headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+
+        self.client.post("/add-expenditure-to-db", data=dict(
+            category=3,
+            price=40,
+            date=datetime.now(),
+            where_bought="Whole Foods",
+            description="groceries and stuff"))
+
+        # A write moves the user to a new data version
+        result = self.client.get("/dashboard-stats.json", headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result.headers['ETag'], etag)
+
+    def test_dashboard_gzip(self):
+        """ Test that the dashboard is gzipped when the client accepts it """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        result = self.client.get("/dashboard/1", headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertIn("Account", gzip.GzipFile(fileobj=StringIO(result.data)).read())
+
+    def test_dashboard_fragments_cached(self):
+        """ Test that dashboard fragments are reused until the user writes """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"))
+
+        first = self.client.get("/dashboard/1").data
+        second = self.client.get("/dashboard/1").data
+        self.assertEqual(first, second)
+        self.assertEqual(user_cache.stats()['fragment:ledger']['hits'], 1)
+        self.assertEqual(user_cache.stats()['fragment:ledger-cursor']['hits'], 1)
+        self.assertEqual(user_cache.stats()['fragment:budgets']['hits'], 1)
+
+        self.client.post("/add-expenditure-to-db", data=dict(
+            category=3,
+            price=40,
+            date=datetime.now(),
+            where_bought="Whole Foods",
+            description="new groceries"))
+
+        # The write moved the user to a new version, so the ledger is rebuilt
+        self.assertIn("new groceries", self.client.get("/dashboard/1").data)
+
+        # So does renaming a category the ledger shows
+        Category.query.get(3).category = "Groceries"
+        db.session.commit()
+
+        self.assertIn('<th scope="row">Groceries</th>', self.client.get("/dashboard/1").data)
+
+
+    def test_tracking_client_caches_by_status(self):
+        """ Test that delivered packages stay cached and moving ones expire """
+
+        fake_shippo, base_url = start_fake_shippo()
+
+        try:
+            FakeShippoHandler.statuses["DONE1"] = "DELIVERED"
+            client = TrackingClient(base_url=base_url, in_transit_ttl=0, final_ttl=3600)
+
+            for i in range(3):
+                client.track("usps", "DONE1")
+                client.track("usps", "MOVING1")
+
+            # One lookup for the delivered package, three for the moving one
+            self.assertEqual(FakeShippoHandler.requests_seen.count("/tracks/usps/DONE1/"), 1)
+            self.assertEqual(FakeShippoHandler.requests_seen.count("/tracks/usps/MOVING1/"), 3)
+
+        finally:
+            fake_shippo.shutdown()
+
+    def test_tracking_route(self):
+        """ Test that the tracking route returns the package location """
+
+        fake_shippo, base_url = start_fake_shippo()
+        original_client = server.tracking_client
+        server.tracking_client = TrackingClient(base_url=base_url)
+
+        try:
+            db.session.add(Expenditure(category_id=3, price=10, date_of_expenditure="2016-05-01",
+                                       tracking_num="9400", tracking_num_carrier="usps"))
+            db.session.commit()
+
+            result = self.client.post("/tracking/9400")
+            self.assertEqual(json.loads(result.data)['city'], "Oakland")
+
+            self.assertEqual(self.client.post("/tracking/unknown").status_code, 404)
+
+            # A body that isn't JSON is a bad gateway, and isn't cached
+            FakeShippoHandler.statuses["9401"] = None
+            db.session.add(Expenditure(category_id=3, price=10, date_of_expenditure="2016-05-01",
+                                       tracking_num="9401", tracking_num_carrier="usps"))
+            db.session.commit()
+
+            self.assertEqual(self.client.post("/tracking/9401").status_code, 502)
+            self.assertEqual(self.client.post("/tracking/9401").status_code, 502)
+            self.assertEqual(FakeShippoHandler.requests_seen.count("/tracks/usps/9401/"), 2)
+
+        finally:
+            server.tracking_client = original_client
+            fake_shippo.shutdown()
+
+
+    def test_tracking_poller(self):
+        """ Test that the poller stores statuses and stops polling delivered packages """
+
+        fake_shippo, base_url = start_fake_shippo()
+        client = TrackingClient(base_url=base_url)
+
+        try:
+            FakeShippoHandler.statuses["DONE1"] = "DELIVERED"
+
+            for tracking_num in ["DONE1", "MOVING1", "MOVING2"]:
+                db.session.add(Expenditure(category_id=3, price=10, date_of_expenditure=datetime.now(),
+                                           tracking_num=tracking_num, tracking_num_carrier="ups"))
+            db.session.commit()
+
+            self.assertEqual(poll_once(client, concurrency=2), (3, 0))
+            self.assertEqual(TrackingStatus.query.filter_by(tracking_num="DONE1").one().status, "DELIVERED")
+
+            # The delivered package isn't polled again
+            self.assertEqual(poll_once(client, concurrency=2), (2, 0))
+
+            # The route answers from the table without calling Shippo
+            requests_before = len(FakeShippoHandler.requests_seen)
+            result = self.client.post("/tracking/MOVING1")
+
+            self.assertEqual(json.loads(result.data)['tracking_status'], "TRANSIT")
+            self.assertEqual(len(FakeShippoHandler.requests_seen), requests_before)
+
+        finally:
+            fake_shippo.shutdown()
+
+
+    def test_tracking_poller_gives_up(self):
+        """ Test that old packages and unknown tracking numbers stop being polled """
+
+        fake_shippo, base_url = start_fake_shippo()
+        client = TrackingClient(base_url=base_url)
+
+        try:
+            FakeShippoHandler.statuses["BAD1"] = "UNKNOWN"
+
+            db.session.add(Expenditure(category_id=3, price=10, date_of_expenditure="2016-05-01",
+                                       tracking_num="OLD1", tracking_num_carrier="ups"))
+            for tracking_num in ["BAD1", "MOVING1"]:
+                db.session.add(Expenditure(category_id=3, price=10, date_of_expenditure=datetime.now(),
+                                           tracking_num=tracking_num, tracking_num_carrier="ups"))
+            db.session.commit()
+
+            # The old package isn't polled at all
+            self.assertEqual(poll_once(client), (2, 0))
+            self.assertEqual(TrackingStatus.query.get(("ups", "BAD1")).failures, 1)
+            self.assertEqual(TrackingStatus.query.get(("ups", "MOVING1")).failures, 0)
+
+            poll_once(client)
+            self.assertEqual(sorted(num for carrier, num, failures in pending_packages(max_failures=2)),
+                             ["MOVING1"])
+
+        finally:
+            fake_shippo.shutdown()
+            fake_shippo.server_close()
+
+        # With Shippo down, every lookup fails and none of them count
+        self.assertEqual(poll_once(client), (0, 2))
+        self.assertEqual(TrackingStatus.query.get(("ups", "MOVING1")).failures, 0)
+
+
+    def test_seed_bulk_load(self):
+        """ Test that seed files load in committed chunks """
+
+        seed_file = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+        seed_file.write("101|3|14.00|2016-04-07|1|Whole Foods|food for the week||\n"
+                        "102|3|20.00|2016-04-08|1|Amazon|new \"leash\"||\n"
+                        "\n"
+                        "103|2|60.50|2016-04-09|1|Forever21|cool new shirt|9400|usps")
+        seed_file.close()
+
+        try:
+            bulk_load(Expenditure, seed_file.name, EXPENDITURE_COLUMNS, chunk_size=2)
+        finally:
+            os.remove(seed_file.name)
+
+        self.assertEqual(Expenditure.query.filter(Expenditure.id > 100).count(), 3)
+        self.assertEqual(Expenditure.query.get(102).description, 'new "leash"')
+        self.assertEqual(Expenditure.query.get(103).tracking_num, "9400")
+
+
+    def test_metrics(self):
+        """ Test that requests are counted per route with their queries """
+
+        instrumentation.metrics.reset()
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        self.client.get("/total-spent.json")
+
+        result = self.client.get("/metrics")
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('spent_http_requests_total{route="budget_types_data",method="GET",status="200"} 1',
+                      result.data)
+        self.assertIn('spent_http_request_duration_seconds_count{route="dashboard"} 1', result.data)
+        self.assertIn('spent_db_queries_total{route="budget_types_data"} 1', result.data)
+        self.assertIn('spent_cache_requests_total{name="get_chart_stats",result="miss"} 1', result.data)
+
+    def test_slow_query_log_redacts_parameters(self):
+        """ Test that slow queries are logged without their values """
+
+        log_output = StringIO()
+        handler = instrumentation.logging.StreamHandler(log_output)
+        instrumentation.slow_query_log.addHandler(handler)
+
+        slow_query_ms = instrumentation.SLOW_QUERY_MS
+        instrumentation.SLOW_QUERY_MS = 0
+
+        try:
+            User.query.filter_by(email="mu@mu.com").first()
+        finally:
+            instrumentation.SLOW_QUERY_MS = slow_query_ms
+            instrumentation.slow_query_log.removeHandler(handler)
+
+        self.assertIn("Slow query", log_output.getvalue())
+        self.assertIn("users.email", log_output.getvalue())
+        self.assertNotIn("mu@mu.com", log_output.getvalue())
+
+
+    def test_read_replica_routing(self):
+        """ Test that read-only routes read from the replica until the user
+        writes """
+
+        replica_path = tempfile.mktemp(suffix=".db")
+        replica_engine = create_engine("sqlite:///" + replica_path)
+
+        # A replica that has a different expenditure than the primary
+        db.metadata.create_all(replica_engine)
+        replica_engine.execute(User.__table__.insert(), id=1, name="Mu", email="mu@mu.com",
+                               password="mu")
+        replica_engine.execute(Category.__table__.insert(), id=3, category="Food")
+        replica_engine.execute(Expenditure.__table__.insert(), id=1, category_id=3, price=5,
+                               date_of_expenditure=datetime(2016, 5, 8),
+                               expenditure_userid=1, where_bought="replica",
+                               description="from the replica")
+
+        # Hashed already, so logging in doesn't write
+        User.query.get(1).password = hash_password("mu")
+        db.session.commit()
+
+        app.config['SQLALCHEMY_BINDS'] = routing.replica_binds(["sqlite:///" + replica_path])
+
+        try:
+            # Log in a test client
+            self.client.post("/login-form", data=dict(
+                email="mu@mu.com",
+                password="mu"), follow_redirects=True)
+
+            result = self.client.get("/expenditures.json")
+            self.assertIn("from the replica", result.data)
+
+            self.client.post("/add-expenditure-to-db", data=dict(
+                category=3,
+                price=40,
+                date=datetime.now(),
+                where_bought="Whole Foods",
+                description="groceries and stuff"))
+
+            # Right after a write the user's reads come from the primary
+            result = self.client.get("/expenditures.json")
+            self.assertIn("groceries and stuff", result.data)
+            self.assertNotIn("from the replica", result.data)
+        finally:
+            app.config['SQLALCHEMY_BINDS'] = {}
+            db.session.close()
+            replica_engine.dispose()
+            os.remove(replica_path)
+
+
+    def test_direct_writes_keep_reads_on_primary(self):
+        """ Test that writes run with session.execute start the read-your-writes
+        window like flushed ones """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        def read_primary_until():
+            with self.client.session_transaction() as client_session:
+                return client_session.pop('read_primary_until', 0)
+
+        read_primary_until()
+
+        self.client.post("/add-budget", data={
+            'budget': 300,
+            'category': 3,
+            'start-date': "2016-05-01",
+            'end-date': "2016-05-31"})
+        self.assertGreater(read_primary_until(), time.time())
+
+        self.client.post("/expenditures/batch", content_type="application/json",
+                         data=json.dumps({'expenditures': [
+                             {'client_id': "a", 'category_id': 3, 'price': "12.50",
+                              'date': "2016-05-20"}]}))
+        self.assertGreater(read_primary_until(), time.time())
+
+
+    def test_import_statement(self):
+        """ Test that statements import once, with the rollup refreshed """
+
+        statement = ("Date,Description,Amount,Category\n"
+                     "05/08/2016,Coffee,-3.50,Food\n"
+                     "05/08/2016,Coffee,-3.50,Food\n"
+                     "05/09/2016,Train,-20.00,Travel\n"
+                     "not a date,Broken,-1.00,Food\n")
+
+        counts = import_statement(1, StringIO(statement))
+        self.assertEqual(counts, {'imported': 3, 'duplicates': 0, 'skipped': 1})
+
+        # Importing the same statement again adds nothing
+        counts = import_statement(1, StringIO(statement))
+        self.assertEqual(counts, {'imported': 0, 'duplicates': 3, 'skipped': 1})
+
+        total, avg, count = expenditure_aggregates(3, 1, "2016-05-01", "2016-05-31")
+        self.assertEqual((total, count), (Decimal('7.00'), 2))
+
+    def test_import_csv_skips_credits(self):
+        """ Test that CSV refunds are skipped like OFX credits """
+
+        statement = ("Date,Description,Amount\n"
+                     "05/08/2016,Coffee,-3.50\n"
+                     "05/09/2016,Coffee refund,3.50\n")
+
+        counts = import_statement(1, StringIO(statement), default_category_id=3)
+        self.assertEqual(counts, {'imported': 1, 'duplicates': 0, 'skipped': 1})
+
+        # Statements with charges as positive amounts say so
+        counts = import_statement(1, StringIO(statement.replace("Coffee", "Tea")),
+                                  default_category_id=3, charge_sign=1)
+        self.assertEqual(counts, {'imported': 1, 'duplicates': 0, 'skipped': 1})
+        self.assertEqual(Expenditure.query.filter_by(description=u"Tea refund").one().price,
+                         Decimal("3.50"))
+
+    def test_import_failure_keeps_rollup(self):
+        """ Test that batches committed before a failure are in the rollup """
+
+        def rows():
+            yield {'date': datetime(2016, 5, 8), 'amount': Decimal('3.50'), 'where_bought': u"Cafe",
+                   'description': u"Coffee", 'category': u"Food", 'fitid': None}
+            raise ValueError("statement cut off")
+
+        self.assertRaises(ValueError, import_rows, 1, rows(), batch_size=1)
+
+        total, avg, count = expenditure_aggregates(3, 1, "2016-05-01", "2016-05-31")
+        self.assertEqual((total, count), (Decimal('3.50'), 1))
+
+    def test_insert_new_rows_in_chunks(self):
+        """ Test that new rows go in as multi-row INSERTs, not one per row """
+
+        inserts = []
+
+        def count_inserts(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("INSERT INTO expenditures"):
+                inserts.append(executemany)
+
+        rows = [{'category_id': 3, 'price': Decimal(price), 'date_of_expenditure': datetime(2016, 5, 8),
+                 'expenditure_userid': 1, 'where_bought': u"Cafe", 'description': u"Coffee",
+                 'content_hash': "hash%s" % price} for price in range(1, 6)]
+
+        chunk_size = importer.INSERT_CHUNK_SIZE
+        importer.INSERT_CHUNK_SIZE = 2
+        engine = db.session.get_bind()
+        event.listen(engine, 'before_cursor_execute', count_inserts)
+
+        try:
+            importer.insert_new_rows(1, rows)
+            db.session.commit()
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_inserts)
+            importer.INSERT_CHUNK_SIZE = chunk_size
+
+        self.assertEqual(inserts, [False, False, False])
+        self.assertEqual(Expenditure.query.filter_by(expenditure_userid=1).count(), 5)
+
+    def test_import_ofx_endpoint(self):
+        """ Test that an uploaded OFX statement is imported in the background """
+
+        statement = ("OFXHEADER:100\n<OFX><BANKTRANLIST>\n"
+                     "<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20160510<TRNAMT>-12.00"
+                     "<FITID>A1<NAME>Lunch place</STMTTRN>\n"
+                     "<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20160511<TRNAMT>500.00"
+                     "<FITID>A2<NAME>Paycheck</STMTTRN>\n"
+                     "</BANKTRANLIST></OFX>\n")
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        result = self.client.post("/import-expenditures", data=dict(
+            category=3,
+            statement=(StringIO(statement), "statement.ofx")))
+
+        self.assertEqual(result.status_code, 202)
+        status_url = json.loads(result.data)['status_url']
+
+        for attempt in range(100):
+            status = json.loads(self.client.get(status_url).data)
+
+            if status['state'] in ('done', 'failed'):
+                break
+
+            time.sleep(0.05)
+
+        self.assertEqual(status['state'], 'done')
+        self.assertEqual((status['imported'], status['skipped']), (1, 1))
+
+        # The status is in the database, so any worker can answer for it
+        self.assertEqual(ImportJob.query.get(status['job_id']).state, 'done')
+        self.assertEqual(Expenditure.query.filter_by(where_bought="Lunch place").count(), 1)
+
+
+    def test_export_expenditures(self):
+        """ Test that exports stream, filter, resume and gzip """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        for day in [8, 9, 10]:
+            self.client.post("/add-expenditure-to-db", data=dict(
+                category=3,
+                price=day,
+                date="2016-05-%02d" % day,
+                wherebought="Whole Foods",
+                description="groceries"))
+
+        result = self.client.get("/export/expenditures.csv")
+        lines = result.data.splitlines()
+
+        self.assertEqual(lines[0].split(",")[:2], ["expenditure_id", "date_of_expenditure"])
+        self.assertEqual(len(lines), 4)
+
+        # Filtered by category and resumed after the first food row
+        result = self.client.get("/export/expenditures.ndjson?category=3&after=2")
+        rows = [json.loads(line) for line in result.data.splitlines()]
+        self.assertEqual([row['date_of_expenditure'] for row in rows],
+                         ["2016-05-09", "2016-05-10"])
+
+        result = self.client.get("/export/expenditures.csv?start=2016-05-09&end=2016-05-09",
+                                 headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        lines = gzip.GzipFile(fileobj=StringIO(result.data)).read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn("9.00", lines[1])
+
+
+    def test_add_budget_replaces_existing(self):
+        """ Test that adding a budget twice leaves one budget per category """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        self.client.post("/add-expenditure-to-db", data=dict(
+            category=3,
+            price=40,
+            date="2016-05-20",
+            wherebought="Market",
+            description="groceries"))
+
+        for amount in [300, 500]:
+            result = self.client.post("/add-budget", data={
+                'budget': amount,
+                'category': 3,
+                'start-date': "2016-05-01",
+                'end-date': "2016-05-31"})
+
+        budgets = Budget.query.filter_by(budget_userid=1, category_id=3).all()
+        self.assertEqual(len(budgets), 1)
+        self.assertEqual(budgets[0].budget, Decimal("500.00"))
+
+        budget_info = json.loads(result.data)
+        self.assertEqual(budget_info['id'], budgets[0].id)
+        self.assertEqual(budget_info['category'], "Food")
+        self.assertEqual(budget_info['cat_budget_minus_expenses'], 460.0)
+
+
+    def test_batch_expenditures(self):
+        """ Test that batches are validated up front and resends are skipped """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        self.client.post("/budgets/batch", content_type="application/json", data=json.dumps({
+            'budgets': [{'category_id': 3, 'budget': "100", 'start_date': "2016-05-01",
+                         'end_date': "2016-05-31"}]}))
+
+        expenditures = [
+            {'client_id': "a", 'category_id': 3, 'price': "12.50", 'date': "2016-05-20"},
+            {'client_id': "b", 'category_id': 3, 'price': "7.50", 'date': "2016-05-20"},
+            {'client_id': "c", 'category_id': 2, 'price': "30", 'date': "2016-05-21"}]
+
+        # One bad entry and nothing is written
+        result = self.client.post("/expenditures/batch", content_type="application/json",
+                                  data=json.dumps({'expenditures': expenditures + [
+                                      {'category_id': 99, 'price': "1", 'date': "2016-05-20"}]}))
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(json.loads(result.data)['errors'][0]['index'], 3)
+        self.assertEqual(Expenditure.query.filter_by(expenditure_userid=1).count(), 0)
+
+        result = self.client.post("/expenditures/batch", content_type="application/json",
+                                  data=json.dumps({'expenditures': expenditures}))
+        batch_info = json.loads(result.data)
+        self.assertEqual(batch_info['inserted'], 3)
+
+        food = [category for category in batch_info['categories'] if category['category_id'] == 3][0]
+        self.assertEqual((food['total'], food['count'], food['remaining']), (20.0, 2, 80.0))
+
+        # Resending the same batch adds nothing
+        result = self.client.post("/expenditures/batch", content_type="application/json",
+                                  data=json.dumps({'expenditures': expenditures}))
+        self.assertEqual(json.loads(result.data)['inserted'], 0)
+        self.assertEqual(DailySpending.query.filter_by(category_id=3).one().count, 2)
+
+
+    def test_login_rehashes_plaintext_password(self):
+        """ Test that a plaintext password is hashed on the next login """
+
+        self.assertEqual(User.query.get(1).password, "mu")
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        stored = User.query.get(1).password
+        self.assertTrue(stored.startswith("pbkdf2_sha256$"))
+        self.assertTrue(verify_password("mu", stored))
+        self.assertFalse(verify_password("wrong", stored))
+
+        # The hash works for the next login and is left alone
+        self.client.get("/logout")
+        result = self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        self.assertNotIn("Error in logging in", result.data)
+        self.assertEqual(User.query.get(1).password, stored)
+
+
+    def test_spending_series(self):
+        """ Test that spending is bucketed by week and month in the database """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        # A Sunday and the Monday after it, then a day in the next month
+        for price, day in [(10, "2016-05-08"), (20, "2016-05-09"), (5, "2016-06-01")]:
+            self.client.post("/add-expenditure-to-db", data=dict(
+                category=3,
+                price=price,
+                date=day,
+                wherebought="Market",
+                description="groceries"))
+
+        result = self.client.get("/spending-series.json?start=2016-05-01&end=2016-06-30&bucket=week")
+        series = json.loads(result.data)['series']
+        self.assertEqual([(point['period'], point['total'], point['count']) for point in series],
+                         [("2016-05-02", 10.0, 1), ("2016-05-09", 20.0, 1), ("2016-05-30", 5.0, 1)])
+
+        result = self.client.get("/spending-series.json?start=2016-05-01&end=2016-06-30&bucket=month&category=3")
+        series = json.loads(result.data)['series']
+        self.assertEqual([(point['period'], point['total']) for point in series],
+                         [("2016-05-01", 30.0), ("2016-06-01", 5.0)])
+
+        # Twenty years of days is too long; without a bucket one is picked
+        result = self.client.get("/spending-series.json?start=1996-01-01&end=2016-01-01&bucket=day")
+        self.assertEqual(result.status_code, 400)
+
+        result = self.client.get("/spending-series.json?start=1996-01-01&end=2016-01-01")
+        self.assertEqual(json.loads(result.data)['bucket'], 'month')
+
+
+    def test_asset_bundles(self):
+        """ Test that bundles get hashed names and are served precompressed
+        with far-future caching """
+
+        static_folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(static_folder, "css"))
+
+        with open(os.path.join(static_folder, "css", "a.css"), "w") as css_file:
+            css_file.write("/* comment */\nbody {\n  background: url(../img/a.png);\n}\n")
+
+        manifest = assets.build(static_folder, {'site.css': ["css/a.css"]})
+        self.assertRegexpMatches(manifest['site.css'], r"^dist/site\.[0-9a-f]{12}\.css$")
+
+        with open(os.path.join(static_folder, manifest['site.css'])) as bundle_file:
+            content = bundle_file.read()
+
+        # Minified, with the image still found from the dist folder
+        self.assertEqual(content, "body{background: url(../img/a.png);}")
+
+        compressed = open(os.path.join(static_folder, manifest['site.css'] + ".gz")).read()
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), content)
+
+        # Editing a source makes the bundles stale
+        bundles = {'site.css': ["css/a.css"]}
+        self.assertFalse(assets.sources_changed(static_folder, bundles))
+        future = time.time() + 60
+        os.utime(os.path.join(static_folder, "css", "a.css"), (future, future))
+        self.assertTrue(assets.sources_changed(static_folder, bundles))
+
+        # The app's own bundles, linked from every page
+        page = self.client.get("/").data
+        url = [line for line in page.split('"') if line.startswith("/static/dist/base.")][0]
+
+        result = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(result.mimetype, 'text/css')
+        self.assertIn("immutable", result.headers['Cache-Control'])
+        self.assertIn("max-age=%d" % assets.ASSET_MAX_AGE, result.headers['Cache-Control'])
+        self.assertIn("glyphicons", gzip.GzipFile(fileobj=StringIO(result.data)).read())
+
+    def test_budget_statuses(self):
+        """ Test that the nightly job records every budget's status and counts
+        each user's budgets that are over """
+
+        # Log in a test client
+        self.client.post("/login-form", data=dict(
+            email="mu@mu.com",
+            password="mu"), follow_redirects=True)
+
+        self.client.post("/add-budget", data={
+            'category': 2, 'budget': "300", 'start-date': "2016-05-01", 'end-date': "2016-05-31"})
+
+        # Over the food budget; the travel one is only partly spent
+        for category, price in [(3, 700), (3, 500), (2, 100)]:
+            self.client.post("/add-expenditure-to-db", data=dict(
+                category=category,
+                price=price,
+                date="2016-05-10",
+                wherebought="Market",
+                description="groceries"))
+
+        self.assertEqual(refresh_budget_statuses(batch_size=1), 2)
+
+        food = BudgetStatus.query.get((1, 3))
+        self.assertTrue(food.over_budget)
+        self.assertEqual(food.remaining, Decimal("-200.00"))
+        self.assertAlmostEqual(food.progress, -20.0)
+        self.assertEqual(food.count, 2)
+
+        travel = BudgetStatus.query.get((1, 2))
+        self.assertFalse(travel.over_budget)
+        self.assertEqual(travel.total, Decimal("100.00"))
+
+        self.assertEqual([food.categories_over_budget, travel.categories_over_budget], [1, 1])
+        self.assertEqual(users_over_budget(), [1])
+        self.assertEqual(users_over_budget(2), [])
+
+        # A second run replaces the first
+        self.assertEqual(refresh_budget_statuses(), 2)
+        self.assertEqual(BudgetStatus.query.count(), 2)
+
 if __name__ == "__main__":
     unittest.main()
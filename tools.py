@@ -1,35 +1,119 @@
-from model import Expenditure, Budget
+from model import db, Budget, DailySpending, Expenditure
 
-from datetime import datetime
+from cache import user_cache
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import and_, or_
+
+from datetime import datetime, date
+
+from decimal import Decimal
+
+import base64
+
+# strptime imports this lazily, which fails when threads race to do it first
+import _strptime
 
 
 ########## THIS FILE CONTAINS WIDELY USED FUNCTIONS ###########
 
 
+# Formats dates arrive in from forms, the dashboard, imported statements
+# and the tests
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f',
+                '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%m-%d-%Y', '%m/%d/%Y']
+
+# Number of expenditures shown per page of the dashboard ledger
+EXPENDITURE_PAGE_SIZE = 50
+
+
+def parse_date(value):
+    """ Turn a date string from a form into a datetime; datetimes and None
+    pass straight through """
+
+    if value is None or isinstance(value, datetime):
+        return value
+
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+
+    value = value.strip()
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+
+    raise ValueError("Unrecognized date: %r" % value)
+
+
+def expenditure_aggregates(category_id, id, start, end):
+    """ Get the total, average and number of expenditures in one category,
+    read from the daily spending rollup without loading any expenditures """
+
+    start = parse_date(start)
+    end = parse_date(end)
+
+    # The rollup is kept per day, so the window covers whole days
+    total_price, count = db.session.query(
+        func.coalesce(func.sum(DailySpending.total), 0),
+        func.coalesce(func.sum(DailySpending.count), 0)).filter(
+        DailySpending.category_id == category_id,
+        DailySpending.spending_userid == id,
+        DailySpending.day.between(
+            start.date() if start else None,
+            end.date() if end else None)).one()
+
+    # The sum comes back as a Decimal, so dividing it here keeps the average
+    # exact on every database instead of relying on AVG's float result
+    total_price = Decimal(total_price)
+    count = int(count)
+
+    if count:
+        avg_expenditures = total_price/count
+    else:
+        avg_expenditures = Decimal(0)
+
+    return total_price, avg_expenditures, count
+
+
+@user_cache.cached('expenditure_function', user_arg=1)
 def expenditure_function(category_id, id, start, end):
     """ Calculate the total amount and avg spent in one particular category """
 
-    # List of expenditure objects
-    expenditures = Expenditure.query.filter_by(
-        category_id=category_id, expenditure_userid=id).filter(
-        Expenditure.date_of_expenditure.between(start, end)).all()
+    total_price, avg_expenditures, count = expenditure_aggregates(category_id, id, start, end)
 
-    # Initialize the total price at 0
-    total_price = 0
+    return float(total_price), float(avg_expenditures)
 
-    # Increase the total price by the price of each expenditure
-    for expenditure in expenditures:
-        expenditure_price = expenditure.price
-        total_price += expenditure_price
 
-    # This gets the average price; if there is an error due to no
-    # expenditures, it returns the value of "0"
-    try:
-        avg_expenditures = total_price/len(expenditures)
-    except ZeroDivisionError:
-        avg_expenditures = "0"
+def get_category_totals(id, start, end):
+    """ Calculate the total amount and avg spent in every category at once;
+    categories with nothing spent are left out """
 
-    return float(total_price), float(avg_expenditures)
+    start = parse_date(start)
+    end = parse_date(end)
+
+    rows = db.session.query(
+        DailySpending.category_id,
+        func.sum(DailySpending.total),
+        func.sum(DailySpending.count)).filter(
+        DailySpending.spending_userid == id,
+        DailySpending.day.between(
+            start.date() if start else None,
+            end.date() if end else None)).group_by(
+        DailySpending.category_id).all()
+
+    category_totals = {}
+
+    for category_id, total_price, count in rows:
+        total_price = Decimal(total_price)
+        count = int(count)
+        avg_expenditures = total_price/count if count else Decimal(0)
+        category_totals[category_id] = (float(total_price), float(avg_expenditures))
+
+    return category_totals
 
 
 def get_dates_for_budget(category_id, id):
@@ -49,6 +133,7 @@ def get_dates_for_budget(category_id, id):
     return start_date, end_date
 
 
+@user_cache.cached('budget_totals', user_arg=1)
 def budget_totals(category_id, id, total_price):
     """ Calculate budget minus expenditures made """
 
@@ -113,3 +198,303 @@ def get_progress(cat_minus_expenses, budget):
     cat_progress = str(progress * 100)
 
     return cat_progress
+
+
+
+def summarize_budget(budget, start, end, total, count):
+    """ Get the widget numbers for one budget from its spending total and
+    count """
+
+    count = int(count)
+
+    try:
+        avg = float(total)/count
+    except ZeroDivisionError:
+        avg = 0.0
+
+    remaining = float(budget) - float(total)
+
+    return {
+        'budget': budget,
+        'start_date': start,
+        'end_date': end,
+        'total': float(total),
+        'avg': avg,
+        'count': count,
+        'remaining': remaining,
+        'progress': get_progress(remaining, budget)
+    }
+
+
+def budget_summaries(id, category_ids):
+    """ Get budget, dates, totals, averages, remaining and progress for every
+    category in one grouped query """
+
+    if not category_ids:
+        return {}
+
+    # Join each of the user's budgets to the daily spending rollup rows that
+    # fall inside the budget's date window, and add them up per budget in the
+    # database
+    rows = db.session.query(
+        Budget.id,
+        Budget.category_id,
+        Budget.budget,
+        Budget.budget_start_date,
+        Budget.budget_end_date,
+        func.coalesce(func.sum(DailySpending.total), 0),
+        func.coalesce(func.sum(DailySpending.count), 0)).outerjoin(
+        DailySpending, and_(
+            DailySpending.category_id == Budget.category_id,
+            DailySpending.spending_userid == Budget.budget_userid,
+            DailySpending.day.between(
+                func.date(Budget.budget_start_date), func.date(Budget.budget_end_date)))).filter(
+        Budget.budget_userid == id,
+        Budget.category_id.in_(list(category_ids))).group_by(
+        Budget.id,
+        Budget.category_id,
+        Budget.budget,
+        Budget.budget_start_date,
+        Budget.budget_end_date).order_by(Budget.id).all()
+
+    summaries = {}
+
+    # Categories without a budget behave the way the single category helpers
+    # do: no budget, a window of today, and nothing spent
+    today = datetime.now()
+
+    for category_id in category_ids:
+        summaries[category_id] = {
+            'budget': 0,
+            'start_date': today,
+            'end_date': today,
+            'total': 0.0,
+            'avg': 0.0,
+            'count': 0,
+            'remaining': 0,
+            'progress': get_progress(0, 0)
+        }
+
+    # Only the first budget per category counts, like get_budget_per_category;
+    # databases upgraded past migration 6 have just one
+    seen = set()
+
+    for budget_id, category_id, budget, start, end, total, count in rows:
+        if category_id in seen:
+            continue
+
+        seen.add(category_id)
+        summaries[category_id] = summarize_budget(budget, start, end, total, count)
+
+    return summaries
+
+
+@user_cache.cached('get_dashboard_data')
+def get_dashboard_data(id, category_ids):
+    """ Cached budget_summaries for the dashboard widgets """
+
+    return budget_summaries(id, category_ids)
+
+
+# Replaces the user's budget for a category, or adds it, and totals the
+# rollup over the new budget window, all in one statement
+UPSERT_BUDGET_SQL = """
+WITH upserted AS (
+    INSERT INTO budget (budget, category_id, budget_userid, budget_start_date, budget_end_date)
+    VALUES (:budget, :category_id, :user_id, :start_date, :end_date)
+    ON CONFLICT (budget_userid, category_id) DO UPDATE SET
+        budget = EXCLUDED.budget,
+        budget_start_date = EXCLUDED.budget_start_date,
+        budget_end_date = EXCLUDED.budget_end_date
+    RETURNING id, budget, budget_start_date, budget_end_date
+)
+SELECT upserted.id, upserted.budget, upserted.budget_start_date, upserted.budget_end_date,
+       COALESCE(SUM(daily_spending.total), 0), COALESCE(SUM(daily_spending.count), 0)
+FROM upserted
+LEFT OUTER JOIN daily_spending
+    ON daily_spending.spending_userid = :user_id
+    AND daily_spending.category_id = :category_id
+    AND daily_spending.day BETWEEN DATE(upserted.budget_start_date) AND DATE(upserted.budget_end_date)
+GROUP BY upserted.id, upserted.budget, upserted.budget_start_date, upserted.budget_end_date
+"""
+
+
+def save_budget(id, category_id, budget, start_date, end_date):
+    """ Make this the user's only budget for the category and get its id and
+    widget numbers, in the caller's transaction """
+
+    start_date = parse_date(start_date)
+    end_date = parse_date(end_date)
+
+    if db.engine.dialect.name == "postgresql":
+
+        # One round trip, atomic against a concurrent double submit
+        budget_id, budget, start, end, total, count = db.session.execute(
+            db.text(UPSERT_BUDGET_SQL), {
+                'budget': budget,
+                'category_id': category_id,
+                'user_id': id,
+                'start_date': start_date,
+                'end_date': end_date}).first()
+
+        return budget_id, summarize_budget(budget, start, end, total, count)
+
+    # Elsewhere, update the budget in place or add it; the unique index on
+    # (budget_userid, category_id) still rejects a duplicate
+    existing = Budget.query.filter_by(budget_userid=id, category_id=category_id).first()
+
+    if existing is None:
+        existing = Budget(budget_userid=id, category_id=category_id)
+        db.session.add(existing)
+
+    existing.budget = budget
+    existing.budget_start_date = start_date
+    existing.budget_end_date = end_date
+    db.session.flush()
+
+    return existing.id, budget_summaries(id, [category_id])[category_id]
+
+
+def save_budgets(id, budgets):
+    """ Make each of a list of (category_id, budget, start_date, end_date)
+    the user's only budget for its category, in one statement on PostgreSQL
+    and in the caller's transaction. Later entries for a category win. """
+
+    # One row per category, or the upsert would hit the same row twice
+    latest = {}
+
+    for category_id, budget, start_date, end_date in budgets:
+        latest[category_id] = (budget, parse_date(start_date), parse_date(end_date))
+
+    if not latest:
+        return
+
+    if db.engine.dialect.name == "postgresql":
+        values = []
+        params = {'user_id': id}
+
+        for position, (category_id, (budget, start_date, end_date)) in enumerate(sorted(latest.items())):
+            values.append("(:budget_%d, :category_id_%d, :user_id, :start_date_%d, :end_date_%d)"
+                          % (position, position, position, position))
+            params.update({
+                'budget_%d' % position: budget,
+                'category_id_%d' % position: category_id,
+                'start_date_%d' % position: start_date,
+                'end_date_%d' % position: end_date})
+
+        db.session.execute(db.text(
+            "INSERT INTO budget (budget, category_id, budget_userid, budget_start_date, budget_end_date) "
+            "VALUES %s "
+            "ON CONFLICT (budget_userid, category_id) DO UPDATE SET "
+            "budget = EXCLUDED.budget, "
+            "budget_start_date = EXCLUDED.budget_start_date, "
+            "budget_end_date = EXCLUDED.budget_end_date" % ", ".join(values)), params)
+
+        return
+
+    existing = dict((budget.category_id, budget) for budget in Budget.query.filter(
+        Budget.budget_userid == id,
+        Budget.category_id.in_(list(latest))))
+
+    for category_id, (budget, start_date, end_date) in latest.items():
+        row = existing.get(category_id)
+
+        if row is None:
+            row = Budget(budget_userid=id, category_id=category_id)
+            db.session.add(row)
+
+        row.budget = budget
+        row.budget_start_date = start_date
+        row.budget_end_date = end_date
+
+    db.session.flush()
+
+
+def encode_cursor(expenditure):
+    """ Make an opaque cursor pointing just past this expenditure """
+
+    # Undated expenditures come after every dated one, so their cursors only
+    # need the id
+    if expenditure.date_of_expenditure is None:
+        date_string = ""
+    else:
+        date_string = expenditure.date_of_expenditure.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    return base64.urlsafe_b64encode("%s|%s" % (date_string, expenditure.id))
+
+
+def decode_cursor(cursor):
+    """ Get the (date, id) position back out of a cursor; the date is None
+    inside the undated expenditures """
+
+    try:
+        date_string, expenditure_id = base64.urlsafe_b64decode(str(cursor)).split("|")
+        last_date = datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S.%f') if date_string else None
+        return last_date, int(expenditure_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor: %r" % cursor)
+
+
+def get_expenditure_page(id, cursor=None, limit=EXPENDITURE_PAGE_SIZE):
+    """ Get one page of the user's expenditures, newest first with undated
+    ones last, and the cursor for the next page (None on the last page) """
+
+    # Categories are loaded in the same query so the ledger doesn't issue a
+    # query per row
+    query = Expenditure.query.options(joinedload(Expenditure.category)).filter(
+        Expenditure.expenditure_userid == id)
+
+    last_date, last_id = decode_cursor(cursor) if cursor else (None, None)
+    expenditures = []
+
+    # Keyset pagination: continue strictly after the last row already shown,
+    # so every page costs the same no matter how deep it is. Dated rows come
+    # first, unless the cursor is already past them.
+    if last_id is None or last_date is not None:
+        dated = query.filter(Expenditure.date_of_expenditure.isnot(None))
+
+        if last_id is not None:
+            dated = dated.filter(or_(
+                Expenditure.date_of_expenditure < last_date,
+                and_(Expenditure.date_of_expenditure == last_date,
+                     Expenditure.id < last_id)))
+
+        # Fetch one extra row to know if there is another page
+        expenditures = dated.order_by(
+            Expenditure.date_of_expenditure.desc(),
+            Expenditure.id.desc()).limit(limit + 1).all()
+
+    # Then the undated ones, newest (highest id) first, to fill the page
+    if len(expenditures) <= limit:
+        undated = query.filter(Expenditure.date_of_expenditure.is_(None))
+
+        if last_id is not None and last_date is None:
+            undated = undated.filter(Expenditure.id < last_id)
+
+        expenditures += undated.order_by(
+            Expenditure.id.desc()).limit(limit + 1 - len(expenditures)).all()
+
+    if len(expenditures) > limit:
+        expenditures = expenditures[:limit]
+        next_cursor = encode_cursor(expenditures[-1])
+    else:
+        next_cursor = None
+
+    return expenditures, next_cursor
+
+
+def expenditure_to_dict(expenditure):
+    """ Get the JSON-friendly info for one expenditure """
+
+    return {
+        'expenditure_id': expenditure.id,
+        'category_id': expenditure.category_id,
+        'category': expenditure.category.category if expenditure.category else None,
+        'price': str(expenditure.price),
+        'date_of_expenditure': (expenditure.date_of_expenditure.strftime('%Y-%m-%d')
+                                if expenditure.date_of_expenditure else None),
+        'where_bought': expenditure.where_bought,
+        'description': expenditure.description,
+        'tracking_num': expenditure.tracking_num,
+        'tracking_num_carrier': expenditure.tracking_num_carrier
+    }
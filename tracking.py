@@ -0,0 +1,145 @@
+""" Client for the Shippo package tracking API """
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from cache import LRUCache
+
+from model import db, TrackingStatus
+
+from datetime import datetime
+
+import os
+
+import requests
+
+import time
+
+
+# Point this at a local stub server for tests and benchmarks
+SHIPPO_BASE_URL = os.getenv('SHIPPO_BASE_URL', 'https://api.goshippo.com/v1')
+
+# Seconds to wait for a connection and for each read from Shippo
+CONNECT_TIMEOUT = float(os.getenv('SHIPPO_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('SHIPPO_READ_TIMEOUT', 5))
+
+# Packages on the move are looked up again after a few minutes, while
+# packages that reached a final status effectively never change again
+IN_TRANSIT_TTL = int(os.getenv('SHIPPO_IN_TRANSIT_TTL', 300))
+FINAL_TTL = int(os.getenv('SHIPPO_FINAL_TTL', 30 * 24 * 60 * 60))
+
+FINAL_STATUSES = set(['DELIVERED', 'RETURNED', 'FAILURE'])
+
+
+class TrackingClient(object):
+    """ Looks up tracking statuses over a shared, pooled HTTP session and
+    caches them by (carrier, tracking number) """
+
+    def __init__(self, base_url=SHIPPO_BASE_URL, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retries=2, backoff_factor=0.3,
+                 in_transit_ttl=IN_TRANSIT_TTL, final_ttl=FINAL_TTL, cache_size=10000):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.in_transit_ttl = in_transit_ttl
+        self.final_ttl = final_ttl
+        self.cache = LRUCache(cache_size)
+
+        # Only idempotent GETs are retried, backing off between attempts
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      method_whitelist=['GET'])
+
+        # One keep-alive session shared by every lookup in this process
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, carrier, tracking_num):
+        """ Creates the API URL for a tracking number """
+
+        return "%s/tracks/%s/%s/" % (self.base_url, carrier, tracking_num)
+
+    def fetch(self, carrier, tracking_num):
+        """ Get the tracking data from Shippo, skipping the cache. Raises
+        requests.RequestException if Shippo can't be reached or fails, and
+        ValueError if it answers with something that isn't JSON. """
+
+        response = self.session.get(self.url(carrier, tracking_num), timeout=self.timeout)
+        response.raise_for_status()
+
+        return response.json()
+
+    def ttl_for(self, data):
+        """ How long tracking data stays fresh, based on its status """
+
+        status = (data.get('tracking_status') or {}).get('status')
+
+        if status in FINAL_STATUSES:
+            return self.final_ttl
+
+        return self.in_transit_ttl
+
+    def track(self, carrier, tracking_num):
+        """ Get the tracking data, from the cache while it is fresh """
+
+        key = "%s:%s" % (carrier, tracking_num)
+        cached = self.cache.get(key)
+
+        if cached is not None:
+            expires_at, data = cached
+
+            if expires_at > time.time():
+                return data
+
+        data = self.fetch(carrier, tracking_num)
+        self.cache.set(key, (time.time() + self.ttl_for(data), data))
+
+        return data
+
+
+def address_info(data):
+    """ Pull the location and status the map needs out of tracking data """
+
+    tracking_status = data.get('tracking_status') or {}
+    final_dest = tracking_status.get('location') or {}
+
+    return {
+        'city': final_dest.get('city'),
+        'state': final_dest.get('state'),
+        'zipcode': final_dest.get('zip'),
+        'country': final_dest.get('country'),
+        'tracking_status': tracking_status.get('status')
+    }
+
+
+def save_tracking_status(carrier, tracking_num, data, failures=0):
+    """ Store the latest status of a package in the caller's session """
+
+    address = address_info(data)
+
+    db.session.merge(TrackingStatus(tracking_num_carrier=carrier,
+                                    tracking_num=tracking_num,
+                                    status=address['tracking_status'],
+                                    city=address['city'],
+                                    state=address['state'],
+                                    zipcode=address['zipcode'],
+                                    country=address['country'],
+                                    updated_at=datetime.now(),
+                                    failures=failures))
+
+
+def tracking_status_info(tracking_status):
+    """ The stored status in the same shape as address_info """
+
+    return {
+        'city': tracking_status.city,
+        'state': tracking_status.state,
+        'zipcode': tracking_status.zipcode,
+        'country': tracking_status.country,
+        'tracking_status': tracking_status.status
+    }
+
+
+tracking_client = TrackingClient()
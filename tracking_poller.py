@@ -0,0 +1,159 @@
+""" Background worker that keeps tracking_statuses up to date
+
+Run `python tracking_poller.py` as its own process (see the Procfile's worker
+entry), or `python tracking_poller.py --once` for a single pass.
+"""
+
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import func
+from sqlalchemy.sql import and_, or_
+
+from model import db, connect_to_db, Expenditure, TrackingStatus
+
+from tracking import tracking_client, save_tracking_status, FINAL_STATUSES
+
+from datetime import datetime, timedelta
+
+import requests
+
+import os
+
+import sys
+
+import time
+
+
+# Seconds between passes, and how many lookups run at once
+POLL_INTERVAL = int(os.getenv('TRACKING_POLL_INTERVAL', 600))
+POLL_CONCURRENCY = int(os.getenv('TRACKING_POLL_CONCURRENCY', 8))
+
+# Packages stop being polled once they are this old, or after this many
+# lookups in a row failed or found nothing (invalid tracking numbers)
+TRACKING_MAX_AGE_DAYS = int(os.getenv('TRACKING_MAX_AGE_DAYS', 90))
+TRACKING_MAX_FAILURES = int(os.getenv('TRACKING_MAX_FAILURES', 20))
+
+# What Shippo answers for tracking numbers it knows nothing about
+UNKNOWN_STATUSES = set([None, 'UNKNOWN'])
+
+
+def pending_packages(max_age_days=TRACKING_MAX_AGE_DAYS, max_failures=TRACKING_MAX_FAILURES):
+    """ Get (carrier, tracking number, failures so far) for every package
+    that hasn't reached a final status yet and is still worth polling """
+
+    oldest = datetime.now() - timedelta(days=max_age_days)
+    failures = func.coalesce(TrackingStatus.failures, 0)
+
+    rows = db.session.query(
+        Expenditure.tracking_num_carrier,
+        Expenditure.tracking_num,
+        failures).outerjoin(
+        TrackingStatus, and_(
+            TrackingStatus.tracking_num_carrier == Expenditure.tracking_num_carrier,
+            TrackingStatus.tracking_num == Expenditure.tracking_num)).filter(
+        Expenditure.tracking_num.isnot(None),
+        Expenditure.tracking_num != "",
+        Expenditure.tracking_num_carrier.isnot(None),
+        or_(Expenditure.date_of_expenditure.is_(None),
+            Expenditure.date_of_expenditure >= oldest),
+        failures < max_failures,
+        or_(TrackingStatus.status.is_(None),
+            ~TrackingStatus.status.in_(list(FINAL_STATUSES)))).distinct().all()
+
+    return rows
+
+
+def record_failure(carrier, tracking_num, failures):
+    """ Count a failed lookup against a package, keeping its last status """
+
+    tracking_status = TrackingStatus.query.get((carrier, tracking_num))
+
+    if tracking_status is None:
+        tracking_status = TrackingStatus(tracking_num_carrier=carrier, tracking_num=tracking_num)
+        db.session.add(tracking_status)
+
+    tracking_status.failures = failures
+    tracking_status.updated_at = datetime.now()
+
+
+def poll_once(client=tracking_client, concurrency=POLL_CONCURRENCY):
+    """ Refresh every pending package once. Returns how many were updated
+    and how many lookups failed. """
+
+    packages = pending_packages()
+
+    # Release the connection while the lookups run
+    db.session.commit()
+
+    def fetch(package):
+        carrier, tracking_num, failures = package
+
+        try:
+            return carrier, tracking_num, failures, client.fetch(carrier, tracking_num)
+        except (requests.RequestException, ValueError):
+            return carrier, tracking_num, failures, None
+
+    updated = 0
+    failed = []
+
+    # Lookups fan out over a bounded pool of threads; the database writes
+    # stay on this thread, since sessions can't be shared between threads
+    pool = ThreadPool(max(1, min(concurrency, len(packages))))
+
+    try:
+        for carrier, tracking_num, failures, data in pool.imap_unordered(fetch, packages):
+            if data is None:
+                failed.append((carrier, tracking_num, failures))
+                continue
+
+            status = (data.get('tracking_status') or {}).get('status')
+
+            # Found, but unknown to the carrier, counts towards giving up
+            if status in UNKNOWN_STATUSES:
+                failures += 1
+            else:
+                failures = 0
+
+            save_tracking_status(carrier, tracking_num, data, failures)
+            updated += 1
+
+    finally:
+        pool.close()
+        pool.join()
+
+    # When every lookup fails, Shippo is down; that says nothing about the
+    # packages, so it doesn't count against them
+    if updated:
+        for carrier, tracking_num, failures in failed:
+            record_failure(carrier, tracking_num, failures + 1)
+
+    db.session.commit()
+
+    return updated, len(failed)
+
+
+def run(interval=POLL_INTERVAL):
+    """ Poll forever, one pass every interval seconds """
+
+    while True:
+        started = time.time()
+        updated, failed = poll_once()
+
+        print "Tracking poll: %s updated, %s failed in %.1fs" % (updated, failed, time.time() - started)
+
+        time.sleep(max(0, interval - (time.time() - started)))
+
+
+if __name__ == "__main__":
+    from flask import Flask
+
+    app = Flask(__name__)
+
+    spent_database = os.getenv('POSTGRES_DB_URL', 'postgres:///spending')
+    connect_to_db(app, spent_database)
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    if "--once" in sys.argv:
+        print "Tracking poll: %s updated, %s failed" % poll_once()
+    else:
+        run()